@@ -0,0 +1,332 @@
+
+import json
+import os
+import shutil
+import struct
+import threading
+import time
+import uuid
+
+from lazy_imports import np
+from PyQt6.QtCore import QObject, QRunnable, QThreadPool, QTimer, QLockFile, QStandardPaths
+from PyQt6.QtGui import QImage
+
+import image_io
+from ProjectFile import ProjectFile
+
+
+'''
+Autosave and crash recovery
+
+Every running window has a session folder in the cache directory:
+    lock          QLockFile, held while the window runs (stale after a crash)
+    session.json  what is being edited (path, size, time of last checkpoint)
+    base.ppp      full checkpoint (project file)
+    journal.bin   changed tiles appended after the base, one record per checkpoint
+
+A record is only used if it was written completely, so a crash while autosaving
+loses at most the last checkpoint. Records carry the generation of the base they
+belong to, so records that are older than a rewritten base are ignored.
+'''
+AUTOSAVE_INTERVAL_MS = 30_000           # Time between checkpoints
+RETRY_MS = 2_000                        # Try again soon when a checkpoint had to be skipped
+CHANNEL = "autosave"                    # Dirty tiles channel on the canvas
+
+RECORD_MAGIC = b"TREC"
+RECORD_END = b"DONE"
+
+
+def autosave_root():
+    base = QStandardPaths.writableLocation(QStandardPaths.StandardLocation.CacheLocation)
+    return os.path.join(base or os.path.expanduser("~/.cache/Paint++"), "autosave")
+
+
+# ----- Recovery ----- #
+
+# Sessions whose window is gone without closing cleanly (list of (folder, session info dict)), newest first
+def find_crashed_sessions():
+
+    root = autosave_root()
+    if not os.path.isdir(root):
+        return []
+
+    found = []
+    for name in os.listdir(root):
+        folder = os.path.join(root, name)
+
+        # A session that is still running holds its lock
+        lock = QLockFile(os.path.join(folder, "lock"))
+        lock.setStaleLockTime(0)                # Only a dead owner makes it stale, not its age
+        if not lock.tryLock(0):
+            continue
+        lock.unlock()
+
+        try:
+            with open(os.path.join(folder, "session.json"), "r", encoding="utf-8") as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            info = None
+
+        # Nothing was checkpointed, nothing to recover
+        if info is None or not os.path.exists(os.path.join(folder, "base.ppp")):
+            shutil.rmtree(folder, ignore_errors=True)
+            continue
+
+        found.append((folder, info))
+
+    found.sort(key=lambda item: item[1].get("saved", 0), reverse=True)
+    return found
+
+
+# Read complete journal records, yields (meta dict, payload bytes)
+def read_journal(path):
+
+    if not os.path.exists(path):
+        return
+
+    with open(path, "rb") as f:
+        while True:
+            head = f.read(12)
+            if len(head) < 12 or head[:4] != RECORD_MAGIC:
+                return
+            meta_len, payload_len = struct.unpack("<II", head[4:])
+
+            meta = f.read(meta_len)
+            payload = f.read(payload_len)
+            if len(meta) < meta_len or len(payload) < payload_len or f.read(4) != RECORD_END:
+                return                          # Cut off by a crash
+
+            yield json.loads(meta.decode("utf-8")), payload
+
+
+# Rebuild the last checkpoint of a session, returns (QImage, meta) or (None, error message)
+def recover_session(folder):
+
+    try:
+        base = ProjectFile.open(os.path.join(folder, "base.ppp"))
+        img = base.read_image()
+    except (OSError, ValueError, KeyError) as e:
+        return None, str(e)
+
+    meta = dict(base.header)
+    generation = meta.get("generation")
+    pixels = image_io.qimage_view(img)
+
+    for record, payload in read_journal(os.path.join(folder, "journal.bin")):
+        if record.get("generation") != generation:
+            continue
+
+        # Copy each tile back in place
+        pos = 0
+        for x, y, w, h in record["tiles"]:
+            size = w * h * 4
+            pixels[y:y + h, x:x + w] = np.frombuffer(payload, np.uint8, size, pos).reshape(h, w, 4)
+            pos += size
+        meta.update(record["meta"])
+
+    return img, meta
+
+
+def discard_session(folder):
+    shutil.rmtree(folder, ignore_errors=True)
+
+
+# ----- Writing checkpoints ----- #
+
+'''
+Write one checkpoint on a worker thread.
+image:   full snapshot, writes a new base (journal is emptied)
+tiles:   list of (x, y, w, h), with payload holding their pixels, appended to the journal
+'''
+class AutosaveTask(QRunnable):
+
+    def __init__(self, folder, session, meta, generation, image=None, tiles=None, payload=b""):
+        super().__init__()
+        self.setAutoDelete(False)               # Python keeps the reference
+
+        self.folder = folder
+        self.session = session
+        self.meta = meta
+        self.generation = generation
+        self.image = image
+        self.tiles = tiles or []
+        self.payload = payload
+        self.signals = image_io.ImageSaveSignals()
+
+        # The session can end while this runs, then the task removes the folder itself
+        self.state_lock = threading.Lock()
+        self.done = False
+        self.remove_when_done = False
+
+
+    def run(self):
+        error = ""
+        try:
+            if self.image is not None:
+                self.write_base()
+            else:
+                self.append_record()
+            self.write_session()
+        except OSError as e:
+            error = str(e)
+
+        with self.state_lock:
+            self.done = True
+            remove = self.remove_when_done
+        if remove:
+            discard_session(self.folder)
+            return
+
+        if error:
+            self.signals.failed.emit(self.folder, error)
+        else:
+            self.signals.finished.emit(self.folder)
+
+
+    # Remove the session folder now, or when the running write is finished
+    def discard_session(self):
+        with self.state_lock:
+            if not self.done:
+                self.remove_when_done = True
+                return
+        discard_session(self.folder)
+
+
+    def write_base(self):
+        meta = dict(self.meta, generation=self.generation)
+        project, error = ProjectFile.create(os.path.join(self.folder, "base.ppp"), self.image, meta)
+        if project is None:
+            raise OSError(error)
+
+        # Old records belong to the old base
+        open(os.path.join(self.folder, "journal.bin"), "wb").close()
+
+
+    def append_record(self):
+        record = json.dumps({"generation": self.generation, "tiles": self.tiles, "meta": self.meta}).encode("utf-8")
+
+        with open(os.path.join(self.folder, "journal.bin"), "ab") as f:
+            f.write(RECORD_MAGIC + struct.pack("<II", len(record), len(self.payload)))
+            f.write(record)
+            f.write(self.payload)
+            f.write(RECORD_END)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+    def write_session(self):
+        path = os.path.join(self.folder, "session.json")
+        tmp = image_io.temp_path_for(path)
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(dict(self.session, saved=time.time()), f)
+        os.replace(tmp, path)
+
+
+'''
+Periodic checkpoints of a canvas.
+Only tiles changed since the last checkpoint are written, on a worker thread.
+A checkpoint is skipped (and retried shortly) while a stroke is being drawn or the previous one still runs.
+path_func: returns the file the canvas belongs to (stored so recovery can name it)
+'''
+class Autosave(QObject):
+
+    def __init__(self, canvas, path_func, parent=None):
+        super().__init__(parent)
+        self.canvas = canvas
+        self.path_func = path_func
+
+        self.folder = os.path.join(autosave_root(), uuid.uuid4().hex)
+        os.makedirs(self.folder, exist_ok=True)
+
+        # Held until the session ends, a leftover unlocked folder means a crash
+        self.lock = QLockFile(os.path.join(self.folder, "lock"))
+        self.lock.setStaleLockTime(0)
+        self.lock.tryLock(0)
+
+        self.task = None
+        self.generation = 0                     # Increased for each new base
+        self.base_size = None                   # (width, height) of the current base
+        self.journal_bytes = 0
+        self.last_meta = None
+        self.discarded = False
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.checkpoint)
+        self.timer.start(AUTOSAVE_INTERVAL_MS)
+
+
+    def checkpoint(self):
+        c = self.canvas
+
+        # Nothing loaded, or nothing edited yet (a preview can not have changes)
+        if c.image is None or c.image.isNull() or c.is_preview():
+            self.timer.start(AUTOSAVE_INTERVAL_MS)
+            return
+
+        # Never compete with a stroke or a running checkpoint
+        if self.task is not None or c.drawing:
+            self.timer.start(RETRY_MS)
+            return
+
+        meta = {
+            "orientation": [c.orientation.rotation, c.orientation.mirrored],
+            "selection": c.selection_state(),
+        }
+        session = {"path": self.path_func(), "width": c.image.width(), "height": c.image.height()}
+
+        size = (c.image.width(), c.image.height())
+        grid = c.dirty.channel(CHANNEL)
+        pixel_bytes = size[0] * size[1] * 4
+
+        # New base when the size changed, most tiles changed or the journal outgrew the image
+        if size != self.base_size or grid.mean() > 0.5 or self.journal_bytes > pixel_bytes:
+            c.dirty.clear(CHANNEL)
+            self.generation += 1
+            self.base_size = size
+            self.journal_bytes = 0
+            task = AutosaveTask(self.folder, session, meta, self.generation, image=QImage(c.picture()))
+
+        else:
+            tiles = c.dirty.take(CHANNEL)
+            if not tiles and meta == self.last_meta:
+                self.timer.start(AUTOSAVE_INTERVAL_MS)
+                return
+
+            # Copy only the changed tiles now, the canvas keeps its pixels to itself
+            view = image_io.qimage_const_view(c.picture())
+            payload = b"".join(view[y:y + h, x:x + w].tobytes() for x, y, w, h in tiles)
+            self.journal_bytes += len(payload)
+            task = AutosaveTask(self.folder, session, meta, self.generation, tiles=[list(t) for t in tiles], payload=payload)
+
+        task.signals.finished.connect(self.on_task_done)
+        task.signals.failed.connect(self.on_task_failed)
+        self.last_meta = meta
+        self.task = task
+        QThreadPool.globalInstance().start(task)
+
+
+    def on_task_done(self, folder):
+        if self.discarded:
+            return
+        self.task = None
+        self.timer.start(AUTOSAVE_INTERVAL_MS)
+
+
+    # Unknown what reached the disk, start over with a new base next time
+    def on_task_failed(self, folder, error):
+        self.base_size = None
+        self.on_task_done(folder)
+
+
+    # Session ended normally (document closed or clean exit): nothing to recover
+    def discard(self):
+        self.discarded = True
+        self.timer.stop()
+        self.lock.unlock()
+
+        if self.task is not None:
+            self.task.discard_session()
+            self.task = None
+        else:
+            discard_session(self.folder)
@@ -0,0 +1,176 @@
+
+import sys
+import time
+
+from lazy_imports import cv2, np
+
+
+# Pixels blended at once, keeps the temporaries of a tile in the CPU cache
+TILE_PIXELS = 1 << 14
+
+
+# ----- Blend modes ----- #
+# B(cb, cs): colour of the mode where both layers are opaque, for uint8 BGRA pixels of the backdrop
+# and the source (the alpha channel of the result is not used). Saturating OpenCV arithmetic throughout.
+
+def _multiply(cb, cs):
+    return cv2.multiply(cb, cs, scale=1.0 / 255.0)
+
+
+# 1 - (1 - cb)(1 - cs)
+def _screen(cb, cs):
+    return cv2.bitwise_not(cv2.multiply(cv2.bitwise_not(cb), cv2.bitwise_not(cs), scale=1.0 / 255.0))
+
+
+# Multiply where the backdrop is dark, screen where it is light: 2 cb cs, or 1 - 2 (1 - cb)(1 - cs)
+def _overlay(cb, cs):
+    out = cv2.multiply(cb, cs, scale=2.0 / 255.0)
+    light = cv2.bitwise_not(cv2.multiply(cv2.bitwise_not(cb), cv2.bitwise_not(cs), scale=2.0 / 255.0))
+    light_half = cv2.threshold(cb, 127, 255, cv2.THRESH_BINARY)[1]
+    return cv2.bitwise_or(cv2.bitwise_and(light, light_half), cv2.bitwise_and(out, cv2.bitwise_not(light_half)))
+
+
+def _darken(cb, cs):
+    return cv2.min(cb, cs)
+
+
+def _lighten(cb, cs):
+    return cv2.max(cb, cs)
+
+
+def _difference(cb, cs):
+    return cv2.absdiff(cb, cs)
+
+
+# Sum, clipped to white
+def _add(cb, cs):
+    return cv2.add(cb, cs)
+
+
+# Name -> blend function (None: normal, the source simply covers the backdrop)
+MODES = {
+    "normal": None,
+    "multiply": _multiply,
+    "screen": _screen,
+    "overlay": _overlay,
+    "darken": _darken,
+    "lighten": _lighten,
+    "difference": _difference,
+    "add": _add,
+}
+
+
+'''
+Blend src onto dst (uint8 BGRA, straight alpha like ARGB32 QImages) with a blend mode.
+src:      BGRA array of the same shape as dst, or one BGRA colour for all pixels
+opacity:  0..1, applied to the alpha of src
+coverage: optional source alpha per pixel with the shape dst.shape[:-1], uint8 (0..255) or float32 (0..1)
+out:      array the result is written to, may be dst itself (default: a new array)
+dst is (h, w, 4) (an image or a part of one) or (n, 4) (e.g. only the pixels picked by a mask).
+Colours are premultiplied by their alpha while they are combined (the W3C compositing formula),
+so translucent pixels blend without dark fringes, and divided back out for the straight result.
+Work is done in tiles; pixels stay uint8, only the alpha weights are float32.
+Tiles where src is fully transparent (or opaque in normal mode) are copied as they are. Returns out.
+'''
+def blend(dst, src, mode="normal", opacity=1.0, coverage=None, out=None):
+    if out is None:
+        out = np.empty_like(dst)
+    if dst.size == 0:
+        return out
+
+    func = MODES[mode]
+    src = np.asarray(src, dtype=np.uint8)
+    color = src.ndim == 1
+
+    # Rows of dst per tile
+    row = dst[0].size // 4 or 1
+    step = max(1, TILE_PIXELS // row)
+
+    for top in range(0, dst.shape[0], step):
+        rows = slice(top, top + step)
+        _blend_tile(dst[rows], src if color else src[rows], func, opacity,
+                    None if coverage is None else coverage[rows], out[rows])
+    return out
+
+
+def _blend_tile(dst, src, func, opacity, coverage, out):
+
+    # Nothing of src reaches this tile
+    if opacity <= 0 or (src.ndim > 1 and coverage is None and not src[..., 3].any()):
+        if out is not dst:
+            out[...] = dst
+        return
+
+    # An opaque layer in normal mode simply covers the backdrop
+    if func is None and src.ndim > 1 and coverage is None and opacity >= 1 and (src[..., 3] == 255).all():
+        out[...] = src
+        return
+
+    # OpenCV wants images: pixels (n, 4) become a column (n, 1, 4)
+    shape = dst.shape
+    if dst.ndim == 2:
+        dst = dst.reshape(-1, 1, 4)
+    cb = dst
+    if src.ndim == 1:
+        cs = np.empty_like(cb)
+        cs[...] = src
+    else:
+        cs = src.reshape(cb.shape)
+
+    # Source alpha of every pixel (0..1)
+    sa = np.multiply(cs[..., 3], np.float32(opacity / 255.0), dtype=np.float32)
+    if coverage is not None:
+        coverage = coverage.reshape(sa.shape)
+        sa *= coverage
+        if coverage.dtype == np.uint8:
+            sa *= np.float32(1.0 / 255.0)
+
+    # The result is the average of cb, cs and B(cb, cs) weighted by how much of each is seen:
+    # cb da (1 - sa), cs sa (1 - da) and B sa da; their sum is the new alpha
+    if (cb[..., 3] == 255).all():
+        # Opaque backdrop (e.g. above a background layer): stays opaque, only cb and B are seen
+        mixed = cs if func is None else func(cb, cs)
+        result = cv2.blendLinear(cb, mixed, 1 - sa, sa)
+        result[..., 3] = 255
+    else:
+        da = np.multiply(cb[..., 3], np.float32(1.0 / 255.0), dtype=np.float32)
+        keep = 1 - sa
+        keep *= da
+        if func is None:
+            mixed = cs
+        else:
+            both = sa * da
+            mixed = cv2.blendLinear(cs, func(cb, cs), sa - both, both)
+        result = cv2.blendLinear(cb, mixed, keep, sa)
+
+        keep += sa
+        keep *= 255
+        keep += 0.5
+        result[..., 3] = keep
+
+    out[...] = result.reshape(shape)
+
+
+# ----- Benchmark ----- #
+
+# python BlendModes.py [width] [height] [repeats]
+# Blends two random half transparent BGRA images with every mode and prints the time per mode
+if __name__ == "__main__":
+    w = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    h = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    rng = np.random.default_rng(0)
+    backdrop = rng.integers(0, 256, (h, w, 4), dtype=np.uint8)
+    layer = rng.integers(0, 256, (h, w, 4), dtype=np.uint8)
+    result = np.empty_like(backdrop)
+
+    print(f"{w}x{h}, best of {repeats}")
+    for name in MODES:
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            blend(backdrop, layer, name, 0.8, out=result)
+            times.append(time.perf_counter() - start)
+        best = min(times)
+        print(f"{name:>10}: {best * 1000:8.1f} ms  {w * h / best / 1e6:7.1f} MP/s")
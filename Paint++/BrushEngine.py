@@ -0,0 +1,458 @@
+
+import math
+
+from PyQt6.QtCore import Qt, QRect, QRectF, QPointF
+from PyQt6.QtGui import QImage, QPainter, QPen
+from PyQt6 import sip
+
+from lazy_imports import cv2, np
+import image_io
+import BlendModes
+
+
+# Sub pixel positions a tip is prepared for (per axis), stamps snap to the nearest one
+PHASES = 4
+
+# Default distance between stamps, as a fraction of the tip diameter
+SPACING = 0.15
+
+# Extra room added when a stroke layer has to grow, so it is not reallocated on every mouse move
+GROW = 128
+
+
+'''
+Brush tip: coverage mask (0..255) the stroke is stamped with.
+diameter: size in image pixels
+hardness: 0 = soft falloff from the centre, 1 = hard edge (antialiased over one pixel)
+shape:    None for a round tip, or a 2D array (0..1) for a custom tip, scaled to diameter
+Masks are made once per sub pixel phase and cached, stamping only combines them.
+'''
+class BrushTip:
+
+    def __init__(self, diameter, hardness=1.0, shape=None):
+        self.diameter = max(1, int(diameter))
+        self.hardness = min(1.0, max(0.0, float(hardness)))
+        self.shape = shape
+
+        self.size = self.diameter + 2                   # Mask edge, room for antialiasing and the sub pixel shift
+        self.masks = {}                                 # (phase x, phase y) -> uint8 mask
+
+
+    # Mask for a stamp whose centre lies (px, py) / PHASES right of / below a pixel corner
+    def mask(self, px, py):
+        key = (px, py)
+        if key not in self.masks:
+            if self.shape is None:
+                m = self.round_mask(px / PHASES, py / PHASES)
+            else:
+                m = self.custom_mask(px / PHASES, py / PHASES)
+
+            m = np.clip(m * 255.0 + 0.5, 0, 255).astype(np.uint8)
+            m.setflags(write=False)
+            self.masks[key] = m
+        return self.masks[key]
+
+
+    def round_mask(self, fx, fy):
+        n = self.size
+        r = self.diameter / 2
+
+        # Distance of every pixel centre to the stamp centre
+        d = np.arange(n, dtype=np.float32) + 0.5 - n // 2
+        dist = np.sqrt((d - fx)[None, :] ** 2 + (d - fy)[:, None] ** 2)
+
+        # Full alpha inside hardness * radius, smooth falloff (smoothstep) to the edge
+        falloff = max(r * (1.0 - self.hardness), 1.0)
+        t = np.clip((r - dist) / falloff, 0.0, 1.0)
+        return t * t * (3.0 - 2.0 * t)
+
+
+    def custom_mask(self, fx, fy):
+        n, d = self.size, self.diameter
+        tip = cv2.resize(np.asarray(self.shape, dtype=np.float32), (d, d), interpolation=cv2.INTER_AREA)
+
+        # Move the tip centre to where the round mask has its centre for this phase
+        shift = n // 2 - 0.5 - (d - 1) / 2
+        move = np.float32([[1, 0, shift + fx], [0, 1, shift + fy]])
+        return cv2.warpAffine(tip, move, (n, n), flags=cv2.INTER_LINEAR, borderValue=0.0)
+
+
+'''
+Floating buffer of one stroke (brush, spray or eraser), in image coordinates.
+Holds the coverage (0..255) of the bounding box drawn so far and grows with the stroke.
+The image is not touched until merge(), until then the canvas shows overlay on top of it.
+Coverage is combined with max(), so a stroke does not build up over itself and opacity applies once.
+color:   (b, g, r, a) 0..255, painted where the stroke covers
+opacity: 0..1 for the whole stroke
+erase:   clear alpha where the stroke covers instead of painting
+'''
+class StrokeLayer:
+
+    def __init__(self, image, color=(0, 0, 0, 255), opacity=1.0, erase=False):
+        self.image = image
+        self.color = tuple(int(c) for c in color)
+        self.opacity = opacity
+        self.erase = erase
+
+        self.rect = QRect()                             # Area the buffers cover (image coordinates)
+        self.coverage = None                            # (h, w) uint8
+        self.overlay = None                             # (h, w, 4) uint8 ARGB32 pixels the canvas draws
+        self.coverage_image = None                      # Alpha8 QImage on the coverage memory, for QPainter
+        self.overlay_image = None                       # ARGB32 QImage on the overlay memory
+
+        self.pen = None                                 # Pen for painter(), kept when the buffers grow
+        self._painter = None
+
+
+    # ---------- Buffers ---------- #
+
+    # Make sure the buffers cover rect (clipped to the image), growing them if needed
+    def ensure(self, rect):
+        bounds = QRect(0, 0, self.image.width(), self.image.height())
+        rect = rect.intersected(bounds)
+        if rect.isEmpty() or self.rect.contains(rect):
+            return
+
+        old = QRect(self.rect)
+        grown = rect.adjusted(-GROW, -GROW, GROW, GROW).intersected(bounds)
+        if not old.isEmpty():
+            grown = grown.united(old)
+
+        # The painter draws into the old memory
+        painting = self._painter is not None
+        self.end_painter()
+
+        w, h = grown.width(), grown.height()
+        stride = (w + 3) & ~3                           # QImage rows start on 4 byte boundaries
+        coverage = np.zeros((h, stride), dtype=np.uint8)
+        overlay = np.zeros((h, w, 4), dtype=np.uint8)
+
+        # Carry over what was drawn
+        if not old.isEmpty():
+            ox, oy = old.x() - grown.x(), old.y() - grown.y()
+            coverage[oy:oy + old.height(), ox:ox + old.width()] = self.coverage
+            overlay[oy:oy + old.height(), ox:ox + old.width()] = self.overlay
+
+        self.rect = grown
+        self.coverage_memory = coverage                 # Keeps the memory of the QImage wrappers alive
+        self.coverage = coverage[:, :w]
+        self.overlay = overlay
+        # Wrap the arrays without copying (a plain buffer would make the QImage read only, and QPainter would copy it)
+        self.coverage_image = QImage(sip.voidptr(coverage.ctypes.data), w, h, stride, QImage.Format.Format_Alpha8)
+        self.overlay_image = QImage(sip.voidptr(overlay.ctypes.data), w, h, w * 4, QImage.Format.Format_ARGB32)
+
+        # New parts of the overlay (bands above, below, left and right of the old area)
+        if old.isEmpty():
+            self.refresh(grown)
+        else:
+            self.refresh(QRect(grown.x(), grown.y(), w, old.y() - grown.y()))
+            self.refresh(QRect(grown.x(), old.bottom() + 1, w, grown.bottom() - old.bottom()))
+            self.refresh(QRect(grown.x(), old.y(), old.x() - grown.x(), old.height()))
+            self.refresh(QRect(old.right() + 1, old.y(), grown.right() - old.right(), old.height()))
+
+        if painting:
+            self.painter()
+
+
+    # Painter on the coverage buffer in image coordinates (eraser lines), reopened after the buffers grow
+    def painter(self):
+        if self._painter is None:
+            self._painter = QPainter(self.coverage_image)
+            self._painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+            self._painter.translate(-self.rect.x(), -self.rect.y())
+            if self.pen is not None:
+                self._painter.setPen(self.pen)
+        return self._painter
+
+
+    def end_painter(self):
+        if self._painter is not None:
+            self._painter.end()
+            self._painter = None
+
+
+    # Writable coverage of rect (image coordinates, must lie inside self.rect)
+    def coverage_at(self, rect):
+        x, y = rect.x() - self.rect.x(), rect.y() - self.rect.y()
+        return self.coverage[y:y + rect.height(), x:x + rect.width()]
+
+
+    # Bring the overlay up to date for rect after its coverage changed
+    def refresh(self, rect):
+        rect = rect.intersected(self.rect)
+        if rect.isEmpty():
+            return
+
+        cover = self.coverage_at(rect)
+        x, y = rect.x() - self.rect.x(), rect.y() - self.rect.y()
+        out = self.overlay[y:y + rect.height(), x:x + rect.width()]
+
+        if self.erase:
+            # The image with its alpha reduced where the eraser went
+            src = image_io.qimage_const_view(self.image)[rect.y():rect.y() + rect.height(), rect.x():rect.x() + rect.width()]
+            out[..., :3] = src[..., :3]
+            out[..., 3] = src[..., 3].astype(np.uint16) * (255 - cover) // 255
+        else:
+            # Stroke colour, alpha from coverage and opacity
+            out[..., :3] = self.color[:3]
+            out[..., 3] = cover * (self.opacity * self.color[3] / 255.0) + 0.5
+
+
+    # ---------- Merge ---------- #
+
+    # Apply the stroke to the image, returns the changed area (empty QRect if nothing was drawn).
+    # before_change: optional function called with that area just before it is written (e.g. to keep it for undo)
+    def merge(self, before_change=None):
+        self.end_painter()
+        if self.coverage is None or not self.coverage.any():
+            return QRect()
+
+        # Only the part the stroke covers
+        rows = np.flatnonzero(self.coverage.any(axis=1))
+        cols = np.flatnonzero(self.coverage.any(axis=0))
+        y1, y2, x1, x2 = int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+        cover = self.coverage[y1:y2, x1:x2]
+        x, y = self.rect.x() + x1, self.rect.y() + y1
+        if before_change is not None:
+            before_change(QRect(x, y, x2 - x1, y2 - y1))
+
+        if self.erase:
+            region = image_io.qimage_view(self.image)[y:y + (y2 - y1), x:x + (x2 - x1)]
+            region[..., 3] = region[..., 3].astype(np.uint16) * (255 - cover) // 255
+        else:
+            composite_over(self.image, x, y, cover * np.float32(self.opacity / 255.0), self.color)
+
+        return QRect(x, y, x2 - x1, y2 - y1)
+
+
+'''
+Brush stroke drawn into a StrokeLayer.
+The path is resampled at a fixed spacing (independent of how often the mouse reports),
+and the stamps of each segment are combined in one pass over their bounding box.
+Drawing methods return the changed area as a QRect (empty if nothing changed).
+'''
+class BrushStroke:
+
+    def __init__(self, layer, tip, spacing=SPACING):
+        self.layer = layer
+        self.tip = tip
+        self.step = max(0.5, spacing * tip.diameter)
+
+        self.last = None                                # Last point of the path
+        self.travelled = 0.0                            # Distance since the last stamp
+
+
+    # First point of the stroke: one stamp
+    def begin(self, x, y):
+        self.last = (x, y)
+        self.travelled = 0.0
+        return self.stamp([(x, y)])
+
+
+    # Continue the path to (x, y), stamping every step
+    def stroke_to(self, x, y):
+        if self.last is None:
+            return self.begin(x, y)
+
+        x0, y0 = self.last
+        length = math.hypot(x - x0, y - y0)
+        self.last = (x, y)
+        if length == 0:
+            return QRect()
+
+        # Distances along this segment where stamps fall
+        first = self.step - self.travelled
+        if first > length:
+            self.travelled += length
+            return QRect()
+
+        dists = np.arange(first, length + 1e-6, self.step)
+        self.travelled = length - dists[-1]
+
+        t = dists / length
+        return self.stamp(zip(x0 + (x - x0) * t, y0 + (y - y0) * t))
+
+
+    # Stamp the tip at the given centres (image coordinates)
+    def stamp(self, centres):
+        n = self.tip.size
+
+        # Integer corner and sub pixel phase of every stamp
+        stamps = []
+        for cx, cy in centres:
+            ix, px = divmod(round(cx * PHASES), PHASES)
+            iy, py = divmod(round(cy * PHASES), PHASES)
+            stamps.append((ix - n // 2, iy - n // 2, px, py))
+        if not stamps:
+            return QRect()
+
+        # Bounding box of the stamps, clipped to the image by the layer
+        box = QRect(min(s[0] for s in stamps), min(s[1] for s in stamps), 0, 0)
+        box.setRight(max(s[0] for s in stamps) + n - 1)
+        box.setBottom(max(s[1] for s in stamps) + n - 1)
+
+        layer = self.layer
+        layer.ensure(box)
+        box = box.intersected(layer.rect)
+        if box.isEmpty():
+            return QRect()
+
+        # Keep the strongest coverage of overlapping stamps
+        cover = layer.coverage_at(box)
+        bx1, by1, bx2, by2 = box.x(), box.y(), box.x() + box.width(), box.y() + box.height()
+        for x, y, px, py in stamps:
+            sx1, sy1 = max(x, bx1), max(y, by1)
+            sx2, sy2 = min(x + n, bx2), min(y + n, by2)
+            if sx2 <= sx1 or sy2 <= sy1:
+                continue
+
+            part = cover[sy1 - by1:sy2 - by1, sx1 - bx1:sx2 - bx1]
+            np.maximum(part, self.tip.mask(px, py)[sy1 - y:sy2 - y, sx1 - x:sx2 - x], out=part)
+
+        layer.refresh(box)
+        return box
+
+
+'''
+Paint a colour with coverage alpha (float32, 0..1) over the pixels of image at (x, y).
+Normal blend of BlendModes (straight alpha in the image, premultiplied while combined).
+color: (b, g, r, a) 0..255
+'''
+def composite_over(image, x, y, alpha, color):
+    bh, bw = alpha.shape
+    region = image_io.qimage_view(image)[y:y + bh, x:x + bw]
+    BlendModes.blend(region, color, coverage=alpha, out=region)
+
+
+# Same for pixels of any shape (..., 4) with a matching alpha (...), e.g. only the pixels picked by a mask. Returns new uint8 pixels
+def over(pixels, alpha, color):
+    return BlendModes.blend(pixels, color, coverage=alpha)
+
+
+'''
+Spray burst into a stroke layer: count dots with a normal distribution (sigma pixels) around (cx, cy).
+All offsets come from one NumPy batch and are written into the coverage directly,
+so thousands of dots per mouse event cost about as much as a hundred.
+dot: edge of a dot in pixels (the pen width)
+rng: numpy Generator
+Returns the changed area as a QRect (empty if all dots missed the image).
+'''
+def spray(layer, cx, cy, sigma, count, dot, rng):
+    image = layer.image
+
+    pts = rng.normal((cx, cy), sigma, size=(count, 2))
+    xs = np.floor(pts[:, 0]).astype(np.int32)
+    ys = np.floor(pts[:, 1]).astype(np.int32)
+
+    # Drop dots outside the image
+    inside = (xs >= 0) & (ys >= 0) & (xs < image.width()) & (ys < image.height())
+    xs, ys = xs[inside], ys[inside]
+    if xs.size == 0:
+        return QRect()
+
+    # Dots are squares of dot pixels, centred like QPainter points of that pen width
+    lo = dot // 2
+    x1, y1 = max(0, int(xs.min()) - lo), max(0, int(ys.min()) - lo)
+    x2 = min(image.width(), int(xs.max()) - lo + dot)
+    y2 = min(image.height(), int(ys.max()) - lo + dot)
+    box = QRect(x1, y1, x2 - x1, y2 - y1)
+
+    dots = np.zeros((y2 - y1, x2 - x1), dtype=np.uint8)
+    dots[ys - y1, xs - x1] = 255
+    if dot > 1:
+        kernel = np.ones((dot, dot), np.uint8)
+        dots = cv2.dilate(dots, kernel, anchor=(dot - 1 - lo, dot - 1 - lo))
+
+    layer.ensure(box)
+    cover = layer.coverage_at(box)
+    np.maximum(cover, dots, out=cover)
+
+    layer.refresh(box)
+    return box
+
+
+'''
+One stroke of the brush, spray or eraser on image, driven by points in image coordinates.
+Does not need the canvas, so recorded strokes can be replayed on any image (also on worker threads).
+settings: dict made by Img_Canvas.tool_settings(), spray strokes need a "seed"
+tip:      BrushTip to use instead of making one from the settings (the canvas keeps one cached)
+press() and move() return the changed area of the stroke layer, finish() merges it into the image.
+'''
+class ToolStroke:
+
+    def __init__(self, image, settings, tip=None):
+        self.tool = settings["tool"]
+        self.settings = settings
+        self.brush = None
+        self.rng = None
+        self.last = None
+        color = tuple(settings["color"])
+
+        if self.tool == "eraser":
+            self.layer = StrokeLayer(image, erase=True)
+
+            # Full coverage, correct size, rounded stroke
+            pen = QPen(Qt.GlobalColor.white)
+            pen.setWidth(settings["pen_width"])
+            pen.setCapStyle(Qt.PenCapStyle.RoundCap)
+            pen.setJoinStyle(Qt.PenJoinStyle.RoundJoin)
+            self.layer.pen = pen
+
+        elif self.tool == "brush":
+            self.layer = StrokeLayer(image, color, settings["opacity"])
+            if tip is None:
+                tip = BrushTip(settings["pen_width"], settings["hardness"], settings["shape"])
+            self.brush = BrushStroke(self.layer, tip, settings["spacing"])
+
+        else:
+            self.layer = StrokeLayer(image, color)
+            self.rng = np.random.default_rng(settings["seed"])      # Same seed, same dots
+
+
+    def press(self, x, y):
+        self.last = (x, y)
+        if self.brush is not None:
+            return self.brush.begin(x, y)
+        if self.rng is not None:
+            return self.spray_at(x, y)
+        return self.erase_line(x, y, x, y)
+
+
+    def move(self, x, y):
+        lx, ly = self.last
+        self.last = (x, y)
+        if self.brush is not None:
+            return self.brush.stroke_to(x, y)
+        if self.rng is not None:
+            return self.spray_at(x, y)
+        return self.erase_line(lx, ly, x, y)
+
+
+    # Merge into the image, returns the changed area (before_change as in StrokeLayer.merge)
+    def finish(self, before_change=None):
+        return self.layer.merge(before_change)
+
+
+    # Drop the stroke, the image was never touched
+    def cancel(self):
+        self.layer.end_painter()
+
+
+    def spray_at(self, x, y):
+        s = self.settings
+        return spray(self.layer, x, y, s["spray_size"], s["spray_density"], s["pen_width"], self.rng)
+
+
+    # Eraser line (or dab when both ends are the same)
+    def erase_line(self, x1, y1, x2, y2):
+        layer = self.layer
+        half = self.settings["pen_width"] / 2 + 2
+        rect = QRectF(QPointF(min(x1, x2) - half, min(y1, y2) - half), QPointF(max(x1, x2) + half, max(y1, y2) + half)).toAlignedRect()
+
+        layer.ensure(rect)
+        if x1 == x2 and y1 == y2:
+            layer.painter().drawPoint(QPointF(x1, y1))
+        else:
+            layer.painter().drawLine(QPointF(x1, y1), QPointF(x2, y2))
+        layer.refresh(rect)
+        return rect
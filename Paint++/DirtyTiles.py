@@ -0,0 +1,91 @@
+
+from lazy_imports import np
+
+
+# Tile edge in pixels
+TILE = 256
+
+
+'''
+Remembers which tiles of the canvas image changed.
+Every consumer (project save, autosave ...) has its own channel, so taking the
+changes for one of them does not hide them from the others.
+A channel that is used for the first time starts with everything dirty.
+'''
+class DirtyTiles:
+
+    def __init__(self, tile=TILE):
+        self.tile = tile
+        self.width = 0
+        self.height = 0
+        self.channels = {}                      # name -> bool array (tile rows, tile columns)
+
+
+    # Number of tile rows and columns
+    def grid_shape(self):
+        return -(-self.height // self.tile), -(-self.width // self.tile)
+
+
+    def channel(self, name):
+        if name not in self.channels:
+            self.channels[name] = np.ones(self.grid_shape(), dtype=bool)
+        return self.channels[name]
+
+
+    # New image: everything is dirty for every channel
+    def reset(self, width, height):
+        self.width = int(width)
+        self.height = int(height)
+        for name in self.channels:
+            self.channels[name] = np.ones(self.grid_shape(), dtype=bool)
+
+
+    # Same content at another resolution (preview -> full image): a channel stays clean only if it was clean
+    def resize(self, width, height):
+        dirty = {name: grid.any() for name, grid in self.channels.items()}
+
+        self.width = int(width)
+        self.height = int(height)
+        for name in self.channels:
+            self.channels[name] = np.full(self.grid_shape(), dirty[name], dtype=bool)
+
+
+    # Mark pixels x, y, w, h (image coordinates, clipped to the image) as changed
+    def mark_rect(self, x, y, w, h):
+
+        x1, y1 = max(0, int(x)), max(0, int(y))
+        x2, y2 = min(self.width, int(x + w)), min(self.height, int(y + h))
+        if x2 <= x1 or y2 <= y1:
+            return
+
+        t = self.tile
+        for grid in self.channels.values():
+            grid[y1 // t:(y2 - 1) // t + 1, x1 // t:(x2 - 1) // t + 1] = True
+
+
+    def mark_all(self):
+        for grid in self.channels.values():
+            grid[:] = True
+
+
+    def clear(self, name):
+        self.channel(name)[:] = False
+
+
+    def is_dirty(self, name) -> bool:
+        return bool(self.channel(name).any())
+
+
+    # Return the dirty tiles of a channel as (x, y, w, h) pixel rects and mark them clean
+    def take(self, name):
+
+        grid = self.channel(name)
+        t = self.tile
+
+        rects = []
+        for row, col in zip(*np.nonzero(grid)):
+            x, y = int(col) * t, int(row) * t
+            rects.append((x, y, min(t, self.width - x), min(t, self.height - y)))
+
+        grid[:] = False
+        return rects
@@ -0,0 +1,301 @@
+import os
+from collections import OrderedDict
+
+from PyQt6.QtCore import Qt, QPoint, QSize, QThreadPool
+from PyQt6.QtGui import QIcon, QPixmap
+from PyQt6.QtWidgets import (QScrollArea, QWidget, QVBoxLayout, QHBoxLayout, QListWidget, QListWidgetItem,
+                             QListView, QCheckBox, QProgressDialog, QMessageBox)
+
+from img_canvas import Img_Canvas
+from image_menu_functions import imf
+from Filters import Filters
+import Autosave
+import FrameSequence
+
+
+# Frame strip thumbnails kept as icons, the ones furthest from view are dropped first
+THUMBNAILS_KEPT = 200
+
+
+'''
+One open image (a tab in the main window).
+Everything that belongs to a single image lives here: canvas, undo history, file path
+and its background loads/saves. Modules, menus and the worker pool are shared by all documents.
+'''
+class Document:
+
+    def __init__(self):
+
+        self.canvas = Img_Canvas(imf)                               # Creates an instance of the canvas class
+        self.scroll = QScrollArea()                                 # Creates a scroll area
+
+        self.imf = imf(self.canvas)
+        self.filters = Filters(self.canvas, self.imf)
+        self.filters.on_applied = self.filter_applied
+        self.undo_history = []                                      # List to store previous image states for undo function
+
+        self.scroll.setWidget(self.canvas)                          # Puts the canvas inside the scroll area
+        self.scroll.setWidgetResizable(False)
+        self.scroll.setAlignment(Qt.AlignmentFlag.AlignCenter)
+
+        self.current_path = None                                    # Tracks current file path
+        self.project = None                                         # ProjectFile the canvas was last opened from / saved to
+        self.recovered = False                                      # Restored from a crashed session, not saved yet
+
+        # Background image loading
+        self.load_task = None
+        self.load_preview_loader = None
+        self.load_previous = None
+
+        # Background saving
+        self.save_task = None
+        self.pending_save = None
+
+        # Periodic checkpoints of changed tiles for crash recovery
+        self.autosave = Autosave.Autosave(self.canvas, lambda: self.current_path, self.scroll)
+
+        # Multi-page / animated images: the canvas shows one frame of the sequence
+        self.frames = None
+        self.frame_index = 0
+        self.batch = None
+        self.thumb_task = None
+        self.thumbs = OrderedDict()                                 # Frames with a thumbnail icon, oldest first
+        self.thumbs_requested = set()
+
+        # Tab widget: canvas with the frame strip below it
+        self.widget = QWidget()
+        layout = QVBoxLayout(self.widget)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.setSpacing(0)
+        layout.addWidget(self.scroll, 1)
+
+        self.frame_bar = QWidget()
+        bar_layout = QHBoxLayout(self.frame_bar)
+        bar_layout.setContentsMargins(4, 2, 4, 2)
+
+        self.batch_frames = QCheckBox("Filters apply to\nall frames")
+        bar_layout.addWidget(self.batch_frames)
+
+        side = FrameSequence.THUMBNAIL_SIDE
+        self.strip = QListWidget()
+        self.strip.setViewMode(QListView.ViewMode.IconMode)
+        self.strip.setFlow(QListView.Flow.LeftToRight)
+        self.strip.setWrapping(False)
+        self.strip.setMovement(QListView.Movement.Static)
+        self.strip.setUniformItemSizes(True)
+        self.strip.setIconSize(QSize(side, side))
+        self.strip.setFixedHeight(side + 48)
+        self.strip.currentRowChanged.connect(self.show_frame)
+        self.strip.horizontalScrollBar().valueChanged.connect(self.request_thumbnails)
+        bar_layout.addWidget(self.strip, 1)
+
+        layout.addWidget(self.frame_bar)
+        self.frame_bar.hide()
+
+
+    # Name shown on the tab
+    def name(self):
+        name = os.path.basename(self.current_path) if self.current_path else "Untitled"
+        return f"{name} (recovered)" if self.recovered else name
+
+
+    # Nothing loaded and nothing on the way, a new image can go here instead of a new tab
+    def is_empty(self):
+        return (self.canvas.image is None or self.canvas.image.isNull()) and self.load_task is None
+
+
+    # Closed: stop background work that belongs only to this document
+    def close(self):
+        if self.load_task is not None:
+            self.load_task.cancel()
+            self.load_task = None
+        self.set_frames(None, 1)
+        self.autosave.discard()
+
+
+    # ---------- Frames ---------- #
+
+    def is_multi_frame(self):
+        return self.frames is not None
+
+
+    '''
+    The canvas holds frame 0 of path, which has count frames.
+    Other frames are decoded when they are shown or a filter runs on them.
+    count 1 (or path None) drops the frames of the previous image.
+    '''
+    def set_frames(self, path, count):
+
+        if self.batch is not None:
+            self.batch.cancel()
+            self.batch = None
+        self.cancel_thumbnails()
+        if self.frames is not None:
+            self.frames.close()
+
+        self.frames = None
+        self.frame_index = 0
+        self.thumbs.clear()
+        self.strip.blockSignals(True)
+        self.strip.clear()
+        self.strip.blockSignals(False)
+
+        if path is None or count <= 1:
+            self.frame_bar.hide()
+            return
+
+        self.frames = FrameSequence.FrameSequence(path, count)
+        self.canvas.dirty.clear("frame")                            # Canvas matches frame 0 of the file
+
+        side = FrameSequence.THUMBNAIL_SIDE
+        blank = QPixmap(side, side)
+        blank.fill(Qt.GlobalColor.transparent)
+        self.blank_icon = QIcon(blank)
+
+        self.strip.blockSignals(True)
+        for i in range(count):
+            self.strip.addItem(QListWidgetItem(self.blank_icon, str(i + 1)))
+        self.strip.setCurrentRow(0)
+        self.strip.blockSignals(False)
+
+        self.frame_bar.show()
+        self.request_thumbnails()
+
+
+    # Switch the canvas to another frame, edits of the current one are kept in the sequence
+    def show_frame(self, index):
+        if self.frames is None or index == self.frame_index or index < 0:
+            return
+
+        img = self.frames.frame(index)
+        if img is None:
+            QMessageBox.warning(self.widget, "Frames", f"Frame {index + 1} could not be decoded.")
+            self.strip.blockSignals(True)
+            self.strip.setCurrentRow(self.frame_index)
+            self.strip.blockSignals(False)
+            return
+
+        self.store_current_frame()
+
+        # Same view for the new frame
+        zoom, offset = self.canvas.zoom_scale, self.canvas.offset
+        self.canvas.set_qimage(img)
+        self.canvas.zoom_scale, self.canvas.offset = zoom, offset
+        self.canvas.update_minimum_size()
+        self.canvas.dirty.clear("frame")
+        self.frame_index = index
+
+        # Undo works per frame
+        self.undo_history.clear()
+        self.undo_history.append(self.canvas.snapshot())
+
+
+    # Put the canvas pixels back into the sequence if they were edited
+    def store_current_frame(self):
+        c = self.canvas
+        if c.image is None or (not c.dirty.is_dirty("frame") and c.orientation.is_identity()):
+            return
+
+        self.frames.set_frame(self.frame_index, c.oriented_image())
+        self.invalidate_thumbnail(self.frame_index)
+
+
+    # ---------- Filters on all frames ---------- #
+
+    # A filter ran on the canvas: repeat it on the other frames when that is switched on
+    def filter_applied(self, operation):
+        if self.frames is None or not self.batch_frames.isChecked() or self.batch is not None:
+            return
+
+        # Same selection on every frame
+        sel = self.canvas.sel_mgr
+        if sel.state.frozen and sel.is_ready():
+            op = lambda bgr: sel.apply_in_selection(bgr, operation)
+        else:
+            op = operation
+
+        others = [i for i in range(self.frames.count) if i != self.frame_index]
+
+        progress = QProgressDialog("Applying filter to all frames ...", "Cancel", 0, len(others), self.widget)
+        progress.setWindowModality(Qt.WindowModality.ApplicationModal)
+        progress.setMinimumDuration(300)
+
+        self.batch = FrameSequence.FrameBatch(self.frames, others, op)
+        self.batch.progress.connect(progress.setValue)
+        self.batch.frame_done.connect(self.invalidate_thumbnail)
+        self.batch.finished.connect(lambda done, errors: self.batch_finished(progress, errors))
+        progress.canceled.connect(self.batch.cancel)
+        self.batch.start()
+
+
+    def batch_finished(self, progress, errors):
+        self.batch = None
+        progress.close()
+        self.request_thumbnails()
+
+        if errors:
+            QMessageBox.warning(self.widget, "Filter", "Some frames were not changed:\n\n" + "\n".join(errors[:10]))
+
+
+    # ---------- Frame strip thumbnails ---------- #
+
+    # Frames whose items are in view of the strip
+    def visible_frames(self):
+        if self.strip.count() == 0:
+            return range(0)
+
+        y = self.strip.viewport().height() // 2
+        first = self.strip.indexAt(QPoint(1, y)).row()
+        last = self.strip.indexAt(QPoint(self.strip.viewport().width() - 2, y)).row()
+        first = max(first, 0)
+        last = self.strip.count() - 1 if last < 0 else last
+        return range(first, last + 1)
+
+
+    # Decode thumbnails of the frames in view that do not have one yet
+    def request_thumbnails(self, *args):
+        if self.frames is None:
+            return
+
+        missing = [i for i in self.visible_frames() if i not in self.thumbs and i not in self.thumbs_requested]
+        if not missing:
+            return
+
+        # Frames that scrolled out of view are not needed anymore
+        self.cancel_thumbnails()
+
+        task = FrameSequence.ThumbnailTask(self.frames, missing)
+        task.signals.done.connect(lambda index, img, task=task: self.on_thumbnail(task, index, img))
+        self.thumb_task = task
+        self.thumbs_requested.update(missing)
+        QThreadPool.globalInstance().start(task)
+
+
+    def cancel_thumbnails(self):
+        if self.thumb_task is not None:
+            self.thumb_task.cancel()
+            self.thumb_task = None
+        self.thumbs_requested.clear()
+
+
+    def on_thumbnail(self, task, index, img):
+        if task is not self.thumb_task or self.frames is None:
+            return
+
+        self.thumbs_requested.discard(index)
+        self.strip.item(index).setIcon(QIcon(QPixmap.fromImage(img)))
+        self.thumbs[index] = True
+
+        # Bounded number of icons, long sequences scroll through thousands of frames
+        visible = self.visible_frames()
+        for old in list(self.thumbs):
+            if len(self.thumbs) <= THUMBNAILS_KEPT:
+                break
+            if old not in visible:
+                del self.thumbs[old]
+                self.strip.item(old).setIcon(self.blank_icon)
+
+
+    # Frame got new pixels: its thumbnail is decoded again when it is in view
+    def invalidate_thumbnail(self, index):
+        self.thumbs.pop(index, None)
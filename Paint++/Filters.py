@@ -1,7 +1,7 @@
 
-import cv2
-import numpy as np
+from lazy_imports import cv2, np
 from PyQt6.QtWidgets import QInputDialog, QMessageBox
+from ToneLUT import ToneLUT
 
 
 # ----- Image filtering tool: Gaussian blur, Sobel, binary threshold, histogram equalization
@@ -13,6 +13,9 @@ class Filters:
         self.canvas = canvas
         self.imf = image_functions
 
+        # Called with the operation after it was applied to the canvas (multi-frame documents repeat it on the other frames)
+        self.on_applied = None
+
 
     # Show warning if no image
     def warning(self, pix):
@@ -21,6 +24,16 @@ class Filters:
             return True
         return False
 
+    # Run an operation (BGR array -> BGR array) on the canvas, inside the frozen selection if there is one
+    def apply(self, operation):
+        result_pixmap = self.imf.apply_operation_with_selection(operation)
+        if not result_pixmap:
+            return
+
+        self.canvas.set_image(result_pixmap)
+        if self.on_applied is not None:
+            self.on_applied(operation)
+
     def normalize_to_bgr_uint8(self, src_bgr, out):
 
         # Handle empty output
@@ -66,6 +79,24 @@ class Filters:
         if self.warning(pix):
             return
 
+        # Ask user which blur mode to use
+        modes = ["Exact (kernel size)", "Fast (large radius)"]
+        mode, ok = QInputDialog.getItem(
+            None,
+            "Gaussian Blur",
+            "Select blur mode",
+            modes,
+            0,
+            False
+        )
+
+        if not ok:
+            return
+
+        # Large radius blur has its own dialog
+        if mode == "Fast (large radius)":
+            self.fast_gaussian_blur()
+            return
 
         # Get Kernel size from user
         kernel_size,  ok = QInputDialog.getInt(
@@ -91,10 +122,62 @@ class Filters:
             out = cv2.GaussianBlur(bgr, (kernel_size, kernel_size), 0)
             return self.normalize_to_bgr_uint8(bgr, out)
 
-        result_pixmap = self.imf.apply_operation_with_selection(blur_operation)
+        self.apply(blur_operation)
 
-        if result_pixmap:
-            self.canvas.set_image(result_pixmap)
+
+    # ----- Fast Gaussian blur (large radius) ----- #
+    def fast_gaussian_blur(self):
+
+        # Get blur radius from user
+        radius, ok = QInputDialog.getInt(
+            None,
+            "Gaussian Blur",
+            "Enter blur radius in pixels",
+            50,                                 # default
+            1,                                  # minimum
+            1000                                # maximum
+        )
+
+        if not ok:
+            return
+
+        # Same radius -> sigma relation as OpenCV uses for a (2r+1) kernel
+        sigma = 0.3 * (radius - 1) + 0.8
+
+        def fast_blur_operation(bgr):
+            out = self.box_blur_approx(bgr, sigma)
+            return self.normalize_to_bgr_uint8(bgr, out)
+
+        self.apply(fast_blur_operation)
+
+
+    # Box widths whose passes together have the same variance as a Gaussian with sigma
+    @staticmethod
+    def box_sizes_for_gauss(sigma, passes=3):
+
+        # Ideal box width, rounded down to an odd number
+        w_ideal = np.sqrt(12 * sigma * sigma / passes + 1)
+        w_low = int(np.floor(w_ideal))
+        if w_low % 2 == 0:
+            w_low -= 1
+        w_up = w_low + 2
+
+        # Number of passes that use the smaller box
+        m = round((12 * sigma * sigma - passes * w_low * w_low - 4 * passes * w_low - 3 * passes) / (-4 * w_low - 4))
+
+        return [w_low if i < m else w_up for i in range(passes)]
+
+
+    # Approximate Gaussian blur with three box filters.
+    # cv2.blur uses running sums, so the cost per pixel does not depend on the radius
+    @staticmethod
+    def box_blur_approx(bgr, sigma):
+
+        out = bgr
+        for size in Filters.box_sizes_for_gauss(sigma):
+            if size > 1:
+                out = cv2.blur(out, (size, size))
+        return out
 
 
     # ----- Sobel Filter ----- #
@@ -119,6 +202,25 @@ class Filters:
         if not ok:
             return
 
+        # Ask user for kernel size, Scharr is a more accurate 3x3 kernel
+        kernels = ["3", "5", "7", "Scharr (3x3)"]
+        kernel, ok = QInputDialog.getItem(
+            None,
+            "Sobel Filter",
+            "Select kernel size",
+            kernels,
+            0,
+            False
+        )
+
+        if not ok:
+            return
+
+        ksize = cv2.FILTER_SCHARR if kernel.startswith("Scharr") else int(kernel)
+
+        # 16-bit output is enough for 3x3, 5x5 and Scharr, 7x7 can overflow so use float32
+        depth = cv2.CV_32F if ksize == 7 else cv2.CV_16S
+
 
         def sobel_operation(bgr):
 
@@ -127,29 +229,26 @@ class Filters:
 
             # Detect vertical edges
             if direction == "X-direction":
-                sobel = cv2.Sobel(gray, cv2.CV_64F, 1,0,  ksize=3)     # Detect vertical edges
+                sobel = cv2.Sobel(gray, depth, 1, 0, ksize=ksize)      # Detect vertical edges
 
             # Detect horizontal edges
             elif direction == "Y-direction":
-                sobel = cv2.Sobel(gray, cv2.CV_64F, 0,1, ksize=3)   #Detect horizontal edges
+                sobel = cv2.Sobel(gray, depth, 0, 1, ksize=ksize)      # Detect horizontal edges
 
             else:
-                # Detect edges in both direction
-                sobel_x = cv2.Sobel(gray, cv2.CV_64F, 1, 0, ksize=3)
-                sobel_y = cv2.Sobel(gray, cv2.CV_64F, 0, 1, ksize=3)
-                sobel = cv2.magnitude(sobel_x, sobel_y)
+                # Detect edges in both direction, magnitude is written over sobel_x
+                sobel_x = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=ksize)
+                sobel_y = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=ksize)
+                sobel = cv2.magnitude(sobel_x, sobel_y, sobel_x)
 
-            # Convert back to uint8
-            sobel = np.absolute(sobel)
-            sobel = np.uint8(np.clip(sobel, 0, 255))
+            # Absolute value and saturation to uint8 in one pass
+            sobel = cv2.convertScaleAbs(sobel)
 
             # Convert back to BGR for display
             sobel_bgr = cv2.cvtColor(sobel, cv2.COLOR_GRAY2BGR)
             return self.normalize_to_bgr_uint8(bgr, sobel_bgr)
 
-        result_pixmap = self.imf.apply_operation_with_selection(sobel_operation)
-        if result_pixmap:
-            self.canvas.set_image(result_pixmap)
+        self.apply(sobel_operation)
 
 
     # ----- Binary Treshhold ----- #
@@ -184,9 +283,7 @@ class Filters:
             binary_bgr = cv2.cvtColor(binary, cv2.COLOR_GRAY2BGR)
             return self.normalize_to_bgr_uint8(bgr, binary_bgr)
 
-        result_pixmap = self.imf.apply_operation_with_selection(treshold_operation)
-        if result_pixmap:
-            self.canvas.set_image(result_pixmap)
+        self.apply(treshold_operation)
 
 
     # -----  Adaptive Threshold ----- #
@@ -234,9 +331,7 @@ class Filters:
             adaptive_bgr = cv2.cvtColor(adaptive, cv2.COLOR_GRAY2BGR)
             return self.normalize_to_bgr_uint8(bgr, adaptive_bgr)
 
-        result_pixmap = self.imf.apply_operation_with_selection(adaptive_threshold_operation)
-        if result_pixmap:
-            self.canvas.set_image(result_pixmap)
+        self.apply(adaptive_threshold_operation)
 
 
     def histogram_operation(self):
@@ -246,26 +341,221 @@ class Filters:
         if self.warning(pix):
             return
 
+        # Ask user for global or tiled (CLAHE) equalization
+        modes = ["Global", "CLAHE (tiled)"]
+        mode, ok = QInputDialog.getItem(
+            None,
+            "Histogram Equalization",
+            "Select equalization method",
+            modes,
+            0,
+            False
+        )
+
+        if not ok:
+            return
+
+        clahe_params = None
+        if mode == "CLAHE (tiled)":
+
+            # Ask user for tile grid size
+            tiles, ok = QInputDialog.getInt(
+                None,
+                "CLAHE",
+                "Enter tile grid size (tiles per side)",
+                8,      # default
+                1,      # minimum
+                64      # maximum
+            )
+
+            if not ok:
+                return
+
+            # Ask user for contrast limit
+            clip_limit, ok = QInputDialog.getDouble(
+                None,
+                "CLAHE",
+                "Enter clip limit (higher = more contrast)",
+                2.0,    # default
+                0.1,    # minimum
+                40.0,   # maximum
+                1       # decimals
+            )
+
+            if not ok:
+                return
+
+            clahe_params = (clip_limit, tiles)
+
         def histogram_operation(bgr):
 
             # Convert BGR to YCrCb color space
             ycrcb = cv2.cvtColor(bgr, cv2.COLOR_BGR2YCrCb)
 
-            # Split the channels
-            y, cr, cb = cv2.split(ycrcb)
+            # Take out the Y channel (luminance) only
+            y = cv2.extractChannel(ycrcb, 0)
 
-            # Apply histogram equlization to Y channal (luminance)
-            y_eq = cv2.equalizeHist(y)
+            # Apply histogram equlization to Y channal, globally or per tile
+            # (a CLAHE object per call, the operation can run on several frames at once)
+            if clahe_params is not None:
+                clip_limit, tiles = clahe_params
+                y_eq = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=(tiles, tiles)).apply(y)
+            else:
+                y_eq = cv2.equalizeHist(y)
 
-            # Merge channels back
-            ycrcb_eq = cv2.merge([y_eq, cr, cb])
+            # Put Y back in place
+            cv2.insertChannel(y_eq, ycrcb, 0)
 
-            bgr_eq = cv2.cvtColor(ycrcb_eq, cv2.COLOR_YCrCb2BGR)
+            bgr_eq = cv2.cvtColor(ycrcb, cv2.COLOR_YCrCb2BGR)
             return self.normalize_to_bgr_uint8(bgr, bgr_eq)
 
-        result_pixmap = self.imf.apply_operation_with_selection(histogram_operation)
-        if result_pixmap:
-            self.canvas.set_image(result_pixmap)
+        self.apply(histogram_operation)
+
+
+    # ----- Tone adjustments (lookup tables) ----- #
+
+    # Apply one or more lookup tables, composed into one table before touching pixels
+    def apply_lut(self, *luts):
+
+        lut = ToneLUT.compose(*luts)
+
+        def lut_operation(bgr):
+            return ToneLUT.apply(bgr, lut)
+
+        self.apply(lut_operation)
+
+
+    # Ask user for brightness and contrast, returns a lookup table or None
+    def ask_brightness_contrast(self):
+
+        brightness, ok = QInputDialog.getInt(
+            None,
+            "Brightness / Contrast",
+            "Enter brightness (-100 to 100)",
+            0,      # default
+            -100,   # minimum
+            100     # maximum
+        )
+
+        if not ok:
+            return None
+
+        contrast, ok = QInputDialog.getInt(
+            None,
+            "Brightness / Contrast",
+            "Enter contrast (-100 to 100)",
+            0,      # default
+            -100,   # minimum
+            100     # maximum
+        )
+
+        if not ok:
+            return None
+
+        return ToneLUT.brightness_contrast(brightness, contrast)
+
+
+    # Ask user for gamma, returns a lookup table or None
+    def ask_gamma(self):
+
+        gamma, ok = QInputDialog.getDouble(
+            None,
+            "Gamma",
+            "Enter gamma (1.0 = unchanged)",
+            1.0,    # default
+            0.1,    # minimum
+            10.0,   # maximum
+            2       # decimals
+        )
+
+        if not ok:
+            return None
+
+        return ToneLUT.gamma(gamma)
+
+
+    def brightness_contrast(self):
+        pix = self.canvas.pixmap()
+        if self.warning(pix):
+            return
+
+        lut = self.ask_brightness_contrast()
+        if lut is not None:
+            self.apply_lut(lut)
+
+
+    def gamma_correction(self):
+        pix = self.canvas.pixmap()
+        if self.warning(pix):
+            return
+
+        lut = self.ask_gamma()
+        if lut is not None:
+            self.apply_lut(lut)
+
+
+    def levels(self):
+        pix = self.canvas.pixmap()
+        if self.warning(pix):
+            return
+
+        # Ask user for input black and white points
+        in_black, ok = QInputDialog.getInt(None, "Levels", "Enter input black point (0-254)", 0, 0, 254)
+        if not ok:
+            return
+
+        in_white, ok = QInputDialog.getInt(None, "Levels", "Enter input white point", 255, in_black + 1, 255)
+        if not ok:
+            return
+
+        # Midtone gamma
+        gamma, ok = QInputDialog.getDouble(None, "Levels", "Enter midtone gamma (1.0 = unchanged)", 1.0, 0.1, 10.0, 2)
+        if not ok:
+            return
+
+        self.apply_lut(ToneLUT.levels(in_black, in_white, gamma))
+
+
+    def curves(self):
+        pix = self.canvas.pixmap()
+        if self.warning(pix):
+            return
+
+        # Control points as "in:out" pairs
+        text, ok = QInputDialog.getText(
+            None,
+            "Curves",
+            "Enter points as in:out separated by spaces (e.g. 0:0 64:48 192:210 255:255)",
+            text="0:0 64:48 192:210 255:255"
+        )
+
+        if not ok or not text.strip():
+            return
+
+        try:
+            points = [tuple(int(v) for v in pair.split(":")) for pair in text.split()]
+        except ValueError:
+            QMessageBox.warning(self.canvas, "Curves", "Points must be written as in:out, for example 64:48")
+            return
+
+        self.apply_lut(ToneLUT.curves(points))
+
+
+    # Brightness/contrast followed by gamma, applied as one lookup table
+    def tone_adjust(self):
+        pix = self.canvas.pixmap()
+        if self.warning(pix):
+            return
+
+        bc_lut = self.ask_brightness_contrast()
+        if bc_lut is None:
+            return
+
+        gamma_lut = self.ask_gamma()
+        if gamma_lut is None:
+            return
+
+        self.apply_lut(bc_lut, gamma_lut)
 
 
     def median_blur(self):
@@ -295,9 +585,7 @@ class Filters:
             out = cv2.medianBlur(bgr, kernel_size)
             return self.normalize_to_bgr_uint8(bgr, out)
 
-        result_pixmap = self.imf.apply_operation_with_selection(median_operation)
-        if result_pixmap:
-            self.canvas.set_image(result_pixmap)
+        self.apply(median_operation)
 
     def bilateral_filter(self):
         pix = self.canvas.pixmap()
@@ -325,9 +613,7 @@ class Filters:
             out = cv2.bilateralFilter(src, diameter, 75, 75)
             return self.normalize_to_bgr_uint8(bgr, out)
 
-        result_pixmap = self.imf.apply_operation_with_selection(bilateral_operation)
-        if result_pixmap:
-            self.canvas.set_image(result_pixmap)
+        self.apply(bilateral_operation)
 
 
 
@@ -373,9 +659,7 @@ class Filters:
             edges_bgr = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
             return self.normalize_to_bgr_uint8(bgr, edges_bgr)
 
-        result_pixmap = self.imf.apply_operation_with_selection(canny_operation)
-        if result_pixmap:
-            self.canvas.set_image(result_pixmap)
+        self.apply(canny_operation)
 
     def grayscale(self):
         pix = self.canvas.pixmap()
@@ -390,9 +674,7 @@ class Filters:
             gray_bgr = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
             return self.normalize_to_bgr_uint8(bgr, gray_bgr)
 
-        result_pixmap = self.imf.apply_operation_with_selection(grayscale_operation)
-        if result_pixmap:
-            self.canvas.set_image(result_pixmap)
+        self.apply(grayscale_operation)
 
 
 
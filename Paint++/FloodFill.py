@@ -0,0 +1,112 @@
+
+from PyQt6.QtCore import QRect
+
+from lazy_imports import cv2, np
+import image_io
+import BrushEngine
+
+
+# Rows blended at once, keeps the temporaries of very large fills small
+BAND_ROWS = 256
+
+
+'''
+Pixels a bucket fill from (x, y) reaches.
+pixels:     BGRA array of the image
+tolerance:  0..255, largest difference per channel (B, G, R and A) to the clicked pixel
+contiguous: only pixels connected to (x, y) (4 neighbours), otherwise every similar pixel in the image
+selection:  optional mask (0 = outside), nothing outside it is filled
+The similar pixels are found in one cv2.inRange pass and the connected ones with cv2.floodFill
+(a scanline fill with its own stack), so there is no recursion and no Python loop over pixels.
+Returns (0/255 mask (h, w), bounding QRect), or (None, empty QRect) if nothing would be filled.
+'''
+def fill_region(pixels, x, y, tolerance, contiguous=True, selection=None):
+    h, w = pixels.shape[:2]
+
+    seed = pixels[y, x].astype(np.int32)
+    lower = tuple(int(v) for v in np.clip(seed - tolerance, 0, 255))
+    upper = tuple(int(v) for v in np.clip(seed + tolerance, 0, 255))
+    similar = cv2.inRange(pixels, lower, upper)
+
+    # Nothing outside the selection (in place, feathered selections count wherever they are above 0)
+    if selection is not None:
+        cv2.bitwise_and(similar, selection, dst=similar)
+        cv2.threshold(similar, 0, 255, cv2.THRESH_BINARY, dst=similar)
+    if not similar[y, x]:
+        return None, QRect()
+
+    if contiguous:
+        # Mask only: the image is not changed, the reached pixels are set to 255 in the (1 pixel larger) mask
+        mask = np.zeros((h + 2, w + 2), np.uint8)
+        _, _, _, rect = cv2.floodFill(similar, mask, (x, y), 0, 0, 0, 4 | cv2.FLOODFILL_MASK_ONLY | (255 << 8))
+        return mask[1:-1, 1:-1], QRect(*rect)
+
+    return similar, QRect(*cv2.boundingRect(similar))
+
+
+'''
+Paint bucket: fill the area around (x, y) of image (ARGB32 QImage) with color.
+color:     (b, g, r, a) 0..255
+antialias: soften the edge of the filled area over about one pixel
+selection: optional mask, feathered (soft) selections fade the fill out towards their edge
+before_change: optional function called with the area to be changed just before it is written
+Returns the changed area as a QRect (empty if nothing was filled).
+'''
+def bucket_fill(image, x, y, color, tolerance=32, contiguous=True, antialias=False, selection=None, before_change=None):
+    w, h = image.width(), image.height()
+    if not (0 <= x < w and 0 <= y < h):
+        return QRect()
+
+    # Nothing outside the selection can change, so only its bounding box is searched
+    area = QRect(0, 0, w, h)
+    if selection is not None:
+        area = QRect(*cv2.boundingRect(selection))
+        if not area.contains(x, y):
+            return QRect()
+        selection = selection[area.y():area.bottom() + 1, area.x():area.right() + 1]
+
+    pixels = image_io.qimage_view(image)[area.y():area.bottom() + 1, area.x():area.right() + 1]
+    region, rect = fill_region(pixels, x - area.x(), y - area.y(), tolerance, contiguous, selection)
+    if region is None:
+        return QRect()
+
+    # The softened edge reaches one pixel further out
+    if antialias:
+        rect = rect.adjusted(-1, -1, 1, 1).intersected(QRect(0, 0, area.width(), area.height()))
+
+    x0, y0, bw, bh = rect.x(), rect.y(), rect.width(), rect.height()
+    if before_change is not None:
+        before_change(rect.translated(area.topLeft()))
+    cover = region[y0:y0 + bh, x0:x0 + bw]
+    if antialias:
+        cover = cv2.GaussianBlur(cover, (3, 3), 0)
+    if selection is not None:
+        cover = cv2.multiply(cover, selection[y0:y0 + bh, x0:x0 + bw], scale=1.0 / 255.0)
+
+    color = np.asarray(color, dtype=np.uint8)
+    packed = color.view(np.uint32)[0]
+    opaque = color[3] == 255
+
+    for top in range(0, bh, BAND_ROWS):
+        band_cover = cover[top:top + BAND_ROWS]
+        band = pixels[y0 + top:y0 + top + band_cover.shape[0], x0:x0 + bw]
+
+        # Fully covered pixels of an opaque colour are simply replaced (one 32 bit write per pixel)
+        if opaque:
+            full = band_cover == 255
+            np.copyto(band.view(np.uint32)[..., 0], packed, where=full)
+            part = (band_cover > 0) & ~full
+        else:
+            part = band_cover > 0
+
+        # Edge pixels (and everything for a translucent colour) are blended
+        if part.any():
+            band[part] = BrushEngine.over(band[part], band_cover[part] * np.float32(1.0 / 255.0), color)
+
+    return rect.translated(area.topLeft())
+
+
+# Bucket fill with the paint bucket settings of Img_Canvas.tool_settings() (also used to replay recorded fills)
+def fill_with(image, x, y, settings, selection=None, before_change=None):
+    return bucket_fill(image, int(x), int(y), tuple(settings["color"]), settings["tolerance"],
+                       settings["contiguous"], settings["antialias"], selection, before_change)
@@ -0,0 +1,314 @@
+
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from PyQt6.QtCore import Qt, QObject, QRunnable, QThread, QThreadPool, pyqtSignal
+from PyQt6.QtGui import QImage
+
+from lazy_imports import np
+import image_io
+from image_menu_functions import imf
+
+
+# Decoded/edited frames kept in memory, the rest is read from the file (or the spill folder) again
+CACHE_FRAMES = 8
+
+# Longest side of frame strip thumbnails
+THUMBNAIL_SIDE = 64
+
+
+'''
+Frames of a multi-page (TIFF) or animated (GIF) image, decoded when first asked for.
+At most CACHE_FRAMES frames are held in memory. Unedited frames that fall out of the
+cache are simply decoded again; edited frames are written to a temporary spill folder
+first, so memory stays bounded however many frames the file has.
+Safe to use from worker threads. Spill files are written after the lock is released (frames on
+their way to disk are still served from memory) and replace the old file in one step.
+'''
+class FrameSequence:
+
+    def __init__(self, path, count, cache_frames=CACHE_FRAMES):
+        self.path = path
+        self.count = count
+        self.cache_frames = cache_frames
+
+        self.cache = OrderedDict()              # index -> QImage, most recently used last
+        self.edited = set()                     # Frames that differ from the file
+        self.spilled = set()                    # Edited frames whose spill file is up to date
+        self.writing = {}                       # index -> QImage, left the cache and is being written to its spill file
+        self.spill_dir = None                   # Made when the first edited frame leaves the cache
+        self.lock = threading.Lock()
+
+
+    # Frame as QImage (a shared copy, painting on it does not change the sequence)
+    def frame(self, index):
+
+        with self.lock:
+            img = self.cache.get(index)
+            if img is not None:
+                self.cache.move_to_end(index)
+                return QImage(img)
+
+            # Being written to disk: still in memory, back into the cache
+            img = self.writing.get(index)
+            if img is not None:
+                self.cache[index] = img
+                evicted = self.trim()
+            spilled = index in self.edited
+
+        if img is not None:
+            self.spill(evicted)
+            return QImage(img)
+
+        # Decode outside the lock, other threads can keep reading cached frames
+        if spilled:
+            img = self.read_spilled(index)
+        else:
+            img, _ = image_io.read_frame(self.path, index)
+        if img is None:
+            return None
+
+        with self.lock:
+            # Replaced while it was decoding, the new pixels win
+            if index in self.cache:
+                img = self.cache[index]
+            else:
+                self.cache[index] = img
+            self.cache.move_to_end(index)
+            evicted = self.trim()
+
+        self.spill(evicted)
+        return QImage(img)
+
+
+    # Replace a frame with edited pixels
+    def set_frame(self, index, img):
+        with self.lock:
+            self.cache[index] = QImage(img)
+            self.cache.move_to_end(index)
+            self.edited.add(index)
+            self.spilled.discard(index)
+            self.writing.pop(index, None)       # A spill still being written is out of date
+            evicted = self.trim()
+
+        self.spill(evicted)
+
+
+    # Small version of a frame for the frame strip (does not fill the cache)
+    def thumbnail(self, index, side=THUMBNAIL_SIDE):
+
+        with self.lock:
+            img = self.cache.get(index)
+            if img is None:
+                img = self.writing.get(index)
+            spilled = index in self.edited
+
+        if img is None and spilled:
+            img = self.read_spilled(index)
+        if img is None:
+            return image_io.read_frame(self.path, index, side)[0]
+
+        return img.scaled(side, side, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+
+
+    # ---------- Spilling edited frames ---------- #
+
+    # Drop least recently used frames until the cache fits (lock must be held).
+    # Returns the edited frames among them that need a spill file, pass them to spill() after releasing the lock
+    def trim(self):
+        evicted = []
+        while len(self.cache) > self.cache_frames:
+            index, img = self.cache.popitem(last=False)
+            if index in self.edited and index not in self.spilled:
+                if self.spill_dir is None:
+                    self.spill_dir = tempfile.TemporaryDirectory(prefix="paintpp-frames-")
+                self.writing[index] = img
+                evicted.append((index, img))
+        return evicted
+
+
+    def spill_path(self, index):
+        return os.path.join(self.spill_dir.name, f"{index}.npy")
+
+
+    # Write frames trim() took out of the cache (lock must not be held)
+    def spill(self, evicted):
+        for index, img in evicted:
+            self.write_spilled(index, img)
+
+
+    # Written next to the spill file and moved over it, readers never see a half written file
+    def write_spilled(self, index, img):
+        spill_dir = self.spill_dir
+        try:
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=spill_dir.name)
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, image_io.qimage_const_view(img))
+            os.replace(tmp, os.path.join(spill_dir.name, f"{index}.npy"))
+            written = True
+        except (OSError, AttributeError):       # Disk full, or the sequence was closed meanwhile
+            written = False
+
+        with self.lock:
+            if self.writing.get(index) is not img:
+                return                          # Edited again or written by another thread meanwhile
+            del self.writing[index]
+            if written:
+                self.spilled.add(index)
+            elif self.spill_dir is not None:
+                self.cache[index] = img         # Keep it in memory rather than lose the edit
+
+
+    def read_spilled(self, index):
+        # Read completely (not mapped), the file is rewritten if the frame is spilled again
+        arr = np.load(self.spill_path(index))
+        h, w = arr.shape[:2]
+
+        img = QImage(w, h, QImage.Format.Format_ARGB32)
+        image_io.qimage_view(img)[:] = arr
+        return img
+
+
+    # Remove spilled frames (the sequence is not used anymore)
+    def close(self):
+        with self.lock:
+            self.cache.clear()
+            self.writing.clear()
+            if self.spill_dir is not None:
+                self.spill_dir.cleanup()
+                self.spill_dir = None
+
+
+# ----- Background work on frames ----- #
+
+class FrameSignals(QObject):
+    done = pyqtSignal(int, QImage)              # Frame index, image
+    failed = pyqtSignal(int, str)               # Frame index, error message
+
+
+# Run a filter operation (BGR array -> BGR array) on one frame
+class FrameFilterTask(QRunnable):
+
+    def __init__(self, sequence, index, operation):
+        super().__init__()
+        self.setAutoDelete(False)               # Python keeps the reference
+
+        self.sequence = sequence
+        self.index = index
+        self.operation = operation
+        self.signals = FrameSignals()
+
+
+    def run(self):
+        img = self.sequence.frame(self.index)
+        if img is None:
+            self.signals.failed.emit(self.index, "Frame could not be decoded.")
+            return
+
+        try:
+            out = self.operation(imf.qimage_to_cv2(img))
+        except Exception as e:                  # Report instead of losing the error on the worker thread
+            self.signals.failed.emit(self.index, str(e))
+            return
+
+        # Stored here, so frames the cache has to spill are written on the worker and not the GUI thread
+        out = imf.cv2_to_qimage(out)
+        self.sequence.set_frame(self.index, out)
+        self.signals.done.emit(self.index, out)
+
+
+# Decode thumbnails for the given frames, one signal per frame
+class ThumbnailTask(QRunnable):
+
+    def __init__(self, sequence, indices):
+        super().__init__()
+        self.setAutoDelete(False)               # Python keeps the reference
+
+        self.sequence = sequence
+        self.indices = list(indices)
+        self.cancelled = False
+        self.signals = FrameSignals()
+
+
+    def cancel(self):
+        self.cancelled = True
+
+
+    def run(self):
+        for index in self.indices:
+            if self.cancelled:
+                return
+            img = self.sequence.thumbnail(index)
+            if img is not None:
+                self.signals.done.emit(index, img)
+
+
+'''
+Apply one operation to many frames in parallel.
+Only as many frames as there are worker threads are in flight at once, finished frames
+go straight into the sequence (and its spill folder), so memory does not grow with the frame count.
+'''
+class FrameBatch(QObject):
+
+    progress = pyqtSignal(int)                  # Frames finished so far
+    frame_done = pyqtSignal(int)                # Index of a frame that got new pixels
+    finished = pyqtSignal(int, list)            # Frames finished, error messages
+
+    def __init__(self, sequence, indices, operation, parent=None):
+        super().__init__(parent)
+        self.sequence = sequence
+        self.pending = list(indices)
+        self.operation = operation
+
+        self.running = {}                       # index -> task
+        self.done = 0
+        self.errors = []
+        self.cancelled = False
+
+
+    def start(self):
+        for _ in range(max(1, QThread.idealThreadCount())):
+            self.submit_next()
+
+        if not self.running:
+            self.finished.emit(0, [])
+
+
+    def cancel(self):
+        self.cancelled = True
+        self.pending.clear()
+
+
+    def submit_next(self):
+        if self.cancelled or not self.pending:
+            return
+
+        index = self.pending.pop(0)
+        task = FrameFilterTask(self.sequence, index, self.operation)
+        task.signals.done.connect(self.on_done)
+        task.signals.failed.connect(self.on_failed)
+        self.running[index] = task
+        QThreadPool.globalInstance().start(task)
+
+
+    # The task already put the new pixels into the sequence
+    def on_done(self, index, img):
+        self.frame_done.emit(index)
+        self.task_ended(index)
+
+
+    def on_failed(self, index, error):
+        self.errors.append(f"Frame {index + 1}: {error}")
+        self.task_ended(index)
+
+
+    def task_ended(self, index):
+        self.running.pop(index, None)
+        self.done += 1
+        self.progress.emit(self.done)
+
+        self.submit_next()
+        if not self.running:
+            self.finished.emit(self.done, self.errors)
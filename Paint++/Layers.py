@@ -0,0 +1,180 @@
+
+from PyQt6.QtCore import QRect
+from PyQt6.QtGui import QImage
+
+from lazy_imports import np
+import image_io
+import BlendModes
+
+
+# One layer: its own ARGB32 pixels (all layers have the image size) and how it is blended onto the ones below
+class Layer:
+
+    def __init__(self, image, name, opacity=1.0, visible=True, blend="normal"):
+        self.image = image
+        self.name = name
+        self.opacity = opacity                  # 0..1
+        self.visible = visible
+        self.blend = blend                      # Key of BlendModes.MODES
+
+
+    # Shares the pixels until one of the two is painted on
+    def copy(self, name=None):
+        return Layer(QImage(self.image), name or self.name, self.opacity, self.visible, self.blend)
+
+
+'''
+Layers of one canvas, bottom first, and the picture they make together.
+The composite is cached: only the tiles that changed since the last call to picture() are
+blended again, so painting on one layer of many costs only the touched tiles. The layers under
+the active one are blended once and kept (they only change through the stack), so a tile only
+blends the active layer and the ones above it. A stack of one plain layer is its own picture.
+'''
+class LayerStack:
+
+    def __init__(self):
+        self.layers = []                        # Bottom first
+        self.active = 0                         # Index of the layer tools and filters work on
+        self.composite = None                   # ARGB32 QImage, valid except for the tiles passed to picture()
+        self.below = None                       # BGRA array, the layers under the active one blended
+        self.below_key = None                   # What below was made from
+
+
+    # New picture: a single layer holding image (no layers for None)
+    def reset(self, image, name="Background"):
+        self.layers = [Layer(image, name)] if image is not None else []
+        self.active = 0
+        self.composite = None
+        self.below = self.below_key = None
+
+
+    def active_layer(self):
+        return self.layers[self.active] if self.layers else None
+
+
+    # True if the picture is simply the one layer
+    def is_flat(self):
+        if len(self.layers) != 1:
+            return False
+        layer = self.layers[0]
+        return layer.visible and layer.opacity >= 1.0 and layer.blend == "normal"
+
+
+    # ---------- Editing the stack ---------- #
+
+    # Put a layer above the active one and make it active
+    def add(self, layer):
+        self.active = self.active + 1 if self.layers else 0
+        self.layers.insert(self.active, layer)
+
+
+    def remove(self, index):
+        if len(self.layers) <= 1:
+            return
+        del self.layers[index]
+        self.active = min(self.active if self.active < index else max(0, self.active - 1), len(self.layers) - 1)
+
+
+    # Move a layer one step up (+1) or down (-1), the active layer follows it
+    def move(self, index, step):
+        to = index + step
+        if not 0 <= to < len(self.layers):
+            return False
+
+        self.layers[index], self.layers[to] = self.layers[to], self.layers[index]
+        if self.active == index:
+            self.active = to
+        elif self.active == to:
+            self.active = index
+        return True
+
+
+    # Replace all layers by the picture they make
+    def flatten(self):
+        if not self.layers or self.is_flat():
+            return
+        self.reset(self.flattened())
+
+
+    # Undo state: layers share their pixels with the live ones until those are painted on
+    def snapshot(self):
+        return [layer.copy() for layer in self.layers], self.active
+
+
+    def restore(self, state):
+        layers, self.active = state
+        self.layers = [layer.copy() for layer in layers]
+        self.composite = None
+        self.below = self.below_key = None
+
+
+    # ---------- Composite ---------- #
+
+    '''
+    The picture all layers make, as ARGB32 QImage (do not paint on it).
+    stale: (x, y, w, h) rects that changed since the last call, only those are blended again
+    '''
+    def picture(self, stale=()):
+        if not self.layers:
+            return None
+        if self.is_flat():
+            self.composite = None
+            return self.layers[0].image
+
+        w, h = self.layers[0].image.width(), self.layers[0].image.height()
+        if self.composite is None or self.composite.width() != w or self.composite.height() != h:
+            self.composite = QImage(w, h, QImage.Format.Format_ARGB32)
+            self.render(QRect(0, 0, w, h))
+        else:
+            for x, y, tw, th in stale:
+                self.render(QRect(x, y, tw, th))
+        return self.composite
+
+
+    # Blend the visible layers into rect of the composite, bottom up onto transparent pixels
+    def render(self, rect):
+        self.update_below()
+
+        x, y, w, h = rect.x(), rect.y(), rect.width(), rect.height()
+        out = image_io.qimage_view(self.composite)[y:y + h, x:x + w]
+        if self.below is None:
+            out[...] = 0
+        else:
+            out[...] = self.below[y:y + h, x:x + w]
+
+        for layer in self.layers[self.active:]:
+            if not layer.visible or layer.opacity <= 0:
+                continue
+            pixels = image_io.qimage_const_view(layer.image)[y:y + h, x:x + w]
+            BlendModes.blend(out, pixels, layer.blend, layer.opacity, out=out)
+
+
+    # Blend the layers under the active one again if any of them changed (pixels, properties or order)
+    def update_below(self):
+        below = self.layers[:self.active]
+        key = tuple((layer.image.cacheKey(), layer.opacity, layer.visible, layer.blend) for layer in below)
+        if key == self.below_key:
+            return
+
+        self.below_key = key
+        if not below:
+            self.below = None
+            return
+
+        w, h = below[0].image.width(), below[0].image.height()
+        self.below = np.zeros((h, w, 4), np.uint8)
+        for layer in below:
+            if layer.visible and layer.opacity > 0:
+                BlendModes.blend(self.below, image_io.qimage_const_view(layer.image), layer.blend, layer.opacity,
+                                 out=self.below)
+
+
+    # Picture as a new ARGB32 QImage of its own
+    def flattened(self):
+        if self.is_flat():
+            return QImage(self.layers[0].image)
+
+        w, h = self.layers[0].image.width(), self.layers[0].image.height()
+        self.composite = QImage(w, h, QImage.Format.Format_ARGB32)
+        self.render(QRect(0, 0, w, h))
+        return QImage(self.composite)
@@ -0,0 +1,90 @@
+
+from dataclasses import dataclass
+
+from lazy_imports import cv2
+from PyQt6.QtCore import QRectF, Qt
+from PyQt6.QtGui import QTransform
+
+
+'''
+Image orientation as an element of the dihedral group D4 (4 rotations x optional mirror).
+The image is mirrored horizontally first (if mirrored), then rotated clockwise in quarter turns.
+Composing new rotations/flips only changes these two numbers, the pixels are untouched
+until the orientation is baked into the image.
+'''
+@dataclass(frozen=True)
+class Orientation:
+    rotation: int = 0                   # Quarter turns clockwise (0-3)
+    mirrored: bool = False              # Mirrored horizontally before rotating
+
+
+    def is_identity(self) -> bool:
+        return self.rotation == 0 and not self.mirrored
+
+
+    # ---------- Composition (new operation applied after the current one) ---------- #
+
+    def rotated_cw(self):
+        return Orientation((self.rotation + 1) % 4, self.mirrored)
+
+    def rotated_ccw(self):
+        return Orientation((self.rotation - 1) % 4, self.mirrored)
+
+    # F * R^k = R^-k * F
+    def flipped_horizontal(self):
+        return Orientation((-self.rotation) % 4, not self.mirrored)
+
+    # Vertical flip = horizontal flip followed by a half turn
+    def flipped_vertical(self):
+        return Orientation((2 - self.rotation) % 4, not self.mirrored)
+
+
+    # ---------- Geometry ---------- #
+
+    # Size (width, height) of an image of size w x h after orientation
+    def size(self, w, h):
+        if self.rotation % 2:
+            return h, w
+        return w, h
+
+
+    # QTransform that maps image pixel coordinates to oriented coordinates (top-left at 0,0)
+    def transform(self, w, h) -> QTransform:
+
+        # Qt applies the last added operation first: mirror, then rotate
+        t = QTransform()
+        t.rotate(90 * self.rotation)
+        if self.mirrored:
+            t.scale(-1, 1)
+
+        # Move the result back so it starts at the origin
+        bounds = t.mapRect(QRectF(0, 0, w, h))
+        return t * QTransform.fromTranslate(-bounds.x(), -bounds.y())
+
+
+    # ---------- Baking into pixels ---------- #
+
+    # Return a new QImage with the orientation applied
+    def apply_to_qimage(self, img):
+
+        if img is None or self.is_identity():
+            return img
+
+        return img.transformed(self.transform(img.width(), img.height()), Qt.TransformationMode.FastTransformation)
+
+
+    # Return a new OpenCV image with the orientation applied
+    def apply_to_cv2(self, bgr):
+
+        if bgr is None or self.is_identity():
+            return bgr
+
+        out = cv2.flip(bgr, 1) if self.mirrored else bgr
+
+        if self.rotation == 1:
+            out = cv2.rotate(out, cv2.ROTATE_90_CLOCKWISE)
+        elif self.rotation == 2:
+            out = cv2.rotate(out, cv2.ROTATE_180)
+        elif self.rotation == 3:
+            out = cv2.rotate(out, cv2.ROTATE_90_COUNTERCLOCKWISE)
+        return out
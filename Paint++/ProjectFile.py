@@ -0,0 +1,214 @@
+
+import json
+import os
+import struct
+
+from lazy_imports import np
+from PyQt6.QtCore import QRunnable
+from PyQt6.QtGui import QImage
+
+import image_io
+from DirtyTiles import TILE
+from Orientation import Orientation
+
+
+'''
+Native Paint++ project (.ppp)
+
+    0            magic b"PPP1", u32 little endian header length
+    8            header (JSON): size, orientation, selection ...
+    data_offset  raw ARGB32 pixels, row by row (width * 4 bytes per row), no compression
+
+data_offset is page aligned, so the pixels can be memory mapped and copied into a QImage
+without decoding, and changed tiles can be written back in place.
+'''
+EXTENSION = ".ppp"
+MAGIC = b"PPP1"
+VERSION = 1
+HEADER_SPACE = 65536                    # Room for the header, so it can be rewritten in place
+
+
+def is_project_path(path) -> bool:
+    return os.path.splitext(path)[1].lower() == EXTENSION
+
+
+# Read and check the header, raises ValueError if path is not a project file
+def read_header(path) -> dict:
+
+    with open(path, "rb") as f:
+        start = f.read(8)
+        if len(start) < 8 or start[:4] != MAGIC:
+            raise ValueError("Not a Paint++ project file.")
+
+        length = struct.unpack("<I", start[4:])[0]
+        header = json.loads(f.read(length).decode("utf-8"))
+
+    if header.get("version", 0) > VERSION:
+        raise ValueError("Project was saved by a newer version of Paint++.")
+    return header
+
+
+def encode_header(header) -> bytes:
+    data = json.dumps(header).encode("utf-8")
+    return MAGIC + struct.pack("<I", len(data)) + data
+
+
+class ProjectFile:
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+
+        self.width = header["width"]
+        self.height = header["height"]
+        self.data_offset = header["data_offset"]
+
+
+    @staticmethod
+    def open(path):
+        return ProjectFile(path, read_header(path))
+
+
+    def orientation(self):
+        rotation, mirrored = self.header.get("orientation", (0, False))
+        return Orientation(rotation, mirrored)
+
+
+    def selection(self):
+        return self.header.get("selection")
+
+
+    # Pixels as a memory mapped (height, width, 4) array, the OS reads pages when they are touched
+    def pixels(self, mode="r"):
+        return np.memmap(self.path, dtype=np.uint8, mode=mode, offset=self.data_offset, shape=(self.height, self.width, 4))
+
+
+    # Full image (one copy out of the mapping, no decoding)
+    def read_image(self):
+        img = QImage(self.width, self.height, QImage.Format.Format_ARGB32)
+        image_io.qimage_view(img)[:] = self.pixels()
+        return img
+
+
+    # Reduced image from every n-th pixel, only the rows it needs are read from disk
+    def read_proxy(self, max_side=image_io.PROXY_MAX_SIDE):
+        step = max(1, -(-max(self.width, self.height) // max_side))
+        small = np.ascontiguousarray(self.pixels()[::step, ::step])
+
+        h, w = small.shape[:2]
+        img = QImage(w, h, QImage.Format.Format_ARGB32)
+        image_io.qimage_view(img)[:] = small
+        return img
+
+
+    # ---------- Saving ---------- #
+
+    '''
+    Write a complete project. Goes through a temporary file, so the old project stays intact until the new one is complete.
+    image: ARGB32 QImage (may be a shared snapshot, it is only read)
+    meta:  extra header entries (orientation, selection)
+    '''
+    @staticmethod
+    def create(path, image, meta):
+
+        header = dict(meta, version=VERSION, width=image.width(), height=image.height(), tile=TILE, format="ARGB32")
+
+        # Keep pixels page aligned even if a long lasso makes the header big
+        header["data_offset"] = HEADER_SPACE
+        head = encode_header(header)
+        if len(head) > HEADER_SPACE:
+            header["data_offset"] = -(-(len(head) + 64) // 4096) * 4096
+            head = encode_header(header)
+
+        tmp = None
+        try:
+            tmp = image_io.temp_path_for(path)
+            with open(tmp, "wb") as f:
+                f.write(head.ljust(header["data_offset"], b"\0"))
+                f.write(np.ascontiguousarray(image_io.qimage_const_view(image)).data)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:                            # Also a missing or unwritable folder
+            if tmp is not None:
+                image_io.remove_temp(tmp)
+            return None, str(e)
+
+        ok, error = image_io.replace_with_temp(tmp, path)
+        if not ok:
+            return None, error
+        return ProjectFile(path, header), ""
+
+
+    '''
+    Write only the given tiles (x, y, w, h) and the new header into the existing file.
+    Unlike create() this writes in place: much faster for big projects, but a crash in the
+    middle leaves a mix of old and new tiles.
+    The image must have the same size as the project, otherwise use create().
+    image may be None when no tiles changed.
+    '''
+    def update(self, image, rects, meta):
+
+        header = dict(self.header, **meta)
+        head = encode_header(header)
+        if len(head) > self.data_offset:
+            if image is None:
+                image = self.read_image()
+            return ProjectFile.create(self.path, image, meta)
+
+        try:
+            if rects:
+                src = image_io.qimage_const_view(image)
+                dst = self.pixels("r+")
+                for x, y, w, h in rects:
+                    dst[y:y + h, x:x + w] = src[y:y + h, x:x + w]
+                dst.flush()
+                del dst
+
+            with open(self.path, "r+b") as f:
+                f.write(head)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            return None, str(e)
+
+        self.header = header
+        return self, ""
+
+
+'''
+Save the canvas as a project on a worker thread.
+image:   snapshot of the canvas pixels, None if only the header of project changes
+project: ProjectFile the dirty tiles refer to, or None to write the whole file
+rects:   changed tiles since project was written (ignored when project is None)
+'''
+class ProjectSaveTask(QRunnable):
+
+    def __init__(self, image, path, meta, project=None, rects=None):
+        super().__init__()
+        self.setAutoDelete(False)               # Python keeps the reference
+
+        self.image = image
+        self.path = path
+        self.meta = meta
+        self.project = project
+        self.rects = rects or []
+        self.result = None                      # ProjectFile after a successful save
+        self.signals = image_io.ImageSaveSignals()
+
+
+    def run(self):
+
+        same_file = (self.project is not None and self.project.path == self.path and os.path.exists(self.path)
+                     and (self.image is None or (self.project.width, self.project.height) == (self.image.width(), self.image.height())))
+
+        if same_file:
+            self.result, error = self.project.update(self.image, self.rects, self.meta)
+        elif self.image is None:
+            error = "The project file was moved or deleted."
+        else:
+            self.result, error = ProjectFile.create(self.path, self.image, self.meta)
+
+        if self.result is not None:
+            self.signals.finished.emit(self.path)
+        else:
+            self.signals.failed.emit(self.path, error)
@@ -1,6 +1,8 @@
 #import numpy as np
+from __future__ import annotations             # Annotations like np.ndarray are not evaluated (NumPy loads lazily)
+import threading
 from dataclasses import dataclass, field
-import numpy as np
+from lazy_imports import np
 from SelectionTools import SelectionTools
 
 
@@ -17,10 +19,27 @@ class SelectionState:
     drawing:bool = False                           # Lasso is currently dragging
 
 
+'''
+Selection of a canvas. Change it only through these methods: each change bumps version, and the masks
+and bounding boxes made for the selection are cached per version and image size until then.
+The cache is locked, filters on other frames ask for the mask from worker threads.
+'''
 class SelectionManager:
 
     def __init__(self):
         self.state = SelectionState()              # all selection states
+        self.feather = 0                           # Edge softening radius in pixels (kept between selections)
+        self.version = 0                           # Bumped on every change of the selection
+        self.cache = {}                            # (version, kind, height, width, ...) -> read only mask or bbox
+        self.soft_key = None                       # Key of the cached feathered mask, only the latest feather is kept
+        self.cache_lock = threading.RLock()
+
+
+    # The selection changed: masks made so far no longer match it
+    def changed(self):
+        with self.cache_lock:
+            self.version += 1
+            self.cache.clear()
 
     def start(self, mode, min_dist=2):
 
@@ -32,6 +51,7 @@ class SelectionManager:
 
         # Reset selection, (keep tool + lasso spacing, clears the rest
         self.state = SelectionState(mode=mode, min_dist=min_dist)
+        self.changed()
 
 
     def cancel(self):
@@ -79,6 +99,7 @@ class SelectionManager:
         if state.mode == "rect" and not state.frozen:
             state.rect_anchor = (int(x), int(y))            # First corner (on mouse click)
             state.rect_current = state.rect_anchor          # Second corner (follows mouse)
+            self.changed()
             return True
         return False
 
@@ -89,6 +110,7 @@ class SelectionManager:
 
         if state.mode == "rect" and not state.frozen and state.rect_anchor is not None:
             state.rect_current = (int(x), int(y))           # second corner follows mouse
+            self.changed()
 
 
     # For displaying the rectangular overlay
@@ -104,6 +126,7 @@ class SelectionManager:
 
         if state.mode == "poly" and not state.frozen:
             state.points.append((int(x), int(y)))               # add vertices on each click
+            self.changed()
 
 
     def polygon_points(self):
@@ -122,6 +145,7 @@ class SelectionManager:
             state.last_pt = (x, y)
 
             state.points.append((int(x), int(y)))               # first point
+            self.changed()
 
 
     # Records lasso points as the mouse moves while the left-mouse-button is  held down
@@ -146,6 +170,7 @@ class SelectionManager:
         if delta_x * delta_x + delta_y * delta_y >= state.min_dist * state.min_dist:
             state.points.append((int(x), int(y)))
             state.last_pt = (x, y)
+            self.changed()
 
     def lasso_release(self):
         state = self.state
@@ -160,10 +185,57 @@ class SelectionManager:
 
 
 
+    # ---------- Saving ---------- #
+
+    # Selection as plain data (stored in project files)
+    def to_dict(self):
+        state = self.state
+        return {
+            "mode": state.mode,
+            "frozen": state.frozen,
+            "rect_anchor": state.rect_anchor,
+            "rect_current": state.rect_current,
+            "points": [list(p) for p in state.points],
+            "min_dist": state.min_dist,
+            "feather": self.feather,
+        }
+
+
+    # Restore a selection made by to_dict()
+    def from_dict(self, data):
+        self.start(data.get("mode", "none"), data.get("min_dist", 2))
+        self.set_feather(data.get("feather", 0))
+
+        state = self.state
+        if data.get("rect_anchor") and data.get("rect_current"):
+            state.rect_anchor = tuple(data["rect_anchor"])
+            state.rect_current = tuple(data["rect_current"])
+        state.points = [(int(x), int(y)) for x, y in data.get("points", [])]
+        state.frozen = bool(data.get("frozen")) and self.is_ready()
+        self.changed()
+
+
     # ---------- Mask ---------- #
 
-    # return current selection as a uint8 mask
+    # Value cached for key and the current selection, make() builds it the first time (arrays are made read only)
+    def cached(self, key, make):
+        with self.cache_lock:
+            key = (self.version,) + key
+            if key not in self.cache:
+                value = make()
+                if isinstance(value, np.ndarray):
+                    value.setflags(write=False)
+                self.cache[key] = value
+            return self.cache[key]
+
+
+    # return current selection as a uint8 mask (read only, shared by all callers until the selection changes)
     def mask(self, hw):
+        h, w = int(hw[0]), int(hw[1])
+        return self.cached(("mask", h, w), lambda: self.make_mask((h, w)))
+
+
+    def make_mask(self, hw):
         state = self.state
 
         # Rectangular selection
@@ -182,6 +254,25 @@ class SelectionManager:
         return np.zeros(hw, dtype=np.uint8)
 
 
+    # Set edge softening radius, 0 = hard edges
+    def set_feather(self, radius):
+        self.feather = max(0, int(radius))
+
+
+    # Selection mask with feathered edges (same as mask() when feather is 0), read only like mask()
+    def soft_mask(self, hw):
+        feather = self.feather
+        if feather <= 0:
+            return self.mask(hw)
+        h, w = int(hw[0]), int(hw[1])
+        with self.cache_lock:
+            key = ("soft", h, w, feather)
+            if self.soft_key is not None and self.soft_key[1:] != key:
+                self.cache.pop(self.soft_key, None)
+            self.soft_key = (self.version,) + key
+            return self.cached(key, lambda: SelectionTools.feather_mask(self.mask((h, w)), feather))
+
+
     # True if there is a frozen selection ready to use
     def has_frozen_selcetion(self) -> bool:
         return self.state.frozen and self.is_ready()
@@ -189,6 +280,11 @@ class SelectionManager:
 
     # Return bounding box of current selection (x1, y1, x2, y2)
     def bbox(self, hw):
+        h, w = int(hw[0]), int(hw[1])
+        return self.cached(("bbox", h, w), lambda: self.make_bbox((h, w)))
+
+
+    def make_bbox(self, hw):
 
         mask = self.mask(hw)
         if mask is None or mask.size == 0:
@@ -221,12 +317,12 @@ class SelectionManager:
             return None
 
         h, w = bgr.shape[:2]
-        mask = self.mask((h, w))
+        mask = self.soft_mask((h, w))
 
         if mask is None:
             return None
 
-        # Let SelectionTools apply op_func where mask > 0
-        return SelectionTools.apply_in_mask(bgr, op_func, mask)
+        # Let SelectionTools apply op_func where mask > 0 (blended when feathered)
+        return SelectionTools.apply_in_mask(bgr, op_func, mask, soft=self.feather > 0)
 
 
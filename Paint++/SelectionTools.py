@@ -1,5 +1,5 @@
-import cv2
-import numpy as np
+from __future__ import annotations             # Annotations like np.ndarray are not evaluated (NumPy loads lazily)
+from lazy_imports import cv2, np
 
 
 
@@ -105,18 +105,54 @@ class SelectionTools:
             submask = mask[y0:y1, x0:x1]
             if submask.dtype != np.uint8:
                 submask = submask.astype(np.uint8)
-            crop[submask == 0] = 0
+            crop = cv2.bitwise_and(crop, crop, mask=submask)
         return crop
 
 
-    # Apply op_func to whole image
+    # Soften the mask edge with a Gaussian blur of the given radius (anti-aliased selection)
     @staticmethod
-    def apply_in_mask(bgr: np.ndarray, op_func,  mask: np.ndarray):
+    def feather_mask(mask: np.ndarray, radius: int):
 
-        modified = op_func(bgr.copy())
+        radius = int(radius)
+        if radius <= 0:
+            return mask
+
+        k = 2 * radius + 1
+        return cv2.GaussianBlur(mask, (k, k), 0)
+
+
+    # Put modified pixels on top of bgr where mask is set.
+    # Hard masks (0/255) are copied with cv2.copyTo, soft masks blend out = a + (b - a) * alpha
+    @staticmethod
+    def blend_with_mask(bgr: np.ndarray, modified: np.ndarray, mask: np.ndarray, soft: bool = False):
 
-        # Copy original and blend back only inside mask
         out = bgr.copy()
-        out[mask > 0] = modified[mask > 0]
+
+        # Only the part of the image covered by the mask needs work
+        x, y, w, h = cv2.boundingRect(mask)
+        if w == 0 or h == 0:
+            return out
+
+        roi_out = out[y:y + h, x:x + w]
+        roi_mod = modified[y:y + h, x:x + w]
+        roi_mask = mask[y:y + h, x:x + w]
+
+        if not soft:
+            cv2.copyTo(roi_mod, roi_mask, roi_out)
+            return out
+
+        # Alpha weights in float32, blendLinear does the weighted sum in one vectorized pass
+        alpha = roi_mask.astype(np.float32)
+        alpha *= 1.0 / 255.0
+        roi_out[...] = cv2.blendLinear(roi_out, roi_mod, 1.0 - alpha, alpha)
         return out
 
+
+    # Apply op_func to whole image
+    @staticmethod
+    def apply_in_mask(bgr: np.ndarray, op_func,  mask: np.ndarray, soft: bool = False):
+
+        modified = op_func(bgr.copy())
+
+        # Copy original and blend back only inside mask
+        return SelectionTools.blend_with_mask(bgr, modified, mask, soft)
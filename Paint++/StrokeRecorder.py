@@ -0,0 +1,337 @@
+
+import base64
+import json
+import os
+import sys
+import time
+
+from PyQt6.QtCore import QRect, QObject, QRunnable, pyqtSignal
+
+from lazy_imports import np
+import image_io
+import BrushEngine
+import FloodFill
+
+
+'''
+Recording of canvas strokes (.pprec, JSON)
+
+    version  format version
+    size     [width, height] of the image it was recorded on (only informative)
+    shapes   custom brush tips used, {"size": [h, w], "data": base64 float32}
+    strokes  [{"settings": {...}, "points": [[t, x, y], ...]}, ...]
+
+settings are Img_Canvas.tool_settings() of the stroke, "shape" is an index into shapes (or null).
+Points are in image coordinates, t is seconds since recording started. The first point is the press,
+the stroke is merged after the last one; a paint bucket fill is a stroke with a single point.
+Spray strokes carry the seed of their dots, so a replay puts every dot where it was.
+'''
+EXTENSION = ".pprec"
+VERSION = 1
+
+# Settings a stroke of each tool needs (all numbers), besides "tool", "color" and "shape"
+SETTINGS = {
+    "brush": ("pen_width", "hardness", "opacity", "spacing"),
+    "spray": ("pen_width", "spray_size", "spray_density", "seed"),
+    "eraser": ("pen_width",),
+    "bucket": ("tolerance", "contiguous", "antialias"),
+}
+
+
+class StrokeRecorder:
+
+    def __init__(self, size=None):
+        self.size = size                                # (width, height) of the image, or None
+        self.started = time.perf_counter()
+        self.strokes = []                               # Finished strokes
+        self.current = None                             # Stroke being drawn
+        self.shapes = []                                # Brush tip arrays, strokes refer to them by index
+
+
+    def is_empty(self):
+        return not self.strokes
+
+
+    # A stroke starts with these settings, its points follow
+    def begin(self, settings):
+        settings = dict(settings)
+
+        shape = settings.get("shape")
+        if shape is not None:
+            index = next((i for i, s in enumerate(self.shapes) if s is shape), None)
+            if index is None:
+                index = len(self.shapes)
+                self.shapes.append(shape)
+            settings["shape"] = index
+
+        self.current = {"settings": settings, "points": []}
+
+
+    def point(self, x, y):
+        if self.current is not None:
+            self.current["points"].append([round(time.perf_counter() - self.started, 6), x, y])
+
+
+    # Stroke went into the image
+    def end(self):
+        if self.current is not None and self.current["points"]:
+            self.strokes.append(self.current)
+        self.current = None
+
+
+    # Stroke was cancelled, it never changed the image
+    def discard(self):
+        self.current = None
+
+
+    def to_dict(self):
+        return {
+            "version": VERSION,
+            "size": list(self.size) if self.size else None,
+            "shapes": [encode_shape(s) for s in self.shapes],
+            "strokes": self.strokes,
+        }
+
+
+def encode_shape(shape):
+    arr = np.ascontiguousarray(shape, dtype=np.float32)
+    return {"size": list(arr.shape), "data": base64.b64encode(arr.tobytes()).decode("ascii")}
+
+
+def decode_shape(data):
+    return np.frombuffer(base64.b64decode(data["data"]), np.float32).reshape(data["size"])
+
+
+# ----- Files ----- #
+
+# Write a recording (StrokeRecorder.to_dict()) next to path and move it over path when complete.
+# Returns (True, "") or (False, error message)
+def save(recording, path):
+    tmp = None
+    try:
+        tmp = image_io.temp_path_for(path)
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(recording, f)
+    except OSError as e:                                # Folder missing or not writable, disk full
+        if tmp is not None:
+            image_io.remove_temp(tmp)
+        return False, str(e)
+    return image_io.replace_with_temp(tmp, path)
+
+
+# Read a recording, brush tips are turned back into arrays. Raises ValueError if path is not one
+def load(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            recording = json.load(f)
+    except (OSError, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Could not read the recording: {e}")
+
+    if not isinstance(recording, dict) or "strokes" not in recording:
+        raise ValueError("Not a Paint++ stroke recording.")
+    if recording.get("version", 0) > VERSION:
+        raise ValueError("Recording was made by a newer version of Paint++.")
+
+    try:
+        shapes = [decode_shape(s) for s in recording.get("shapes", [])]
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Broken brush tip in the recording: {e}")
+
+    if not isinstance(recording["strokes"], list):
+        raise ValueError("Broken recording: strokes is not a list.")
+    for i, stroke in enumerate(recording["strokes"]):
+        check_stroke(stroke, len(shapes), i)
+        index = stroke["settings"].get("shape")
+        stroke["settings"]["shape"] = None if index is None else shapes[index]
+    return recording
+
+
+# Raise ValueError unless stroke (number i of the recording) can be replayed
+def check_stroke(stroke, shape_count, i):
+    def number(value):
+        return isinstance(value, (int, float))
+
+    if not isinstance(stroke, dict) or not isinstance(stroke.get("settings"), dict):
+        raise ValueError(f"Broken stroke {i + 1}: no settings.")
+    settings = stroke["settings"]
+
+    tool = settings.get("tool")
+    if tool not in SETTINGS:
+        raise ValueError(f"Broken stroke {i + 1}: unknown tool {tool!r}.")
+
+    color = settings.get("color")
+    if not isinstance(color, list) or len(color) != 4 or not all(number(v) and 0 <= v <= 255 for v in color):
+        raise ValueError(f"Broken stroke {i + 1}: color must be 4 values 0..255.")
+
+    for key in SETTINGS[tool]:
+        value = settings.get(key)
+        if not number(value):
+            raise ValueError(f"Broken stroke {i + 1}: {key} is missing or not a number.")
+
+    shape = settings.get("shape")
+    if shape is not None and not (isinstance(shape, int) and 0 <= shape < shape_count):
+        raise ValueError(f"Broken stroke {i + 1}: unknown brush tip {shape!r}.")
+
+    points = stroke.get("points")
+    if not isinstance(points, list) or not points:
+        raise ValueError(f"Broken stroke {i + 1}: no points.")
+    for point in points:
+        if not isinstance(point, list) or len(point) != 3 or not all(number(v) for v in point):
+            raise ValueError(f"Broken stroke {i + 1}: points must be [t, x, y].")
+
+
+# ----- Replay ----- #
+
+# Time spent per tool while replaying, to compare brush paths and find slow events
+class ReplayStats:
+
+    def __init__(self):
+        self.tools = {}                                 # tool -> [events, seconds, slowest event in seconds]
+        self.recorded = 0.0                             # Seconds the strokes took when they were drawn
+        self.changed = QRect()                          # Area of the image that was changed
+
+
+    def add(self, tool, seconds):
+        entry = self.tools.setdefault(tool, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+
+    def total(self):
+        return sum(entry[1] for entry in self.tools.values())
+
+
+    def summary(self):
+        lines = [f"Replayed in {self.total() * 1000:.1f} ms (drawn in {self.recorded:.2f} s)"]
+        for tool, (events, seconds, slowest) in sorted(self.tools.items()):
+            lines.append(f"{tool}: {events} events, {seconds / events * 1000:.3f} ms per event, slowest {slowest * 1000:.3f} ms")
+        return "\n".join(lines)
+
+
+'''
+Draw a recording on image (ARGB32 QImage) as fast as possible, without the canvas.
+Strokes go through the same BrushEngine / FloodFill code as on the canvas and sprays use their
+recorded seeds, so the same recording on the same image always gives the same pixels.
+Fills are not limited by a selection (the recording does not know about it).
+cancelled: optional function, replay stops between strokes when it returns True
+Returns ReplayStats.
+'''
+def replay(recording, image, cancelled=None):
+    stats = ReplayStats()
+
+    for stroke in recording["strokes"]:
+        if cancelled is not None and cancelled():
+            break
+
+        settings, points = stroke["settings"], stroke["points"]
+        tool = settings["tool"]
+        stats.recorded += points[-1][0] - points[0][0]
+
+        if tool == "bucket":
+            _, x, y = points[0]
+            start = time.perf_counter()
+            rect = FloodFill.fill_with(image, x, y, settings)
+            stats.add(tool, time.perf_counter() - start)
+
+        else:
+            start = time.perf_counter()
+            drawing = BrushEngine.ToolStroke(image, settings)
+            _, x, y = points[0]
+            drawing.press(x, y)
+            stats.add(tool, time.perf_counter() - start)
+
+            for _, x, y in points[1:]:
+                start = time.perf_counter()
+                drawing.move(x, y)
+                stats.add(tool, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            rect = drawing.finish()
+            stats.add(tool, time.perf_counter() - start)
+
+        if not rect.isEmpty():
+            stats.changed = stats.changed.united(rect)
+
+    return stats
+
+
+# ----- Replay on files ----- #
+
+class ReplayFileSignals(QObject):
+    finished = pyqtSignal(str)                  # Path that was written
+    failed = pyqtSignal(str, str)               # Source path, error message
+
+
+# Load an image, replay a recording on it and write it to out_path, on a worker thread
+class ReplayFileTask(QRunnable):
+
+    def __init__(self, recording, path, out_path):
+        super().__init__()
+        self.setAutoDelete(False)               # Python keeps the reference
+
+        self.recording = recording
+        self.path = path
+        self.out_path = out_path
+        self.cancelled = False
+        self.signals = ReplayFileSignals()
+
+
+    def cancel(self):
+        self.cancelled = True
+
+
+    def run(self):
+        if self.cancelled:
+            return
+
+        try:
+            self.replay_file()
+        except Exception as e:                  # Report instead of losing the error (and the task) on the worker thread
+            self.signals.failed.emit(self.path, str(e))
+
+
+    def replay_file(self):
+        img, error = image_io.read_image(self.path)
+        if img is None:
+            self.signals.failed.emit(self.path, error)
+            return
+
+        replay(self.recording, img, lambda: self.cancelled)
+        if self.cancelled:
+            return
+
+        ext = os.path.splitext(self.out_path)[1].lstrip(".").lower()
+        ok, error = image_io.write_image_atomic(img, self.out_path, ext.encode("ascii") if ext else None)
+        if ok:
+            self.signals.finished.emit(self.out_path)
+        else:
+            self.signals.failed.emit(self.path, error)
+
+
+# ----- Benchmark ----- #
+
+# python StrokeRecorder.py recording.pprec [image] [repeats]
+# Replays on the image (or a white image of the recorded size) and prints the time per tool
+if __name__ == "__main__":
+    from PyQt6.QtGui import QGuiApplication, QImage, QColor
+
+    app = QGuiApplication(sys.argv[:1])
+    if len(sys.argv) < 2:
+        sys.exit("usage: StrokeRecorder.py recording.pprec [image] [repeats]")
+
+    recording = load(sys.argv[1])
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    if len(sys.argv) > 2 and sys.argv[2] != "-":
+        source, error = image_io.read_image(sys.argv[2])
+        if source is None:
+            sys.exit(error)
+    else:
+        w, h = recording.get("size") or (2000, 2000)
+        source = QImage(w, h, QImage.Format.Format_ARGB32)
+        source.fill(QColor(255, 255, 255))
+
+    for i in range(repeats):
+        stats = replay(recording, source.copy())
+        print(f"Run {i + 1}: {stats.summary()}\n")
@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+
+# Paint++ folder (main.py), this script lives in "Test files"
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Heavy modules that must only load when a feature first needs them (see lazy_imports.py)
+LAZY = ("cv2", "numpy")
+
+# Slowest imports to show
+TOP = 15
+
+
+# Import main in a fresh interpreter with -X importtime, returns (modules still not loaded, importtime lines)
+def profile_import():
+    check = f"import sys, main; print(','.join(m for m in {LAZY!r} if m not in sys.modules))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", check],
+                            cwd=APP_DIR, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    not_loaded = [m for m in result.stdout.strip().split(",") if m]
+    return not_loaded, [line for line in result.stderr.splitlines() if line.startswith("import time:")]
+
+
+# "import time: self [us] | cumulative | imported package" -> (cumulative us, package)
+def parse(lines):
+    rows = []
+    for line in lines:
+        parts = line[len("import time:"):].split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2][1:].rstrip()))
+    return rows
+
+
+if __name__ == '__main__':
+    not_loaded, lines = profile_import()
+    rows = parse(lines)
+
+    total = sum(us for us, name in rows if not name.startswith(" "))
+    print(f"import main: {total / 1000:.1f} ms")
+    for us, name in sorted(rows, reverse=True)[:TOP]:
+        print(f"{us / 1000:8.1f} ms  {name}")
+
+    loaded = [m for m in LAZY if m not in not_loaded]
+    assert not loaded, f"Loaded while importing main: {', '.join(loaded)}"
+    print("OK:", ", ".join(LAZY), "not loaded at startup")
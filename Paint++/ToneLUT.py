@@ -0,0 +1,96 @@
+
+from lazy_imports import cv2, np
+
+
+# ----- 256-entry lookup tables for tone operations (levels, curves, gamma, brightness/contrast)
+class ToneLUT:
+
+    # Table that leaves every value unchanged
+    @staticmethod
+    def identity():
+        return np.arange(256, dtype=np.uint8)
+
+
+    # Convert a float table to uint8 with rounding and saturation
+    @staticmethod
+    def to_uint8(values):
+        return np.clip(np.rint(values), 0, 255).astype(np.uint8)
+
+
+    # ----- Levels ----- #
+    @staticmethod
+    def levels(in_black=0, in_white=255, gamma=1.0, out_black=0, out_white=255):
+
+        # Avoid division by zero if black and white points meet
+        in_white = max(int(in_white), int(in_black) + 1)
+
+        x = np.arange(256, dtype=np.float32)
+
+        # Stretch input range to 0..1, then apply midtone gamma
+        t = np.clip((x - in_black) / (in_white - in_black), 0.0, 1.0)
+        t = t ** (1.0 / max(float(gamma), 1e-3))
+
+        # Map to output range
+        return ToneLUT.to_uint8(out_black + t * (out_white - out_black))
+
+
+    # ----- Gamma ----- #
+    @staticmethod
+    def gamma(gamma):
+        x = np.arange(256, dtype=np.float32) / 255.0
+        return ToneLUT.to_uint8(255.0 * x ** (1.0 / max(float(gamma), 1e-3)))
+
+
+    # ----- Brightness / Contrast ----- #
+    # brightness and contrast both range from -100 to 100 (0 = unchanged)
+    @staticmethod
+    def brightness_contrast(brightness=0, contrast=0):
+
+        x = np.arange(256, dtype=np.float32)
+
+        # Contrast scales around mid gray, brightness shifts everything
+        factor = (100.0 + contrast) / 100.0 if contrast <= 0 else 100.0 / max(100.0 - contrast, 1.0)
+        return ToneLUT.to_uint8((x - 127.5) * factor + 127.5 + brightness * 2.55)
+
+
+    # ----- Curves ----- #
+    # points: list of (input, output) control points, linear between points
+    @staticmethod
+    def curves(points):
+
+        pts = sorted((int(np.clip(px, 0, 255)), int(np.clip(py, 0, 255))) for px, py in points)
+
+        # Anchor the ends at black and white unless the user moved them
+        if not pts or pts[0][0] != 0:
+            pts.insert(0, (0, 0))
+        if pts[-1][0] != 255:
+            pts.append((255, 255))
+
+        xs = [p[0] for p in pts]
+        ys = [p[1] for p in pts]
+        return ToneLUT.to_uint8(np.interp(np.arange(256), xs, ys))
+
+
+    # Compose tables so that applying the result equals applying them in order
+    @staticmethod
+    def compose(*luts):
+
+        out = ToneLUT.identity()
+        for lut in luts:
+            out = np.asarray(lut, dtype=np.uint8)[out]
+        return out
+
+
+    # Apply a table to the colour channels in one cv2.LUT pass, alpha is left untouched
+    @staticmethod
+    def apply(bgr, lut):
+
+        lut = np.asarray(lut, dtype=np.uint8)
+
+        # Grayscale or BGR: same table for every channel
+        if bgr.ndim == 2 or bgr.shape[2] != 4:
+            return cv2.LUT(bgr, lut)
+
+        # BGRA: identity table for alpha
+        table = np.stack([lut, lut, lut, ToneLUT.identity()], axis=-1).reshape(256, 1, 4)
+        return cv2.LUT(bgr, table)
@@ -0,0 +1,326 @@
+# image_io.py
+import os
+import tempfile
+import threading
+
+from lazy_imports import np
+from PyQt6.QtCore import Qt, QSize, QRect, QObject, QRunnable, pyqtSignal
+from PyQt6.QtGui import QImage, QImageReader, QImageWriter, QImageIOHandler
+
+
+# Ways an image can be opened
+OPEN_FULL = "Full resolution"
+OPEN_PROXY = "Quick look (reduced resolution)"
+OPEN_REGION = "Region only"
+OPEN_MODES = [OPEN_FULL, OPEN_PROXY, OPEN_REGION]
+
+# Images above this many pixels ask how they should be opened
+LARGE_IMAGE_PIXELS = 25_000_000
+
+# Longest side of a quick look image
+PROXY_MAX_SIDE = 2048
+
+# Bytes per pixel a decoder may need (16 bit per channel formats)
+DECODE_BYTES_PER_PIXEL = 8
+
+_allocation_lock = threading.Lock()
+
+
+# Image size from the file header, without decoding pixels (empty QSize if unknown)
+def image_size(path) -> QSize:
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)
+    return reader.size()
+
+
+# Size that fits inside max_side x max_side with the same aspect ratio (never larger than the original)
+def proxy_size(full: QSize, max_side=PROXY_MAX_SIDE) -> QSize:
+    if not full.isValid() or max(full.width(), full.height()) <= max_side:
+        return full
+    return full.scaled(max_side, max_side, Qt.AspectRatioMode.KeepAspectRatio)
+
+
+# Qt refuses to decode images above 256 MB by default, raise the (process wide) limit to what this one needs.
+# Only ever raised, so decodes running on other threads keep the room they got
+def allow_decode(size: QSize):
+    if not size.isValid():
+        return
+    needed = -(-size.width() * size.height() * DECODE_BYTES_PER_PIXEL // (1 << 20))     # MB, rounded up
+    with _allocation_lock:
+        if needed > QImageReader.allocationLimit():
+            QImageReader.setAllocationLimit(needed)
+
+
+'''
+Decode an image as ARGB32.
+clip_rect:   only decode this region (original image coordinates)
+scaled_size: let the decoder produce a smaller image directly (JPEG/TIFF decoders skip work for this)
+Returns (QImage, "") or (None, error message)
+'''
+def read_image(path, scaled_size: QSize = None, clip_rect: QRect = None):
+
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)                       # Auto-rotate based on EXIF data
+    allow_decode(reader.size())
+
+    if clip_rect is not None:
+        reader.setClipRect(clip_rect)
+    if scaled_size is not None:
+        reader.setScaledSize(scaled_size)
+
+    img = reader.read()
+    if img.isNull():
+        return None, reader.errorString()
+
+    if img.format() != QImage.Format.Format_ARGB32:
+        img = img.convertToFormat(QImage.Format.Format_ARGB32)
+    return img, ""
+
+
+# True if the format decodes straight to a reduced size (much faster than a full decode)
+def scales_natively(path):
+    return QImageReader(path).supportsOption(QImageIOHandler.ImageOption.ScaledSize)
+
+
+# ----- Multi-page / animated images ----- #
+
+# Number of images in a file (pages of a TIFF, frames of a GIF), at least 1
+def frame_count(path):
+    return max(1, QImageReader(path).imageCount())
+
+
+'''
+Decode one frame as ARGB32.
+Uses jumpToImage when the format supports it, otherwise reads the frames before it
+(animated GIFs draw every frame on top of the previous one, so that is needed anyway).
+max_side: decode a reduced image (thumbnails)
+Returns (QImage, "") or (None, error message)
+'''
+def read_frame(path, index, max_side=None):
+
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)
+    allow_decode(reader.size())
+
+    if index > 0 and not reader.jumpToImage(index):
+        for _ in range(index):
+            if reader.read().isNull():
+                return None, reader.errorString()
+
+    if max_side is not None:
+        size = proxy_size(reader.size(), max_side)
+        if size.isValid():
+            reader.setScaledSize(size)
+
+    img = reader.read()
+    if img.isNull():
+        return None, reader.errorString()
+
+    if img.format() != QImage.Format.Format_ARGB32:
+        img = img.convertToFormat(QImage.Format.Format_ARGB32)
+    return img, ""
+
+
+# ----- NumPy views of ARGB32 images (BGRA in memory, no copy) ----- #
+
+# Writable view: detaches the QImage first if its pixels are shared
+def qimage_view(img):
+    ptr = img.bits()
+    ptr.setsize(img.sizeInBytes())
+    arr = np.frombuffer(ptr, np.uint8).reshape(img.height(), img.bytesPerLine())
+    return arr[:, :img.width() * 4].reshape(img.height(), img.width(), 4)
+
+
+# Read only view: never detaches, safe on a shared snapshot while the original is edited
+def qimage_const_view(img):
+    ptr = img.constBits()
+    ptr.setsize(img.sizeInBytes())
+    arr = np.frombuffer(ptr, np.uint8).reshape(img.height(), img.bytesPerLine())
+    return arr[:, :img.width() * 4].reshape(img.height(), img.width(), 4)
+
+
+# ----- Background loading ----- #
+
+# Signals must live on a QObject, QRunnable is not one
+class ImageLoadSignals(QObject):
+    preview = pyqtSignal(QImage)            # Quick low resolution image (only for full resolution loads)
+    finished = pyqtSignal(QImage)           # Final image
+    failed = pyqtSignal(str)                # Error message
+
+
+'''
+Decode an image on a worker thread.
+For full resolution loads a reduced preview is decoded first so something can be shown quickly, but only
+from formats that decode reduced sizes natively (JPEG), otherwise the preview would cost a second full decode.
+cancel() stops the task before the next step; a decode that already started still runs, but its result is dropped.
+wait() blocks until the task ended, image is then the decoded image (None if it failed or was cancelled).
+'''
+class ImageLoadTask(QRunnable):
+
+    def __init__(self, path, mode=OPEN_FULL, clip_rect=None):
+        super().__init__()
+        self.setAutoDelete(False)               # Python keeps the reference
+
+        self.path = path
+        self.mode = mode
+        self.clip_rect = clip_rect
+        self.cancelled = False
+        self.frame_count = 1                    # Frames in the file (full resolution loads only)
+        self.image = None
+        self.error = ""                         # Why the decode failed
+        self.done = threading.Event()
+        self.signals = ImageLoadSignals()
+
+
+    def cancel(self):
+        self.cancelled = True
+
+
+    def wait(self):
+        self.done.wait()
+
+
+    def run(self):
+        try:
+            self.load()
+        finally:
+            self.done.set()
+
+
+    def load(self):
+
+        full_size = image_size(self.path)
+        small = proxy_size(full_size)
+
+        # Quick look and region are a single decode
+        if self.mode == OPEN_PROXY:
+            img, error = read_image(self.path, scaled_size=small)
+        elif self.mode == OPEN_REGION:
+            img, error = read_image(self.path, clip_rect=self.clip_rect)
+
+        else:
+            # Preview first, only worth it when the preview is really smaller and cheap to decode
+            if small.isValid() and small != full_size and scales_natively(self.path):
+                preview, _ = read_image(self.path, scaled_size=small)
+                if self.cancelled:
+                    return
+                if preview is not None:
+                    self.signals.preview.emit(preview)
+
+            img, error = read_image(self.path)
+
+            # Counting GIF frames reads the whole file, so it is done here and not on the GUI thread
+            self.frame_count = frame_count(self.path)
+
+        if self.cancelled:
+            return
+
+        if img is None:
+            self.error = error
+            self.signals.failed.emit(error)
+        else:
+            self.image = img
+            self.signals.finished.emit(img)
+
+
+# ----- Saving ----- #
+
+# Formats that use a quality setting (0-100) and formats that use a compression level
+QUALITY_FORMATS = {"jpg", "jpeg", "webp"}
+COMPRESSION_FORMATS = {"png"}
+
+
+# Temporary file in the same directory as path (same extension), so it can be renamed over path
+def temp_path_for(path):
+    directory = os.path.dirname(os.path.abspath(path))
+    name, ext = os.path.splitext(os.path.basename(path))
+
+    fd, tmp = tempfile.mkstemp(prefix=f".{name}.", suffix=ext, dir=directory)
+    os.close(fd)
+    return tmp
+
+
+# Delete the temporary file of a failed save (nothing to do if it is already gone)
+def remove_temp(tmp):
+    try:
+        os.remove(tmp)
+    except OSError:
+        pass
+
+
+# Move a finished temporary file over path in one step. Returns (True, "") or (False, error message)
+def replace_with_temp(tmp, path):
+
+    # mkstemp creates the file private, use the permissions a normal save would get
+    try:
+        if os.path.exists(path):
+            os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+
+        os.replace(tmp, path)
+    except OSError as e:
+        remove_temp(tmp)
+        return False, str(e)
+
+    return True, ""
+
+
+'''
+Write image to a temporary file next to path and rename it over path when complete,
+so a crash or a full disk never leaves a half written file behind.
+quality:     0-100 for lossy formats, -1 = format default
+compression: format specific compression level (PNG 0-9), None = format default
+Returns (True, "") or (False, error message)
+'''
+def write_image_atomic(image, path, fmt=None, quality=-1, compression=None):
+
+    # Same extension so the writer can still pick the format from the name
+    try:
+        tmp = temp_path_for(path)
+    except OSError as e:                                # Folder missing or not writable
+        return False, str(e)
+
+    writer = QImageWriter(tmp, fmt if fmt else b"")
+    if quality >= 0:
+        writer.setQuality(quality)
+    if compression is not None:
+        writer.setCompression(compression)
+
+    if not writer.write(image):
+        error = writer.errorString() or "Unkown error."
+        remove_temp(tmp)
+        return False, error
+
+    return replace_with_temp(tmp, path)
+
+
+class ImageSaveSignals(QObject):
+    finished = pyqtSignal(str)              # Path that was written
+    failed = pyqtSignal(str, str)           # Path, error message
+
+
+# Encode and write an image on a worker thread.
+# image must be a snapshot (QImage copy) so the canvas can keep being edited meanwhile
+class ImageSaveTask(QRunnable):
+
+    def __init__(self, image, path, fmt=None, quality=-1, compression=None):
+        super().__init__()
+        self.setAutoDelete(False)               # Python keeps the reference
+
+        self.image = image
+        self.path = path
+        self.fmt = fmt
+        self.quality = quality
+        self.compression = compression
+        self.signals = ImageSaveSignals()
+
+
+    def run(self):
+        ok, error = write_image_atomic(self.image, self.path, self.fmt, self.quality, self.compression)
+        if ok:
+            self.signals.finished.emit(self.path)
+        else:
+            self.signals.failed.emit(self.path, error)
@@ -1,8 +1,19 @@
 # image_menu_functions.py
-import cv2
-import numpy as np
+import math
+from functools import lru_cache
+
+from lazy_imports import cv2, np
+from PyQt6.QtCore import Qt
 from PyQt6.QtGui import QPixmap, QImage, QMouseEvent
-from PyQt6.QtWidgets import QInputDialog, QMessageBox
+from PyQt6.QtWidgets import (
+    QInputDialog,
+    QMessageBox,
+    QDialog,
+    QVBoxLayout,
+    QLabel,
+    QSlider,
+    QComboBox,
+    QDialogButtonBox)
 
 class imf:
     """Image manipulation tools for Paint++ (rotate, flip, resize, etc.)"""
@@ -17,6 +28,12 @@ class imf:
         if bgr is None:
             return QPixmap()
 
+        # returns Qpixmap from QImage
+        return QPixmap.fromImage(imf.cv2_to_qimage(bgr))
+
+    # QImage version, also safe on worker threads (QPixmap is not)
+    @staticmethod
+    def cv2_to_qimage(bgr):
         # takes the cv2 bgr image and makes it rgb image
         rgba = cv2.cvtColor(bgr, cv2.COLOR_BGRA2RGBA)
 
@@ -25,9 +42,7 @@ class imf:
 
         # makes rgb to QImage
         qimg = QImage(rgba.data, width, height, bytes_per_line, QImage.Format.Format_ARGB32)
-
-        # returns Qpixmap from QImage
-        return QPixmap.fromImage(qimg.copy())
+        return qimg.copy()
 
     @staticmethod
     def qpixmap_to_cv2(pixmap):
@@ -35,8 +50,14 @@ class imf:
         if pixmap.isNull():
             return None
 
-        # Makes a QImage in rgba from QPixmap
-        qimg = pixmap.toImage().convertToFormat(QImage.Format.Format_ARGB32)
+        return imf.qimage_to_cv2(pixmap.toImage())
+
+    # QImage version, also safe on worker threads (QPixmap is not)
+    @staticmethod
+    def qimage_to_cv2(qimg):
+
+        # Makes a QImage in rgba
+        qimg = qimg.convertToFormat(QImage.Format.Format_ARGB32)
 
         # QImage height and width
         w = qimg.width()
@@ -56,90 +77,167 @@ class imf:
         bgra = cv2.cvtColor(arr, cv2.COLOR_RGBA2BGRA)
         return bgra.copy()
     # === ROTATE ===
+    # Rotations and flips only change the canvas orientation (a view transform).
+    # The pixels are rotated once, when a pixel operation or save needs them.
     def rotate_CW(self):
-        # Gets the QPixmap
-        pix = self.canvas.pixmap()
+        # Does not rotate if there is no image, returns
+        if self.canvas.image is None or self.canvas.image.isNull():
+            return
 
-        # Does not rotate if QPixmap is empty, returns
-        if not pix or pix.isNull():
+        self.canvas.set_orientation(self.canvas.orientation.rotated_cw())
+
+    def rotate_CCW(self):
+        # Does not rotate if there is no image, returns
+        if self.canvas.image is None or self.canvas.image.isNull():
             return
 
-        # Makes a bgr
-        cv = self.qpixmap_to_cv2(pix)
+        self.canvas.set_orientation(self.canvas.orientation.rotated_ccw())
 
-        # Rotates the bgr in cv2
-        cv = cv2.rotate(cv, cv2.ROTATE_90_CLOCKWISE)
+    # === FLIP ===
+    def flip_horizontal(self):
+        # Does not flip if there is no image, returns
+        if self.canvas.image is None or self.canvas.image.isNull():
+            return
 
-        # Makes a QPixmap of rotated bgr
-        qpix = self.cv2_to_qpixmap(cv)
+        self.canvas.set_orientation(self.canvas.orientation.flipped_horizontal())
 
-        # Sets  the rotated QPixmap as canvas
-        self.canvas.set_image(qpix)
+    def flip_vertical(self):
+        # Does not flip if there is no image, returns
+        if self.canvas.image is None or self.canvas.image.isNull():
+            return
 
-    def rotate_CCW(self):
-        # Gets the QPixmap
-        pix = self.canvas.pixmap()
+        self.canvas.set_orientation(self.canvas.orientation.flipped_vertical())
+
+    # === FREE ROTATE / STRAIGHTEN ===
+    # Longest side of the preview image shown while dragging the angle slider
+    ROTATE_PREVIEW_SIZE = 800
+
+    def rotate_free(self):
+
+        # Size changes apply to the whole picture, not to one layer
+        pix = self.canvas.picture_pixmap()
 
         # Does not rotate if QPixmap is empty, returns
         if not pix or pix.isNull():
             return
 
-        # Makes a bgr
-        cv = self.qpixmap_to_cv2(pix)
+        bgr = self.qpixmap_to_cv2(pix)
+        h, w = bgr.shape[:2]
 
-        # Rotates the bgr in cv2
-        cv = cv2.rotate(cv, cv2.ROTATE_90_COUNTERCLOCKWISE)
+        # Small proxy of the image for the live preview
+        scale = min(1.0, self.ROTATE_PREVIEW_SIZE / max(w, h))
+        proxy = self.resize_cv2(bgr, max(1, int(w * scale)), max(1, int(h * scale)), draft=True)
+        ph, pw = proxy.shape[:2]
 
-        # Makes a QPixmap of rotated bgr
-        qpix = self.cv2_to_qpixmap(cv)
+        dlg = QDialog(self.canvas)
+        dlg.setWindowTitle("Rotate / Straighten")
+        layout = QVBoxLayout(dlg)
 
-        # Sets the rotated QPixmap as canvas
-        self.canvas.set_image(qpix)
+        preview = QLabel(dlg)
+        preview.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        preview.setMinimumSize(self.ROTATE_PREVIEW_SIZE, self.ROTATE_PREVIEW_SIZE)
+        layout.addWidget(preview)
 
-    # === FLIP ===
-    def flip_horizontal(self):
-        # Gets the QPixmap
-        pix = self.canvas.pixmap()
+        angle_label = QLabel(dlg)
+        layout.addWidget(angle_label)
 
-        # Does not flip if QPixmap is empty, returns
-        if not pix or pix.isNull():
-            return
+        # Angle in tenths of a degree, positive = clockwise
+        slider = QSlider(Qt.Orientation.Horizontal, dlg)
+        slider.setRange(-1800, 1800)
+        slider.setValue(0)
+        layout.addWidget(slider)
 
-        # Makes a bgr
-        cv = self.qpixmap_to_cv2(pix)
+        mode = QComboBox(dlg)
+        mode.addItems(["Expand canvas", "Crop to fit"])
+        layout.addWidget(mode)
 
-        # Flips the bgr in cv2
-        cv = cv2.flip(cv, 1)
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Ok | QDialogButtonBox.StandardButton.Cancel, dlg)
+        buttons.accepted.connect(dlg.accept)
+        buttons.rejected.connect(dlg.reject)
+        layout.addWidget(buttons)
 
-        # Makes QPixmap of flipped bgr
-        qpix = self.cv2_to_qpixmap(cv)
+        # Redraw the proxy with the current angle (matrices are cached, so dragging back and forth is cheap)
+        def update_preview():
+            angle = slider.value() / 10.0
+            crop = mode.currentIndex() == 1
+            angle_label.setText(f"Angle: {angle:.1f}\u00b0")
 
-        # Sets the flipped QPixmap as canvas
-        self.canvas.set_image(qpix)
+            m, size = self.rotation_matrix(pw, ph, angle, crop)
+            rotated = cv2.warpAffine(proxy, m, size, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0))
+            preview.setPixmap(self.cv2_to_qpixmap(rotated))
 
-    def flip_vertical(self):
-        # Gets the QPixmap
-        pix = self.canvas.pixmap()
+        slider.valueChanged.connect(update_preview)
+        mode.currentIndexChanged.connect(update_preview)
+        update_preview()
 
-        # Does not flip if QPixmap is empty, returns
-        if not pix or pix.isNull():
+        if dlg.exec() != QDialog.DialogCode.Accepted:
             return
 
-        # Makes a bgr
-        cv = self.qpixmap_to_cv2(pix)
+        angle = slider.value() / 10.0
+        if angle == 0:
+            return
 
-        # Flips the bgr in cv2
-        cv = cv2.flip(cv, 0)
+        # Full resolution rotation
+        m, size = self.rotation_matrix(w, h, angle, mode.currentIndex() == 1)
+        rotated = cv2.warpAffine(bgr, m, size, flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0))
 
-        # Makes QPixmap of flipped bgr
-        qpix = self.cv2_to_qpixmap(cv)
+        # Sets the rotated image as canvas
+        self.canvas.flatten_layers()
+        self.canvas.set_image(self.cv2_to_qpixmap(rotated))
+
+
+    # Affine matrix and output size (width, height) for rotating a w x h image by angle degrees clockwise.
+    # crop=False grows the canvas to fit the whole image, crop=True keeps the largest rectangle without empty corners
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def rotation_matrix(w, h, angle, crop=False):
+
+        rad = math.radians(angle)
+        sin_a = abs(math.sin(rad))
+        cos_a = abs(math.cos(rad))
+
+        if crop:
+            out_w, out_h = imf.largest_inner_rect(w, h, sin_a, cos_a)
+        else:
+            out_w = w * cos_a + h * sin_a
+            out_h = w * sin_a + h * cos_a
+
+        out_w = max(1, int(round(out_w)))
+        out_h = max(1, int(round(out_h)))
+
+        # OpenCV angles are counter clockwise
+        m = cv2.getRotationMatrix2D(((w - 1) / 2, (h - 1) / 2), -angle, 1.0)
+
+        # Move the center of the image to the center of the output
+        m[0, 2] += (out_w - w) / 2
+        m[1, 2] += (out_h - h) / 2
+
+        m.setflags(write=False)
+        return m, (out_w, out_h)
+
+
+    # Largest axis aligned rectangle inside a w x h rectangle rotated by an angle (given as |sin|, |cos|)
+    @staticmethod
+    def largest_inner_rect(w, h, sin_a, cos_a):
+
+        width_is_longer = w >= h
+        side_long, side_short = (w, h) if width_is_longer else (h, w)
+
+        # Half constrained case: two corners touch the longer side
+        if side_short <= 2.0 * sin_a * cos_a * side_long or abs(sin_a - cos_a) < 1e-10:
+            x = 0.5 * side_short
+            if width_is_longer:
+                return x / sin_a, x / cos_a
+            return x / cos_a, x / sin_a
+
+        # Fully constrained case: all four corners touch the sides
+        cos_2a = cos_a * cos_a - sin_a * sin_a
+        return (w * cos_a - h * sin_a) / cos_2a, (h * cos_a - w * sin_a) / cos_2a
 
-        # Sets the flipped QPixmap as canvas
-        self.canvas.set_image(qpix)
 
     def selective_crop(self):
-        # Get current pixmap from canvas
-        pix = self.canvas.pixmap()
+        # Size changes apply to the whole picture, not to one layer
+        pix = self.canvas.picture_pixmap()
 
         # Abort if no image
         if not pix or pix.isNull():
@@ -159,22 +257,23 @@ class imf:
         qpix = self.cv2_to_qpixmap(crop_image)
 
         # Sets the cropped QPixmap as canvas
+        self.canvas.flatten_layers()
         self.canvas.set_image(qpix)
 
 
     def resize(self):
 
-        # Get current pixmap
-        pix = self.canvas.pixmap()
+        # Size changes apply to the whole picture, not to one layer
+        pix = self.canvas.picture_pixmap()
 
         # Abort if no canvas image
-        if self.canvas.image is None or self.canvas.image.isNull():
+        if pix is None or pix.isNull():
             QMessageBox.information(None, "No Image", "Image must be loaded first")
             return
 
-        # Get current image dimensions from the canvas
-        current_width = self.canvas.width()
-        current_height = self.canvas.height()
+        # Get current image dimensions
+        current_width = pix.width()
+        current_height = pix.height()
 
         # Ask user for new width
         width, ok1 = QInputDialog.getInt(
@@ -182,7 +281,7 @@ class imf:
             "Resize Image", f"Enter Width (current: {current_width}px:",
             current_width,
             1,  # minimum
-            10000  # maximum
+            self.RESIZE_MAX  # maximum
         )
 
         if not ok1:  # User Canceld
@@ -193,22 +292,103 @@ class imf:
             None, "Resize Image", f"Enter Height (current: {current_height}px:",
             current_height,
             1,
-            10000
+            self.RESIZE_MAX
         )
         if not ok2:  # User Cancelde
             return
 
+        # Ask user for quality
+        qualities = ["Final (high quality)", "Fast draft"]
+        quality, ok3 = QInputDialog.getItem(None, "Resize Image", "Select quality", qualities, 0, False)
+        if not ok3:
+            return
+
         # Convert QPixmap to an OpenCV image
         cv_image = self.qpixmap_to_cv2(pix)
 
         # Resize with OpenCV
-        resized_image = cv2.resize(cv_image, (width, height))
+        resized_image = self.resize_cv2(cv_image, width, height, draft=(quality == "Fast draft"))
 
         # Convert back to QPixmap and update canvas
         new_pixmap = self.cv2_to_qpixmap(resized_image)
+        self.canvas.flatten_layers()
         self.canvas.set_image(new_pixmap)
 
 
+    # Largest width/height accepted in the resize dialog
+    RESIZE_MAX = 30000
+
+    # Outputs with more pixels than this are resized in row strips
+    STRIP_PIXELS = 16_000_000
+
+
+    # Resize engine: picks the interpolation from the direction and quality.
+    # Downscale: INTER_AREA (final) or pyramid halving + bilinear (draft)
+    # Upscale: Lanczos (final) or bilinear (draft), in row strips for very large outputs
+    @staticmethod
+    def resize_cv2(bgr, width, height, draft=False):
+
+        h, w = bgr.shape[:2]
+        if (w, h) == (width, height):
+            return bgr.copy()
+
+        # Shrinking in both directions
+        if width <= w and height <= h:
+
+            if not draft:
+                return cv2.resize(bgr, (width, height), interpolation=cv2.INTER_AREA)
+
+            # Halve with pyrDown while the image is still at least twice the target
+            src = bgr
+            while src.shape[1] >= 2 * width and src.shape[0] >= 2 * height:
+                src = cv2.pyrDown(src)
+            return cv2.resize(src, (width, height), interpolation=cv2.INTER_LINEAR)
+
+        # Enlarging (in at least one direction)
+        interpolation = cv2.INTER_LINEAR if draft else cv2.INTER_LANCZOS4
+
+        if width * height > imf.STRIP_PIXELS:
+            return imf.resize_in_strips(bgr, width, height, interpolation)
+
+        return cv2.resize(bgr, (width, height), interpolation=interpolation)
+
+
+    # Resize into a preallocated output one band of rows at a time, so the
+    # temporary buffers of the interpolation stay the size of one strip
+    @staticmethod
+    def resize_in_strips(bgr, width, height, interpolation, strip_rows=512):
+
+        h, w = bgr.shape[:2]
+        sx = width / w
+        sy = height / h
+
+        out = np.empty((height, width) + bgr.shape[2:], dtype=bgr.dtype)
+
+        # Extra source rows above/below each strip for the interpolation kernel (Lanczos uses 8 taps)
+        pad = 4
+
+        for y0 in range(0, height, strip_rows):
+            y1 = min(height, y0 + strip_rows)
+
+            # Source rows that output rows y0..y1 sample from (same pixel-center mapping as cv2.resize)
+            s0 = max(0, int(np.floor((y0 + 0.5) / sy - 0.5)) - pad)
+            s1 = min(h, int(np.ceil((y1 - 0.5) / sy - 0.5)) + pad + 1)
+
+            # Output -> source mapping for this strip
+            m = np.float32([
+                [1 / sx, 0, 0.5 / sx - 0.5],
+                [0, 1 / sy, (y0 + 0.5) / sy - 0.5 - s0]
+            ])
+
+            cv2.warpAffine(
+                bgr[s0:s1], m, (width, y1 - y0),
+                dst=out[y0:y1],
+                flags=interpolation | cv2.WARP_INVERSE_MAP,
+                borderMode=cv2.BORDER_REPLICATE
+            )
+
+        return out
+
 
     def apply_operation_with_selection(self, operation_func):
         # Get current pixmap
@@ -225,15 +405,8 @@ class imf:
         # If frozen selection exists, apply only inside mask
         if hasattr(c, "sel_mgr") and c.sel_mgr.state.frozen and c.sel_mgr.is_ready():
 
-                h, w = cv_img.shape[:2]
-                mask = c.sel_mgr.mask((h, w))
-
-                # Apply operatuon to a copy
-                modified = operation_func(cv_img.copy())
-
-                # Blend modified pixels only where mask > 0
-                result = cv_img.copy()
-                result[mask > 0] = modified[mask > 0]
+                # Apply operation to a copy and blend it back only inside the (feathered) mask
+                result = c.sel_mgr.apply_in_selection(cv_img, operation_func)
 
                 return self.cv2_to_qpixmap(result)
 
@@ -252,14 +425,16 @@ class imf:
             QMessageBox.information(None, "Crop", "Select an area an press enter to freeze it first. \n Then choose Image -> Crop and press Enter to apply.")
             return
 
-        # Get current image as BGR
-        bgr = c.get_cv2_image()
-        if bgr is None:
+        # Size changes apply to the whole picture, not to one layer
+        pix = c.picture_pixmap()
+        if pix is None or pix.isNull():
             return
+        bgr = self.qpixmap_to_cv2(pix)
 
         # Let SelectionManager perform crop
         out = c.sel_mgr.crop(bgr, strict=bool(strict))
         if out is not None:
+            c.flatten_layers()
             self.canvas.set_cv2_image(out)
 
         # Exit selection mode after crop
@@ -1,27 +1,59 @@
 # imports different classes from the PyQt library
 from PyQt6 import QtGui
-import random
-from PyQt6.QtGui import QPainter, QPixmap, QColor, QBrush, QPen, QPolygon, QImage
+from PyQt6.QtGui import QPainter, QPixmap, QColor, QBrush, QPen, QPolygon, QPolygonF, QImage, QTransform
 from PyQt6.QtCore import Qt, QPoint, QSize, QRect, pyqtSignal
 from PyQt6 import QtCore
-from PyQt6.QtCore import QRectF
+from PyQt6.QtCore import QRectF, QPointF
 from image_menu_functions import imf
 from SelectionManager import SelectionManager
-from PyQt6.QtWidgets import (QWidget, QColorDialog, QInputDialog)
+from Orientation import Orientation
+from DirtyTiles import DirtyTiles
+import BrushEngine
+import FloodFill
+import Layers
+import BlendModes
+from lazy_imports import cv2, np
+import image_io
+from PyQt6.QtWidgets import (QWidget, QColorDialog, QInputDialog, QFileDialog, QMessageBox)
 
 
 
+# Undo step of a stroke or fill: the pixels of one layer it covered, before and after (BGRA arrays)
+class StrokeChange:
+
+    def __init__(self, layer, rect, before, after):
+        self.layer = layer                      # Index in the layer stack
+        self.rect = rect                        # QRect, image coordinates
+        self.before = before
+        self.after = after
+
+
+# full_res_loader of a preview whose full image could not be read: it stays a preview, edits go to its pixels
+def no_full_resolution():
+    return None, ""
+
+
 ##### Inhertis from Qwidget ######
 class Img_Canvas(QWidget):
     colorPicked = pyqtSignal(QColor)
+    strokeFinished = pyqtSignal(object)                         # Brush/spray/eraser stroke or bucket fill went into the image (StrokeChange)
+    layersChanged = pyqtSignal()                                # Layers added, removed, reordered or their settings changed
+    fullResolutionFailed = pyqtSignal(str)                      # Preview could not be replaced by the full image (error message)
+    pixelsReplaced = pyqtSignal()                               # Same picture in new pixel coordinates (full resolution loaded, orientation baked)
 
     def __init__(self, imf_instance, parent=None):
         super().__init__(parent)
 
         self.imf = imf_instance
 
+        self.layers = Layers.LayerStack()                       # Layers of the picture, self.image is the active one
         self.image = None                                       # No image loaded yet - Hodls QPixmap (image data)
+        self.orientation = Orientation()                        # Rotation/flip shown on screen, not yet applied to pixels
+        self.full_res_loader = None                             # Set when image is a reduced preview, loads the real pixels
+        self.dirty = DirtyTiles()                               # Changed tiles, for saving only what changed
         self._checker = self.make_checker_brush(tile=16)        # Background Pattern
+        self._view = None                                       # Cached view transform, see view()
+        self._scaled = None                                     # ((image cache key, width, height), scaled image) shown last
         self.offset = QPoint(0, 0)                       # Sets the position of the image (for panning)
         self.panning = False                                    # Is the image being dragged, Boolean value
         self.Last_pos = None                                    # Last Mouse position
@@ -39,6 +71,8 @@ class Img_Canvas(QWidget):
         self.shape_width = 20
         self.shape_height = 20
         self.spray_size = 10
+        self.spray_density = 100                                # Dots per mouse event
+        self.spray_rng = None                                   # numpy Generator the seeds of spray strokes come from, made on first use
 
         # Textbox size
         self.text_size = 50
@@ -52,9 +86,29 @@ class Img_Canvas(QWidget):
         self.brush_enabled = False
         self.eraser_enabled = False
 
+        # Brush tip settings and the stroke being drawn
+        self.brush_hardness = 1.0
+        self.brush_opacity = 1.0
+        self.brush_spacing = BrushEngine.SPACING
+        self.brush_shape = None                                 # None = round tip, else 2D array (0..1)
+        self.brush_tip = None                                   # Cached BrushTip for the current settings
+        self.brush_tip_key = None
+
+        # Stroke being drawn (set on press, merged into the image on release)
+        self.stroke = None                                      # BrushEngine.ToolStroke
+        self.stroke_layer = None                                # Its StrokeLayer, shown over the image until merged
+        self.recorder = None                                    # StrokeRecorder taking down strokes and fills, when recording
+        self.change_before = None                               # (QRect, pixels) the stroke being merged covers
+
         # For selecting spray
         self.spray_enabled = False
 
+        # For selecting paint bucket
+        self.bucket_enabled = False
+        self.bucket_tolerance = 32                              # Largest difference per channel that is still filled
+        self.bucket_contiguous = True                           # Only connected pixels, else every similar pixel
+        self.bucket_antialias = True
+
         # For selecting rectangle
         self.rect_enabled = False
 
@@ -119,33 +173,236 @@ class Img_Canvas(QWidget):
         if pix is not None and not pix.isNull():
 
             # Store as QImage so we can draw on it
-            self.image = pix.toImage()
+            image = pix.toImage()
             # Ensure it has an alpha channel for transparency
-            if self.image.format() != QImage.Format.Format_ARGB32:
-                self.image = self.image.convertToFormat(QImage.Format.Format_ARGB32)
+            if image.format() != QImage.Format.Format_ARGB32:
+                image = image.convertToFormat(QImage.Format.Format_ARGB32)
+        else:
+            image = None
+
+        # Result of a filter on one layer of several: only that layer changes
+        if image is not None and len(self.layers.layers) > 1 and image.size() == self.image.size():
+            self.set_layer_image(image)
+            return
+
+        self.set_qimage(image)
+
+
+    # Load new image from QImage (ARGB32), with an optional orientation that is not baked yet.
+    # full_res_loader: when image is a reduced preview, function returning (full resolution QImage, "") or (None, error message)
+    def set_qimage(self, image, orientation=None, full_res_loader=None):
+        self.end_stroke()                                       # A running stroke paints on the old image
+        self.layers.reset(image)
+        self.orientation = orientation or Orientation()
+        self.invalidate_view()
+        self.full_res_loader = full_res_loader
+
+        # Whole image is new
+        if image is not None:
+            self.dirty.reset(image.width(), image.height())
         else:
-            self.image = None
+            self.dirty.reset(0, 0)
 
         # Reset pan and zoom
         self.offset = QPoint(0, 0)
         self.zoom_scale = 1.0
 
         # Update minimmum sizr to match image
-        if self.image is not None and not self.image.isNull():
-            self.setMinimumSize(self.image.size())
-            if self.image.width() > self.width() or self.image.height() > self.image.height():
-                self.resize(self.image.size())
+        self.update_minimum_size()
 
         # Redraw widget
         self.update()
 
+
+    # Active layer: tools, filters and selections work on its pixels
+    @property
+    def image(self):
+        layer = self.layers.active_layer()
+        return layer.image if layer is not None else None
+
+    @image.setter
+    def image(self, image):
+        layer = self.layers.active_layer()
+        if layer is None or image is None:
+            self.layers.reset(image)
+        else:
+            layer.image = image
+
+
+    # Picture of all layers, as shown and saved (do not paint on it)
+    def picture(self):
+        if self.layers.is_flat():
+            self.dirty.clear("composite")
+            return self.image
+        return self.layers.picture(self.dirty.take("composite"))
+
+
+    # Keep widget at least as large as the image on screen
+    def update_minimum_size(self):
+        if self.image is not None and not self.image.isNull():
+            size = self.display_size()
+            self.setMinimumSize(size)
+            if size.width() > self.width() or size.height() > self.height():
+                self.resize(size)
+
+
     # Return current image as QPixmap
     def pixmap(self):
         if self.image is not None and not self.image.isNull():
+            self.prepare_pixels()                               # Pixel operations need full resolution and real orientation
             return QPixmap.fromImage(self.image)
         return None
 
 
+    # Called before anything reads or edits pixels
+    def prepare_pixels(self):
+        self.load_full_resolution()
+        self.bake_orientation()
+
+
+    # ---------- Reduced resolution preview ---------- #
+
+    def is_preview(self):
+        return self.full_res_loader is not None
+
+
+    # Replace a preview with the full resolution image (keeps orientation and what is shown on screen).
+    # If it cannot be read the image stays a preview (never saved as if it were the full image)
+    def load_full_resolution(self):
+        if self.full_res_loader is None or self.full_res_loader is no_full_resolution:
+            return
+
+        loader = self.full_res_loader
+        self.full_res_loader = None
+
+        full, error = loader()
+        if full is None or full.isNull():
+            self.full_res_loader = no_full_resolution
+            self.fullResolutionFailed.emit(error or "Unknown error.")
+            return
+
+        # Keep the image the same size on screen
+        if self.image is not None and self.image.width() > 0:
+            self.zoom_scale *= self.image.width() / full.width()
+
+        self.image = full
+        self.invalidate_view()
+        self.dirty.resize(full.width(), full.height())         # Same picture, only more pixels
+        self.update_minimum_size()
+        self.update()
+        self.pixelsReplaced.emit()                              # Undo steps of strokes made from now on are in full resolution pixels
+
+
+    # ---------- Orientation (view transform until baked) ---------- #
+
+    # Size of the image as shown on screen (width/height swap after quarter turns)
+    def display_size(self) -> QSize:
+        if self.image is None:
+            return QSize()
+        w, h = self.orientation.size(self.image.width(), self.image.height())
+        return QSize(w, h)
+
+
+    # Change orientation without touching the pixels
+    def set_orientation(self, orientation):
+        if self.image is None or self.image.isNull():
+            return
+
+        self.orientation = orientation
+        self.invalidate_view()
+        self.update_minimum_size()
+        self.update()
+
+
+    # Apply pending orientation to the pixels (done once, right before a pixel operation)
+    def bake_orientation(self):
+        if self.image is None or self.orientation.is_identity():
+            return
+
+        for layer in self.layers.layers:
+            layer.image = self.orientation.apply_to_qimage(layer.image)
+        self.orientation = Orientation()
+        self.invalidate_view()
+        self.dirty.reset(self.image.width(), self.image.height())
+        self.update()
+        self.pixelsReplaced.emit()                              # Undo steps of strokes made from now on are in baked pixels
+
+
+    # Full resolution image with orientation applied, without changing the canvas (used when saving)
+    def oriented_image(self):
+        if self.image is None:
+            return None
+        self.load_full_resolution()
+        return self.orientation.apply_to_qimage(self.picture())
+
+
+    # Cheap undo state: QImage copies are shared until one of them is painted on.
+    # image: take the snapshot of this full resolution image instead of the one shown
+    # Layers are only kept when there is more than one
+    def snapshot(self, image=None):
+        if image is not None:
+            return QImage(image), self.orientation, None, None
+
+        if self.image is None or self.image.isNull():
+            return None
+        layers = self.layers.snapshot() if len(self.layers.layers) > 1 else None
+        return QImage(self.image), self.orientation, self.full_res_loader, layers
+
+
+    # Restore a state made by snapshot()
+    def restore_snapshot(self, snapshot):
+        image, orientation, loader, layers = snapshot
+        self.set_qimage(QImage(image), orientation, loader)
+        if layers is not None:
+            self.layers.restore(layers)
+
+
+    # ---------- Stroke undo ---------- #
+
+    # Pixels of layer (index) under rect, read only
+    def layer_pixels(self, layer, rect):
+        view = image_io.qimage_const_view(self.layers.layers[layer].image)
+        return view[rect.y():rect.y() + rect.height(), rect.x():rect.x() + rect.width()]
+
+
+    # Called by strokes and fills just before they write rect: keep what was there
+    def keep_before(self, rect):
+        self.change_before = (rect, self.layer_pixels(self.layers.active, rect).copy())
+
+
+    # The stroke or fill is in the image: its undo step
+    def take_change(self):
+        rect, before = self.change_before
+        self.change_before = None
+        active = self.layers.active
+        return StrokeChange(active, rect, before, self.layer_pixels(active, rect).copy())
+
+
+    # Put the pixels of a change back (undo) or in again
+    def apply_change(self, change, undo=False):
+        r = change.rect
+        view = image_io.qimage_view(self.layers.layers[change.layer].image)
+        view[r.y():r.y() + r.height(), r.x():r.x() + r.width()] = change.before if undo else change.after
+        self.dirty.mark_rect(r.x(), r.y(), r.width(), r.height())
+        self.update()
+
+
+    # Write a change into a state made by snapshot(), as if it had been taken after the change
+    @staticmethod
+    def fold_change(snapshot, change):
+        image, orientation, loader, layers = snapshot
+        target = image if layers is None else layers[0][change.layer].image
+        r = change.rect
+        image_io.qimage_view(target)[r.y():r.y() + r.height(), r.x():r.x() + r.width()] = change.after
+
+
+    # Mark a painted area (image coordinates) as changed, margin covers pen width and antialiasing
+    def mark_dirty(self, rect: QRect, margin=0):
+        margin += self.pen_width + 2
+        r = rect.normalized().adjusted(-margin, -margin, margin, margin)
+        self.dirty.mark_rect(r.x(), r.y(), r.width(), r.height())
+
+
     def zoom_in(self):
         self.zoom_scale *= 1.25
         self.update()
@@ -173,26 +430,52 @@ class Img_Canvas(QWidget):
         if self.image is None:                                  # Exits the method if there is no image
             return
 
-        # Find the scaled image size from zoom
-        scaled_width = int(self.image.width() * self.zoom_scale)
-        scaled_height = int(self.image.height() * self.zoom_scale)
-
-        # Center image in widget
-        x = (self.width() - scaled_width) / 2
-        y = (self.height() - scaled_height) / 2
-
-
-        # Apply panning offset
-        xi = int(x + self.offset.x())
-        yi = int(y + self.offset.y())
-
-        # Draw scaled image
-        p.drawImage(xi, yi, self.image.scaled(
-            scaled_width,
-            scaled_height,
-            Qt.AspectRatioMode.KeepAspectRatio,
-            Qt.TransformationMode.SmoothTransformation
-        ))        # Draws the image with DrawPixmap
+        # Image position and scaled size on the widget (cached view transform)
+        display = self.display_size()
+        to_widget, to_image, image_rect = self.view()
+        xi, yi = image_rect.x(), image_rect.y()
+        scaled_width, scaled_height = image_rect.width(), image_rect.height()
+
+        # All layers (blended again only where they changed)
+        picture = self.picture()
+
+        # Draw scaled image (scaled again only when the pixels or the zoom changed, not on every stroke repaint)
+        if self.orientation.is_identity():
+            key = (picture.cacheKey(), scaled_width, scaled_height)
+            if self._scaled is None or self._scaled[0] != key:
+                self._scaled = (key, picture.scaled(
+                    scaled_width,
+                    scaled_height,
+                    Qt.AspectRatioMode.KeepAspectRatio,
+                    Qt.TransformationMode.SmoothTransformation
+                ))
+            p.drawImage(xi, yi, self._scaled[1])        # Draws the image with DrawPixmap
+
+        # Rotated/flipped: let the painter transform the image instead of the pixels
+        else:
+            p.save()
+            p.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+            p.translate(xi, yi)
+            p.scale(scaled_width / display.width(), scaled_height / display.height())
+            p.setTransform(self.orientation.transform(self.image.width(), self.image.height()), True)
+            p.drawImage(0, 0, picture)
+            p.restore()
+
+        # Stroke being drawn, shown over the image until it is merged
+        layer = self.stroke_layer
+        if layer is not None and layer.overlay_image is not None:
+            p.save()
+            p.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+            target = to_widget.mapRect(QRectF(layer.rect))
+
+            # Eraser shows the image with its alpha reduced, the checker has to show through
+            if layer.erase:
+                p.setClipRect(target)
+                p.fillRect(target, self._checker)
+
+            p.setTransform(to_widget)
+            p.drawImage(layer.rect.topLeft(), layer.overlay_image)
+            p.restore()
 
         # Draw border around the image
         if self.selected:
@@ -222,17 +505,12 @@ class Img_Canvas(QWidget):
             # Lasso/polygon selection outline
             elif self.sel_mode in ("lasso", "poly") and len(self.sel_points) >= 2:
 
-                # Convert all selection points to widget coordinates
-                pts_w = [self.image_to_widget(p) for p in self.sel_points]
-
+                # Convert all selection points to widget coordinates at once
                 path = QtGui.QPainterPath()
-                path.moveTo(QtCore.QPointF(pts_w[0]))
-
-                for q in pts_w[1:]:
-                    path.lineTo(QtCore.QPointF(q))
+                path.addPolygon(self.image_to_widget_polygon(self.sel_points))
 
                 # Close shape when frozen
-                if self.sel_frozen and len(pts_w) >= 3:
+                if self.sel_frozen and len(self.sel_points) >= 3:
                     path.closeSubpath()
 
                 selection_path.addPath(path)
@@ -255,7 +533,7 @@ class Img_Canvas(QWidget):
     # Suggest default widget size based on image
     def sizeHint(self):
         if self.image is not None:
-            return self.image.size()
+            return self.display_size()
         return QSize(800, 600)
 
 
@@ -287,30 +565,29 @@ class Img_Canvas(QWidget):
         # Mouse position in widget coordinates
         click_pos = event.position().toPoint()
 
-        # Centered position of the image on the canvas (before pan)
-        scaled_width = int(self.image.width() * self.zoom_scale)
-        scaled_height = int(self.image.height() * self.zoom_scale)
-
-        x = (self.width() - scaled_width) / 2
-        y = (self.height() - scaled_height) / 2
+        # Actual rectangle occupied by the image
+        return click_pos, self.image_rect_on_widget()
 
 
-        # Apply pan offset and snap to integer pixels
-        xi = int(x + self.offset.x())
-        yi = int(y + self.offset.y())
 
-        # Store for later use (e.g., in mouseMoveEvent)
-        self.image_origin = QPoint(xi, yi)
+    # True if a shape tool is selected
+    def shape_tool_enabled(self):
+        return self.rect_enabled or self.ellipse_enabled or self.triangle_enabled
 
-        # Actual rectangle occupied by the image
-        image_rect = QRect(xi, yi, scaled_width, scaled_height)
-        return click_pos, self.image_origin, image_rect, xi, yi
 
+    # True if any drawing tool is selected
+    def drawing_tool_enabled(self):
+        return (self.brush_enabled or self.spray_enabled or self.rect_enabled or self.ellipse_enabled or self.triangle_enabled or self.text_enabled or getattr(self, "eraser_enabled", False)
+                or self.bucket_enabled)
 
 
     # Handle mouse press for selection, drawing anf panning
     def mousePressEvent(self, event):
 
+        # Tools work on pixels, so load full resolution and apply pending rotation/flip first
+        if event.button() == Qt.MouseButton.LeftButton and (self.drawing_tool_enabled() or self.sel_active):
+            self.prepare_pixels()
+
         # Handle active selection before tools
         if event.button() == Qt.MouseButton.LeftButton and self.sel_active and not self.sel_frozen:
 
@@ -352,13 +629,13 @@ class Img_Canvas(QWidget):
             return
 
         # unpack mouse press info
-        click_pos, image_origin, image_rect, xi, yi = result
+        click_pos, image_rect = result
 
         # Check if the click was inside the image rectangle
         if image_rect.contains(click_pos):
 
             # If brush mode is enabled then draw, not pan
-            if (self.brush_enabled or self.spray_enabled or self.rect_enabled or self.ellipse_enabled or self.triangle_enabled or self.text_enabled or getattr(self, "eraser_enabled", False)):
+            if self.drawing_tool_enabled():
 
                 # Set drawing state as true
                 self.drawing = True
@@ -373,6 +650,22 @@ class Img_Canvas(QWidget):
                 image_x = pos_i.x()
                 image_y = pos_i.y()
 
+                # Paint bucket: one fill per click
+                if self.bucket_enabled:
+                    self.bucket_fill_at(image_x, image_y)
+                    return
+
+                # Stroke tools draw into a stroke layer that is merged into the image on release
+                if getattr(self, "brush_enabled", False) or getattr(self, "spray_enabled", False) or getattr(self, "eraser_enabled", False):
+                    self.begin_stroke()
+
+                    # Brush stamp, spray burst or eraser dab where the stroke starts
+                    x, y = self.stroke_point(event.position())
+                    self.stroke_changed(self.stroke.press(x, y))
+                    if self.recorder is not None:
+                        self.recorder.point(x, y)
+                    return
+
                 # Draw a point directly on the image
                 painter = QtGui.QPainter(self.image)
                 pen = QPen(self.pen_color, self.pen_width)
@@ -428,24 +721,15 @@ class Img_Canvas(QWidget):
                 elif getattr(self, "ellipse_enabled", False):
                     painter.drawEllipse(int(image_x - sw/2), int(image_y - sh/2), sw, sh)
 
-                # Single brush point
-                elif getattr(self, "brush_enabled", False):
-                    painter.drawPoint(image_x, image_y)
-
-                # Spray burst at click position
-                elif getattr(self, "spray_enabled", False):
-                    # Draw many tiny dots near the initial click (like a quick spray burst)
-                    for n in range(100):  # same density as during movement
-                        xo = random.gauss(0, self.spray_size)
-                        yo = random.gauss(0, self.spray_size)
-
-                        # Draw using image coordinates
-                        painter.drawPoint(
-                            int(image_x + xo),
-                            int(image_y + yo)
-                        )
-
                 painter.end()
+
+                # Area the tool could have touched
+                if getattr(self, "text_enabled", False):
+                    fm = QtGui.QFontMetrics(font)
+                    tw, th = fm.horizontalAdvance(self.text), fm.height()
+                    self.mark_dirty(QRect(image_x - tw // 2, image_y - th, tw, 2 * th))
+                else:
+                    self.mark_dirty(QRect(int(image_x - sw/2), int(image_y - sh/2), sw, sh) if self.shape_tool_enabled() else QRect(image_x, image_y, 0, 0))
                 self.update()
                 return
 
@@ -487,120 +771,17 @@ class Img_Canvas(QWidget):
                 self.update()
             return
 
-        # Brush tool: draw on image while sragging with LMB
-        if getattr(self, "brush_enabled", False) and self.drawing and (event.buttons() & Qt.MouseButton.LeftButton):
-            # Creates painter object for drawing on image
-            painter = QPainter(self.image)
-
-            # Use pen with current color and width
-            pen = QPen(self.pen_color, self.pen_width)
-            painter.setPen(pen)
-
-            # Find image position on widget with zoom and offset
-            scaled_width = int(self.image.width() * self.zoom_scale)
-            scaled_height = int(self.image.height() * self.zoom_scale)
-            x = (self.width() - scaled_width) / 2
-            y = (self.height() - scaled_height) / 2
-
-            xi = int(x + self.offset.x())
-            yi = int(y + self.offset.y())
-
+        # Brush, spray and eraser: continue the stroke while dragging with LMB
+        if self.stroke is not None and self.drawing and (event.buttons() & Qt.MouseButton.LeftButton):
 
-            # Convert mouse position from widget space to image pixel coordinates
-            current_widget = event.position().toPoint()
-
-            current_img = QPoint(
-                int((current_widget.x() - xi ) / self.zoom_scale),
-                int((current_widget.y() - yi ) / self.zoom_scale))
-
-            last_img = QPoint(
-                int((self.last_point.x() - xi ) / self.zoom_scale),
-                int((self.last_point.y() - yi ) / self.zoom_scale))
-
-            # Draws line from last to current position on the image
-            painter.drawLine(last_img, current_img)
-
-            # Releases painter
-            painter.end()
+            # Stamps are spaced along the path, however far the mouse moved since the last event
+            x, y = self.stroke_point(event.position())
+            self.stroke_changed(self.stroke.move(x, y))
+            if self.recorder is not None:
+                self.recorder.point(x, y)
 
             # Updates the last point for next mouse event (store screen position)
             self.last_point = event.position().toPoint()
-
-            # Triggers repaint of the widget
-            self.update()
-            return
-
-
-        # Eraser tooø: clear pixels along hte stroke
-        if getattr(self, "eraser_enabled", False) and self.drawing and (event.buttons() & Qt.MouseButton.LeftButton):
-            painter = QPainter(self.image)
-            painter.setRenderHint(QPainter.RenderHint.Antialiasing)
-            painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Clear)
-
-            # Configure Eraser pen: transparent, correct size, rounded stroke
-            eraser_pen = QPen(Qt.GlobalColor.transparent)
-            eraser_pen.setWidth(self.pen_width)
-            eraser_pen.setCapStyle(Qt.PenCapStyle.RoundCap)
-            eraser_pen.setJoinStyle(Qt.PenJoinStyle.RoundJoin)
-            painter.setPen(eraser_pen)
-
-            # Convert mouse position from widget space to image pixel coordinates (using image_origin)
-            current_point = event.position().toPoint() - self.image_origin
-            last_point_on_image = self.last_point - self.image_origin
-
-            painter.drawLine(last_point_on_image, current_point)
-            painter.end()
-
-            # Store last mouse position in widget space
-            self.last_point = event.position().toPoint()
-            self.update()
-            return
-
-
-        # Spray tool: Draw random points around the cursor
-        if getattr(self, "spray_enabled", False) and self.drawing and (event.buttons() & Qt.MouseButton.LeftButton):
-            # Creates painter object for drawing on image
-            painter = QPainter(self.image)
-
-            # Creates pen with defined color and width
-            pen = QPen(self.pen_color, self.pen_width)
-
-            # Makes painter use the selected pen
-            painter.setPen(pen)
-
-            # Gets the current mouse position adjusted for image offset
-            current_point = event.position().toPoint()
-
-
-            # Find image position on widget using zoom and offset
-            scaled_width = int(self.image.width() * self.zoom_scale)
-            scaled_height = int(self.image.height() * self.zoom_scale)
-            x = (self.width() - scaled_width) / 2
-            y = (self.height() - scaled_height) / 2
-            xi = int(x + self.offset.x())
-            yi = int(y + self.offset.y())
-
-            # Draw spray as random points around the cursor
-            current_img_x = int((current_point.x() - xi) / self.zoom_scale)
-            current_img_y = int((current_point.y() - yi) / self.zoom_scale)
-
-
-            # Draw spray as random points around the cursor
-            for n in range(100):
-                xo = random.gauss(0, self.spray_size)
-                yo = random.gauss(0, self.spray_size)
-                painter.drawPoint(
-                    int(current_img_x + xo),
-                    int(current_img_y + yo)
-                )
-            # Releases painter
-            painter.end()
-
-            # Store last mouse position in widget space
-            self.last_point = event.position().toPoint()
-
-            # Request repaint of the widget space
-            self.update()
             return
 
         # Panning: move image when dragging with left mouse button
@@ -639,8 +820,10 @@ class Img_Canvas(QWidget):
         if event.button() == Qt.MouseButton.LeftButton:
 
             if (getattr(self, "rect_enabled", False) or getattr(self, "triangle_enabled", False) or getattr(self, "brush_enabled", False)
-                            or getattr(self, "ellipse_enabled", False) or getattr(self, "spray_enabled", False) or getattr(self,"eraser_enabled", False)):
+                            or getattr(self, "ellipse_enabled", False) or getattr(self, "spray_enabled", False) or getattr(self,"eraser_enabled", False)
+                            or self.bucket_enabled):
                 self.drawing = False
+                self.end_stroke(commit=True)
 
             # If brush tool was not active, stop panning
             if self.panning:
@@ -664,6 +847,7 @@ class Img_Canvas(QWidget):
             self.text_enabled = False
             self.picker_enabled = False
             self.eraser_enabled = False
+            self.bucket_enabled = False
 
 
             brush_size, ok1 = QInputDialog.getInt(self, "Paintbrush size", "Enter size (1-100)", 5, 1, 100)
@@ -687,6 +871,166 @@ class Img_Canvas(QWidget):
             self.setCursor(Qt.CursorShape.ArrowCursor)
 
 
+    # ---------- Strokes ---------- #
+
+    # Set up everything a stroke needs once, mouse moves only map the position and draw
+    def begin_stroke(self):
+        self.end_stroke(commit=True)
+
+        settings = self.tool_settings()
+
+        # Spray dots come from a seed of their own, so a recorded stroke can be sprayed again exactly
+        if settings["tool"] == "spray":
+            if self.spray_rng is None:
+                self.spray_rng = np.random.default_rng()
+            settings["seed"] = int(self.spray_rng.integers(2 ** 63))
+
+        tip = self.current_brush_tip() if settings["tool"] == "brush" else None
+        self.stroke = BrushEngine.ToolStroke(self.image, settings, tip)
+        self.stroke_layer = self.stroke.layer
+
+        if self.recorder is not None:
+            self.recorder.begin(settings)
+
+
+    '''
+    Finish the running stroke.
+    commit: merge the stroke layer into the image (mouse release), otherwise drop it (Esc, image replaced)
+    '''
+    def end_stroke(self, commit=False):
+        stroke = self.stroke
+        self.stroke = None
+        self.stroke_layer = None
+        if stroke is None:
+            return
+
+        if commit:
+            rect = stroke.finish(self.keep_before)
+            if self.recorder is not None:
+                self.recorder.end()
+            if not rect.isEmpty():
+                self.dirty.mark_rect(rect.x(), rect.y(), rect.width(), rect.height())
+                self.strokeFinished.emit(self.take_change())
+        else:
+            stroke.cancel()
+            if self.recorder is not None:
+                self.recorder.discard()
+
+        self.update()
+
+
+    # Esc while drawing: throw the stroke away, the image was never touched
+    def cancel_stroke(self):
+        self.drawing = False
+        self.end_stroke(commit=False)
+
+
+    # Repaint the part of the widget showing rect (image coordinates) of the stroke layer
+    def stroke_changed(self, rect):
+        if rect.isEmpty():
+            return
+        r = self.view()[0].mapRect(QRectF(rect)).toAlignedRect()
+        self.update(r.adjusted(-2, -2, 2, 2))
+
+
+    # Settings of the active tool, everything needed to draw the same stroke again (also from a recording)
+    def tool_settings(self):
+        if self.brush_enabled:
+            tool = "brush"
+        elif self.spray_enabled:
+            tool = "spray"
+        elif self.eraser_enabled:
+            tool = "eraser"
+        elif self.bucket_enabled:
+            tool = "bucket"
+        else:
+            tool = None
+
+        c = self.pen_color
+        return {
+            "tool": tool,
+            "color": [c.blue(), c.green(), c.red(), c.alpha()],         # ARGB32 pixels are BGRA in memory
+            "pen_width": self.pen_width,
+            "spray_size": self.spray_size,
+            "spray_density": self.spray_density,
+            "seed": None,
+            "hardness": self.brush_hardness,
+            "opacity": self.brush_opacity,
+            "spacing": self.brush_spacing,
+            "shape": self.brush_shape,
+            "tolerance": self.bucket_tolerance,
+            "contiguous": self.bucket_contiguous,
+            "antialias": self.bucket_antialias,
+        }
+
+
+    # Widget position (QPointF) to image coordinates (floats, not clamped: strokes may leave the image)
+    def stroke_point(self, p):
+        q = self.view()[1].map(QPointF(p))
+        return q.x(), q.y()
+
+
+    # ---------- Brush engine ---------- #
+
+    # Tip for the current brush settings (masks are cached as long as the settings stay the same)
+    def current_brush_tip(self):
+        key = (self.pen_width, self.brush_hardness, id(self.brush_shape))
+        if self.brush_tip is None or self.brush_tip_key != key:
+            self.brush_tip = BrushEngine.BrushTip(self.pen_width, self.brush_hardness, self.brush_shape)
+            self.brush_tip_key = key
+        return self.brush_tip
+
+
+    # Ask for hardness, opacity, spacing and tip shape
+    def brush_settings(self):
+
+        hardness, ok = QInputDialog.getInt(self, "Brush Settings", "Hardness (%)", int(self.brush_hardness * 100), 0, 100)
+        if not ok:
+            return
+
+        opacity, ok = QInputDialog.getInt(self, "Brush Settings", "Opacity (%)", int(self.brush_opacity * 100), 1, 100)
+        if not ok:
+            return
+
+        spacing, ok = QInputDialog.getInt(self, "Brush Settings", "Spacing (% of brush size)", int(self.brush_spacing * 100), 1, 200)
+        if not ok:
+            return
+
+        tips = ["Round", "Custom (from image file)"]
+        tip, ok = QInputDialog.getItem(self, "Brush Settings", "Tip", tips, 0 if self.brush_shape is None else 1, False)
+        if not ok:
+            return
+
+        shape = None
+        if tip == tips[1]:
+            path, _ = QFileDialog.getOpenFileName(self, "Brush Tip Image", "", "Images (*.png *.jpg *.jpeg *.bmp)")
+            if not path:
+                return
+            shape = self.load_brush_shape(path)
+            if shape is None:
+                QMessageBox.warning(self, "Brush Settings", "Could not read the tip image.")
+                return
+
+        self.brush_hardness = hardness / 100
+        self.brush_opacity = opacity / 100
+        self.brush_spacing = spacing / 100
+        self.brush_shape = shape
+
+
+    # Tip mask from an image: its alpha channel if it has transparency, otherwise dark = paint
+    @staticmethod
+    def load_brush_shape(path):
+        img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        if img is None:
+            return None
+
+        if img.ndim == 3 and img.shape[2] == 4 and img[..., 3].min() < 255:
+            return img[..., 3] / 255.0
+        if img.ndim == 3:
+            img = cv2.cvtColor(img[..., :3], cv2.COLOR_BGR2GRAY)
+        return 1.0 - img / 255.0
+
+
     # Toggle eraser tool
     def toggle_eraser_mode(self):
         self.eraser_enabled = not self.eraser_enabled
@@ -699,6 +1043,7 @@ class Img_Canvas(QWidget):
             self.ellipse_enabled = False
             self.triangle_enabled = False
             self.text_enabled = False
+            self.bucket_enabled = False
             self.picker_enabled = False
             self.panning = False
 
@@ -732,6 +1077,7 @@ class Img_Canvas(QWidget):
             self.text_enabled = False
             self.picker_enabled = False
             self.eraser_enabled = False
+            self.bucket_enabled = False
 
 
             # Spray pixel thickness
@@ -742,6 +1088,11 @@ class Img_Canvas(QWidget):
 
             self.spray_size = spray_size
 
+            density, ok1 = QInputDialog.getInt(self, "Spray density", "Dots per mouse move (1-20000)", self.spray_density, 1, 20000)
+            if not ok1: return
+
+            self.spray_density = density
+
             color = QColorDialog.getColor(self.pen_color if hasattr(self, "pen_color") else QColor(0, 0, 0),
                                           self, "Choose spray color")
             if not color.isValid():
@@ -774,6 +1125,7 @@ class Img_Canvas(QWidget):
             self.text_enabled = False
             self.picker_enabled = False
             self.eraser_enabled = False
+            self.bucket_enabled = False
 
             # Ask for outline width
             outline_width, ok1 = QInputDialog.getInt(self, "Outline width", "Enter line thickness (1-100)", 5, 1, 100)
@@ -826,6 +1178,7 @@ class Img_Canvas(QWidget):
             self.panning = False
             self.picker_enabled = False
             self.eraser_enabled = False
+            self.bucket_enabled = False
 
             # ask for outline width
             outline_width, ok1 = QInputDialog.getInt(self, "Outline width", "Enter line thickness (1-100)", 5, 1, 100)
@@ -878,6 +1231,7 @@ class Img_Canvas(QWidget):
             self.text_enabled = False
             self.picker_enabled = False
             self.eraser_enabled = False
+            self.bucket_enabled = False
 
             # Ask for outline width
             outline_width, ok1 = QInputDialog.getInt(self, "Outline width", "Enter line thickness (1-100)", 5, 1, 100)
@@ -927,6 +1281,7 @@ class Img_Canvas(QWidget):
             self.panning = False
             self.picker_enabled = False
             self.eraser_enabled = False
+            self.bucket_enabled = False
 
             # Ask for text size
             pointsize, ok1 = QInputDialog.getInt(self, "Text size", "Enter size (1-100)", 5, 1, 100)
@@ -954,6 +1309,73 @@ class Img_Canvas(QWidget):
             self.panning = True
             self.setCursor(Qt.CursorShape.ArrowCursor)
 
+    # Toggle paint bucket tool
+    def toggle_bucket_mode(self):
+        self.bucket_enabled = not self.bucket_enabled
+
+        if self.bucket_enabled:
+            # Turn off other tools
+            self.brush_enabled = False
+            self.spray_enabled = False
+            self.rect_enabled = False
+            self.ellipse_enabled = False
+            self.triangle_enabled = False
+            self.text_enabled = False
+            self.panning = False
+            self.picker_enabled = False
+            self.eraser_enabled = False
+
+            # Ask for tolerance, fill mode and edges
+            tolerance, ok1 = QInputDialog.getInt(self, "Paint bucket", "Tolerance (0-255)", self.bucket_tolerance, 0, 255)
+            if not ok1: return
+
+            modes = ["Contiguous", "Global (all similar pixels)"]
+            mode, ok2 = QInputDialog.getItem(self, "Paint bucket", "Fill:", modes, 0 if self.bucket_contiguous else 1, False)
+            if not ok2: return
+
+            edges = ["Anti-aliased", "Hard"]
+            edge, ok3 = QInputDialog.getItem(self, "Paint bucket", "Edges:", edges, 0 if self.bucket_antialias else 1, False)
+            if not ok3: return
+
+            # Ask for fill color
+            color = QColorDialog.getColor(self.pen_color if hasattr(self, "pen_color") else QColor(0, 0, 0),
+                                          self, "Choose fill color", QColorDialog.ColorDialogOption.ShowAlphaChannel)
+            if not color.isValid():
+                return
+
+            self.bucket_tolerance = tolerance
+            self.bucket_contiguous = mode == modes[0]
+            self.bucket_antialias = edge == edges[0]
+            self.pen_color = color
+            self.setCursor(Qt.CursorShape.CrossCursor)
+
+        # Exit bucket mode and enable panning
+        else:
+            self.panning = True
+            self.setCursor(Qt.CursorShape.ArrowCursor)
+
+
+    # Bucket fill at image position (x, y), limited to the frozen selection if there is one
+    def bucket_fill_at(self, x, y):
+        selection = None
+        if self.sel_mgr.has_frozen_selcetion():
+            selection = self.sel_mgr.soft_mask((self.image.height(), self.image.width()))
+
+        settings = self.tool_settings()
+        rect = FloodFill.fill_with(self.image, x, y, settings, selection, self.keep_before)
+        if rect.isEmpty():
+            return
+
+        if self.recorder is not None:
+            self.recorder.begin(settings)
+            self.recorder.point(x, y)
+            self.recorder.end()
+
+        self.dirty.mark_rect(rect.x(), rect.y(), rect.width(), rect.height())
+        self.strokeFinished.emit(self.take_change())
+        self.update()
+
+
     # Turn panning on/off and disable other tools
     def toggle_panning_mode(self):
 
@@ -969,12 +1391,157 @@ class Img_Canvas(QWidget):
         self.text_enabled = False
         self.picker_enabled = False
         self.eraser_enabled = False
+        self.bucket_enabled = False
 
         # Normal cursor when panning
         self.setCursor(Qt.CursorShape.ArrowCursor)
 
 
 
+    # ---------- Layers ---------- #
+
+    # Replace the pixels of the active layer (same size), the other layers stay
+    def set_layer_image(self, image):
+        self.end_stroke()
+        self.image = image
+        self.dirty.mark_all()
+        self.update()
+
+
+    # Layers changed. picture_changed: the picture looks different (not for a new empty layer or a rename)
+    def layers_edited(self, picture_changed=True):
+        if picture_changed:
+            self.dirty.mark_all()
+        self.update()
+        self.layersChanged.emit()
+
+
+    # Layer names for choosing one, top layer first
+    def layer_names(self):
+        names = []
+        for i in reversed(range(len(self.layers.layers))):
+            layer = self.layers.layers[i]
+            names.append(f"{i + 1}: {layer.name}" + ("" if layer.visible else " (hidden)"))
+        return names
+
+
+    # Layers work on full resolution pixels, a running stroke goes into the layer it was drawn on
+    def prepare_layers(self):
+        if self.image is None or self.image.isNull():
+            return False
+        self.prepare_pixels()
+        self.end_stroke(commit=True)
+        return True
+
+
+    # Add an empty layer above the active one
+    def new_layer(self):
+        if not self.prepare_layers():
+            return
+
+        name, ok = QInputDialog.getText(self, "New Layer", "Name:", text=f"Layer {len(self.layers.layers) + 1}")
+        if not ok:
+            return
+
+        image = QImage(self.image.width(), self.image.height(), QImage.Format.Format_ARGB32)
+        image.fill(Qt.GlobalColor.transparent)
+        self.layers.add(Layers.Layer(image, name or "Layer"))
+        self.layers_edited(picture_changed=False)
+
+
+    def duplicate_layer(self):
+        if not self.prepare_layers():
+            return
+
+        layer = self.layers.active_layer()
+        self.layers.add(layer.copy(f"{layer.name} copy"))
+        self.layers_edited()
+
+
+    def delete_layer(self):
+        if not self.prepare_layers():
+            return
+        if len(self.layers.layers) < 2:
+            QMessageBox.information(self, "Delete Layer", "The last layer can not be deleted.")
+            return
+
+        self.layers.remove(self.layers.active)
+        self.layers_edited()
+
+
+    # Move the active layer up (+1) or down (-1)
+    def move_layer(self, step):
+        if not self.prepare_layers():
+            return
+        if self.layers.move(self.layers.active, step):
+            self.layers_edited()
+
+
+    # Choose the layer tools and filters work on
+    def select_layer(self):
+        if not self.prepare_layers():
+            return
+
+        names = self.layer_names()
+        current = len(self.layers.layers) - 1 - self.layers.active
+        name, ok = QInputDialog.getItem(self, "Select Layer", "Layer:", names, current, False)
+        if not ok:
+            return
+
+        self.layers.active = len(self.layers.layers) - 1 - names.index(name)
+        self.update()
+
+
+    # Ask for name, opacity, visibility and blend mode of the active layer
+    def layer_properties(self):
+        if not self.prepare_layers():
+            return
+        layer = self.layers.active_layer()
+
+        name, ok = QInputDialog.getText(self, "Layer Properties", "Name:", text=layer.name)
+        if not ok:
+            return
+
+        opacity, ok = QInputDialog.getInt(self, "Layer Properties", "Opacity (%)", round(layer.opacity * 100), 0, 100)
+        if not ok:
+            return
+
+        shown = ["Visible", "Hidden"]
+        visible, ok = QInputDialog.getItem(self, "Layer Properties", "Show:", shown, 0 if layer.visible else 1, False)
+        if not ok:
+            return
+
+        modes = list(BlendModes.MODES)
+        blend, ok = QInputDialog.getItem(self, "Layer Properties", "Blend mode:", modes, modes.index(layer.blend), False)
+        if not ok:
+            return
+
+        before = (layer.opacity, layer.visible, layer.blend)
+        layer.name = name or layer.name
+        layer.opacity = opacity / 100
+        layer.visible = visible == shown[0]
+        layer.blend = blend
+        self.layers_edited(picture_changed=(layer.opacity, layer.visible, layer.blend) != before)
+
+
+    # Merge all layers into one (the picture stays the same). Returns True if there was more than one
+    def flatten_layers(self):
+        if len(self.layers.layers) < 2:
+            return False
+        self.prepare_layers()
+        self.layers.flatten()
+        self.update()
+        return True
+
+
+    # All layers in one as QPixmap, for operations that change the size of the whole picture.
+    # The layers stay as they are, flatten_layers() once the operation is confirmed
+    def picture_pixmap(self):
+        if not self.prepare_layers():
+            return None
+        return QPixmap.fromImage(self.layers.flattened())
+
+
     # Begin a new selection (rect, lasso or poly)
     def start_selection(self, mode: str):
 
@@ -986,6 +1553,9 @@ class Img_Canvas(QWidget):
         if mode not in ("rect", "lasso", "poly"):
             return
 
+        # Selections are in pixel coordinates, load full resolution and apply pending rotation/flip first
+        self.prepare_pixels()
+
         # Reset selection state
         self.sel_mode = mode
         self.sel_active = True
@@ -1019,6 +1589,100 @@ class Img_Canvas(QWidget):
         self.update()
 
 
+    # Selection as plain data (None if there is no selection)
+    def selection_state(self):
+        if not self.sel_active:
+            return None
+        return self.sel_mgr.to_dict()
+
+
+    # Restore a selection made by selection_state() (image must be at full resolution)
+    def restore_selection(self, data):
+        if not data or self.image is None:
+            self.cancel_selection()
+            return
+
+        self.sel_mgr.from_dict(data)
+        state = self.sel_mgr.state
+
+        self.sel_mode = state.mode
+        self.sel_active = state.mode != "none"
+        self.sel_frozen = state.frozen
+        self.rect_anchor = QPoint(*state.rect_anchor) if state.rect_anchor else None
+        self.rect_current = QPoint(*state.rect_current) if state.rect_current else None
+        self.sel_points = [QPoint(x, y) for x, y in state.points]
+
+        # Frozen selection is ready for operations, like after pressing Enter
+        if self.sel_frozen:
+            self.active_mask = self.sel_mgr.mask((self.image.height(), self.image.width()))
+            self.ops_since_freeze = False
+        self.update()
+
+
+    # Ask for selection edge softening (applies to filters run inside a selection)
+    def feather_selection(self):
+
+        radius, ok = QInputDialog.getInt(self, "Feather Selection", "Feather radius in pixels (0 = hard edge)", self.sel_mgr.feather, 0, 200)
+        if not ok:
+            return
+
+        self.sel_mgr.set_feather(radius)
+
+
+    # ---------- View transform (image <-> widget coordinates) ---------- #
+
+    # Zoom and pan go through properties, so the cached view transform is dropped whenever they change
+    @property
+    def zoom_scale(self):
+        return self._zoom_scale
+
+    @zoom_scale.setter
+    def zoom_scale(self, value):
+        self._zoom_scale = value
+        self._view = None
+
+    @property
+    def offset(self):
+        return self._offset
+
+    @offset.setter
+    def offset(self, value):
+        self._offset = QPoint(value)
+        self._view = None
+
+
+    # Image size on screen or widget size changed
+    def invalidate_view(self):
+        self._view = None
+
+
+    def resizeEvent(self, event):
+        self.invalidate_view()
+        super().resizeEvent(event)
+
+
+    '''
+    (image -> widget QTransform, widget -> image QTransform, image rect on the widget)
+    Image coordinates are those of the image as shown (orientation applied).
+    Computed once and reused until zoom, pan, widget size or the shown image size change.
+    '''
+    def view(self):
+        if self._view is None:
+            display = self.display_size() if self.image is not None and not self.image.isNull() else QSize(0, 0)
+
+            # Scaled image size
+            sw = int(display.width() * self.zoom_scale)
+            sh = int(display.height() * self.zoom_scale)
+
+            # Centered position + panning offset
+            x = int((self.width() - sw) / 2 + self.offset.x())
+            y = int((self.height() - sh) / 2 + self.offset.y())
+
+            to_widget = QTransform(self.zoom_scale, 0, 0, self.zoom_scale, x, y)
+            self._view = (to_widget, to_widget.inverted()[0], QRect(x, y, sw, sh))
+        return self._view
+
+
     # Get the image's displayed rectangle in the widget (scaled + offset)
     def image_rect_on_widget(self) -> QRect:
 
@@ -1026,15 +1690,7 @@ class Img_Canvas(QWidget):
         if not self.image or self.image.isNull():
             return QRect()
 
-        # Scaled image size
-        sw = int(self.image.width() * self.zoom_scale)
-        sh = int(self.image.height() * self.zoom_scale)
-
-        # Centered position + panning offset
-        x = int((self.width() - sw) / 2 + self.offset.x())
-        y = int((self.height() - sh) / 2 + self.offset.y())
-
-        return QRect(x, y, sw, sh)
+        return QRect(self.view()[2])
 
 
     # Convert widget coordinates to image coordinates
@@ -1044,32 +1700,48 @@ class Img_Canvas(QWidget):
         if not self.image or self.image.isNull():
             return None
 
-
-        r = self.image_rect_on_widget()
+        to_widget, to_image, r = self.view()
         if not r.contains(p):               # Click is outside the image area
             return None
 
         # Map from widget space to image space
-        ix = (p.x() - r.x()) / self.zoom_scale
-        iy = (p.y() - r.y()) / self.zoom_scale
+        q = to_image.map(QPointF(p))
 
         # Clamp to valid image bounds
-        ix = max(0, min(int(ix), min(self.image.width() - 1, int(ix))))
-        iy = max(0, min(int(iy), min(self.image.height() - 1, int(iy))))
+        ix = max(0, min(int(q.x()), self.image.width() - 1))
+        iy = max(0, min(int(q.y()), self.image.height() - 1))
 
         return QPoint(ix, iy)
 
     # Convert image coordinates to widget coordinates
     def image_to_widget(self, p: QPoint) -> QPoint:
-        r = self.image_rect_on_widget()                 # image position/size on the widget
-        wx = int(r.x() + p.x() * self.zoom_scale)
-        wy = int(r.y() + p.y() * self.zoom_scale)
-        return QPoint(wx, wy)
+        q = self.view()[0].map(QPointF(p))
+        return QPoint(int(q.x()), int(q.y()))
+
+
+    # Many image points (list of QPoint) to a widget polygon in one call (lasso / polygon outlines)
+    def image_to_widget_polygon(self, points) -> QPolygonF:
+        return self.view()[0].map(QPolygonF(QPolygon(points)))
+
+
+    # Point arrays (N, 2) between image and widget coordinates, vectorized (the view is scale + translate)
+    def image_to_widget_array(self, xy):
+        t = self.view()[0]
+        return np.asarray(xy, dtype=np.float64) * (t.m11(), t.m22()) + (t.dx(), t.dy())
+
+    def widget_to_image_array(self, xy):
+        t = self.view()[1]
+        return np.asarray(xy, dtype=np.float64) * (t.m11(), t.m22()) + (t.dx(), t.dy())
 
 
     # Handle keyboard input
     def keyPressEvent(self, event):
 
+        # Esc while a stroke is drawn: cancel the stroke
+        if event.key() == Qt.Key.Key_Escape and self.stroke_layer is not None:
+            self.cancel_stroke()
+            return
+
         # Handle keys when a selection is active
         if self.sel_active and self.sel_mode in ("rect", "lasso", "poly"):
             # ENTER pressed
@@ -1078,6 +1750,9 @@ class Img_Canvas(QWidget):
                 if self.sel_frozen and self.pending_op:
                     op, params = self.pending_op  # params is a dict of options
 
+                    # Crop applies to the whole picture, not to one layer
+                    if op == "crop":
+                        self.flatten_layers()
 
                     pix = self.pixmap()
                     if pix is None:
@@ -1110,22 +1785,12 @@ class Img_Canvas(QWidget):
                     if self.sel_mgr.freeze():
                         self.sel_frozen = True
 
-                        pix = self.pixmap()
-                        if pix is None:
-                            self.cancel_selection()
-                            return
-
-                        # Convert current pixmap BGR image
-                        bgr = imf.qpixmap_to_cv2(pix)
-
-                        # If conversion failed, cancel selection
-                        if bgr is None:
+                        if self.image is None or self.image.isNull():
                             self.cancel_selection()
                             return
 
-                        # Build mask matching image size
-                        h, w = bgr.shape[:2]
-                        self.active_mask = self.sel_mgr.mask((h, w))
+                        # Build mask matching image size (cached by the selection manager)
+                        self.active_mask = self.sel_mgr.mask((self.image.height(), self.image.width()))
 
                         # No edits done since we froze the selection
                         self.ops_since_freeze = False
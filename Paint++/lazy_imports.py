@@ -0,0 +1,29 @@
+
+import importlib
+
+
+'''
+Stand-ins for the heavy modules (OpenCV, NumPy).
+The real module is imported the first time one of its attributes is used,
+so the window can appear before they are loaded.
+After loading, the module's names are copied onto the stand-in, so later
+lookups are plain attribute lookups instead of going through __getattr__.
+'''
+class LazyModule:
+
+    def __init__(self, name):
+        self.__dict__["_lazy_name"] = name
+
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._lazy_name)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+    def __repr__(self):
+        return f"<lazy module {self._lazy_name!r}>"
+
+
+cv2 = LazyModule("cv2")
+np = LazyModule("numpy")
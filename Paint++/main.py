@@ -1,9 +1,10 @@
 import os
 import sys
+import time
 
 # imports different classes from the PyQt library'
 from PyQt6.QtCore import QSize
-from PyQt6.QtCore import Qt, QProcess
+from PyQt6.QtCore import Qt
 from PyQt6.QtCore import *
 
 from PyQt6.QtGui import (
@@ -13,6 +14,7 @@ from PyQt6.QtGui import (
     QImageWriter,
     QPixmap,
     QColor,
+    QImage,
     QImageReader)
 
 from PyQt6.QtWidgets import (
@@ -30,16 +32,29 @@ from PyQt6.QtWidgets import (
     QScrollArea,
     QVBoxLayout,
     QPushButton,
-    QDialog)
-from img_canvas import Img_Canvas
-from image_menu_functions import imf
-from Filters import Filters
+    QInputDialog,
+    QProgressBar,
+    QTabWidget,
+    QDialog,
+    QProgressDialog)
+from Orientation import Orientation
+from Document import Document
+import image_io
+import ProjectFile
+import Autosave
+import StrokeRecorder
+from img_canvas import Img_Canvas, StrokeChange
+
+
+# Undo steps kept per document, the oldest are merged into the first full state
+UNDO_LIMIT = 50
 
 
 def main():
 
     # Create application object
     app = QApplication(sys.argv)
+    app.setApplicationName("Paint++")                   # Names the cache folder used for autosaves
 
     # creates an object from the QWidget class
     window = MainWindow()
@@ -51,11 +66,18 @@ def main():
     window.image_menu()
     window.tools_menu()
     window.shapes_menu()
+    window.layers_menu()
     window.filters_menu()
 
+    # Work from a session that crashed
+    window.offer_recovery()
+
     # Start eventloop
     app.exec()
 
+    # Closed normally, the autosaves are not needed anymore
+    window.close_all_documents()
+
 class MainWindow(QMainWindow):
 
     # Basic Window setup
@@ -66,23 +88,32 @@ class MainWindow(QMainWindow):
         self.panning = True
 
 
-        self.canvas = Img_Canvas(imf)                               # Creates an instance of the canvas class
-        self.canvas.colorPicked.connect(self.on_color_picked)
-        self.scroll = QScrollArea()                                 # Creates a scroll area
-
-        self.imf = imf(self.canvas)
-        self.filters = Filters(self.canvas, self.imf)
-        self.undo_history = []                                      # List to store previous image states for undo function
-
-        self.scroll.setWidget(self.canvas)                          # Puts the canvas inside the scroll area
-        self.scroll.setWidgetResizable(False)
-        self.scroll.setAlignment(Qt.AlignmentFlag.AlignCenter)
-        self.setCentralWidget(self.scroll)                          # Makes tbe scroll are the main content
+        # Every open image is a Document in its own tab
+        self.documents = []
+        self.tabs = QTabWidget()
+        self.tabs.setTabsClosable(True)
+        self.tabs.setMovable(True)
+        self.tabs.setDocumentMode(True)
+        self.tabs.tabCloseRequested.connect(self.close_document)
+        self.tabs.currentChanged.connect(self.on_document_changed)
+        self.setCentralWidget(self.tabs)                            # Makes the tabs the main content
 
         self.status = QStatusBar()
         self.setStatusBar(self.status)
 
-        self.current_path = None                                    # Tracks current file path
+        # Background image loading (of the current document)
+        self.load_cancel = QPushButton("Cancel loading")
+        self.load_cancel.clicked.connect(lambda: self.cancel_loading())
+        self.load_cancel.hide()
+        self.status.addPermanentWidget(self.load_cancel)
+
+        # Background saving
+        self.save_options = {}                                      # Per path quality/compression chosen in Save As
+        self.save_progress = QProgressBar()
+        self.save_progress.setRange(0, 0)                           # Busy indicator, writers do not report progress
+        self.save_progress.setMaximumWidth(120)
+        self.save_progress.hide()
+        self.status.addPermanentWidget(self.save_progress)
 
         # Create a dock panel
         dock = QDockWidget("", self)
@@ -100,7 +131,7 @@ class MainWindow(QMainWindow):
         self.addDockWidget(Qt.DockWidgetArea.LeftDockWidgetArea, dock)
 
         # Checkbox for shape fill toggle
-        self.cb_shape_fill.stateChanged.connect(self.canvas.set_fill_enabled)
+        self.cb_shape_fill.stateChanged.connect(lambda state: self.canvas.set_fill_enabled(state))
 
         # Color preview box
         self.color_preview = QFrame()
@@ -116,6 +147,132 @@ class MainWindow(QMainWindow):
         # Push content to the top
         layout.addStretch(1)
 
+        # Stroke recording (shared by all documents) and replays running on files
+        self.recorder = None
+        self.replay_tasks = []
+
+        # Start with one empty document
+        self.new_document()
+
+
+    # ----- Documents (tabs) ----- #
+
+    # The document in the current tab
+    @property
+    def doc(self):
+        return self.document_of(self.tabs.currentWidget())
+
+    def document_of(self, widget):
+        for doc in self.documents:
+            if doc.widget is widget:
+                return doc
+        return None
+
+    # Menu actions work on the current document
+    @property
+    def canvas(self):
+        return self.doc.canvas
+
+    @property
+    def scroll(self):
+        return self.doc.scroll
+
+    @property
+    def imf(self):
+        return self.doc.imf
+
+    @property
+    def filters(self):
+        return self.doc.filters
+
+    @property
+    def undo_history(self):
+        return self.doc.undo_history
+
+    @property
+    def current_path(self):
+        return self.doc.current_path
+
+    @current_path.setter
+    def current_path(self, path):
+        self.doc.current_path = path
+
+
+    # Open an empty document in a new tab (same process, shares modules and the worker pool)
+    def new_document(self):
+
+        doc = Document()
+        doc.canvas.colorPicked.connect(self.on_color_picked)
+        doc.canvas.strokeFinished.connect(lambda change: self.save_change(doc, change))     # Strokes are undone one at a time
+        doc.canvas.layersChanged.connect(lambda: self.save_state(doc))
+        doc.canvas.pixelsReplaced.connect(lambda: self.save_state(doc))                     # Full state that later strokes apply to
+        doc.canvas.fullResolutionFailed.connect(lambda error: self.on_full_resolution_failed(doc, error))
+        doc.canvas.recorder = self.recorder
+
+        # Keep the drawing colour and size of the current document
+        if self.documents:
+            doc.canvas.pen_color = self.canvas.pen_color
+            doc.canvas.pen_width = self.canvas.pen_width
+
+        self.documents.append(doc)
+        self.tabs.setCurrentIndex(self.tabs.addTab(doc.widget, doc.name()))
+        return doc
+
+
+    # Document a new image should go to: the current one if it is empty, otherwise a new tab
+    def target_document(self):
+        doc = self.doc
+        if doc is not None and doc.is_empty():
+            return doc
+        return self.new_document()
+
+
+    def close_document(self, index):
+        doc = self.document_of(self.tabs.widget(index))
+        if doc is None:
+            return
+
+        doc.close()
+        self.documents.remove(doc)
+        self.tabs.removeTab(index)
+        doc.widget.deleteLater()
+
+        # Always keep one tab
+        if not self.documents:
+            self.new_document()
+
+
+    # Stop background work of all documents (on exit)
+    def close_all_documents(self):
+        for doc in self.documents:
+            doc.close()
+        QThreadPool.globalInstance().waitForDone()
+
+
+    # Tab switched: show the state of the new current document
+    def on_document_changed(self, index):
+        doc = self.doc
+        if doc is None:
+            return
+
+        self.setWindowTitle(f"Paint++ - {doc.name()}" if doc.current_path or doc.canvas.image else "Paint++")
+        self.load_cancel.setVisible(doc.load_task is not None)
+        self.save_progress.setVisible(doc.save_task is not None)
+        self.cb_shape_fill.setChecked(doc.canvas.shape_fill_enabled)
+        self.update_color_preview(doc.canvas.pen_color)
+
+
+    # Refresh tab text (and window title if it is the current tab) after a document got a new name
+    def update_document_title(self, doc):
+        index = self.tabs.indexOf(doc.widget)
+        if index < 0:
+            return
+
+        self.tabs.setTabText(index, doc.name())
+        self.tabs.setTabToolTip(index, doc.current_path or "")
+        if doc is self.doc:
+            self.setWindowTitle(f"Paint++ - {doc.name()}")
+
     # Update color preview frame background
     def update_color_preview(self, color: QColor):
         self.color_preview.setStyleSheet(
@@ -133,25 +290,242 @@ class MainWindow(QMainWindow):
         self.status.showMessage(f"Picked color: {color.name()}", 2000)
 
     #### Undo Functions
-    def save_state(self):
+    def save_state(self, doc=None):
+        doc = doc or self.doc
 
-        pixmap = self.canvas.pixmap()
-        if pixmap and not pixmap.isNull():
-            self.undo_history.append(pixmap.copy())                 # Make a copy and add to history
+        state = doc.canvas.snapshot()                               # Shared copy of image + orientation
+        if state is not None:
+            doc.undo_history.append(state)                          # Add to history
+            self.trim_history(doc)
+
+
+    # A stroke or fill went in: keep only the pixels it covered (StrokeChange) instead of the whole image
+    def save_change(self, doc, change):
+        if not doc.undo_history:
+            self.save_state(doc)
+            return
+        doc.undo_history.append(change)
+        self.trim_history(doc)
+
+
+    # Keep UNDO_LIMIT steps. The first one always is a full state, changes after it are written into it
+    def trim_history(self, doc):
+        history = doc.undo_history
+        while len(history) > UNDO_LIMIT:
+            if isinstance(history[1], StrokeChange):
+                Img_Canvas.fold_change(history[0], history.pop(1))
+            else:
+                history.pop(0)
 
 
     # Undo the last action
     def undo(self):
-        if len(self.undo_history) < 2:
+        history = self.undo_history
+        if len(history) < 2:
             self.status.showMessage("Nothing to undo")
             return
 
-        self.undo_history.pop()                                     # Remove current state
+        last = history.pop()                                        # Remove current state
 
-        previous = self.undo_history[-1]
-        self.canvas.set_image(previous.copy())
-        self.status.showMessage(f"Undo successfull. {len(self.undo_history) - 1} undos remaining")
+        # A stroke: put back the pixels it covered
+        if isinstance(last, StrokeChange):
+            self.canvas.apply_change(last, undo=True)
 
+        # Otherwise the last full state, with the strokes made after it drawn in again
+        else:
+            base = max(i for i, step in enumerate(history) if not isinstance(step, StrokeChange))
+            self.canvas.restore_snapshot(history[base])
+            for change in history[base + 1:]:
+                self.canvas.apply_change(change)
+        self.status.showMessage(f"Undo successfull. {len(history) - 1} undos remaining")
+
+
+
+    # ----- Stroke recordings ----- #
+
+    # Take down every brush, spray, eraser stroke and bucket fill (in all documents) from now on
+    def start_recording(self):
+        if self.recorder is not None:
+            self.status.showMessage("Already recording")
+            return
+
+        image = self.canvas.image
+        self.recorder = StrokeRecorder.StrokeRecorder((image.width(), image.height()) if image is not None else None)
+        for doc in self.documents:
+            doc.canvas.recorder = self.recorder
+        self.status.showMessage("Recording strokes ...")
+
+
+    def stop_recording(self):
+        recorder = self.recorder
+        if recorder is None:
+            self.status.showMessage("Not recording")
+            return
+
+        self.recorder = None
+        for doc in self.documents:
+            doc.canvas.end_stroke(commit=True)                      # A stroke still being drawn belongs to the recording
+            doc.canvas.recorder = None
+
+        if recorder.is_empty():
+            self.status.showMessage("Nothing was recorded", 3000)
+            return
+
+        path, _ = QFileDialog.getSaveFileName(self, "Save Recording", "", f"Stroke Recording (*{StrokeRecorder.EXTENSION})")
+        if not path:
+            return
+        if not os.path.splitext(path)[1]:
+            path += StrokeRecorder.EXTENSION
+
+        ok, error = StrokeRecorder.save(recorder.to_dict(), path)
+        if not ok:
+            QMessageBox.critical(self, "Save Error", f"Could not save the recording:\n{error}")
+            return
+        self.status.showMessage(f"Saved {len(recorder.strokes)} strokes to {os.path.basename(path)}", 3000)
+
+
+    # Ask for a recording file and read it (None if cancelled or unreadable)
+    def open_recording(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Open Recording", "", f"Stroke Recording (*{StrokeRecorder.EXTENSION});;All Files (*)")
+        if not path:
+            return None
+
+        try:
+            return StrokeRecorder.load(path)
+        except ValueError as e:
+            QMessageBox.critical(self, "Open Error", str(e))
+            return None
+
+
+    # Draw a recording on the current image at full speed (one undo step), and show how long it took
+    def replay_recording(self):
+        canvas = self.canvas
+        if canvas.image is None or canvas.image.isNull():
+            return
+
+        recording = self.open_recording()
+        if recording is None:
+            return
+
+        canvas.end_stroke(commit=True)
+        canvas.prepare_pixels()
+        stats = StrokeRecorder.replay(recording, canvas.image)
+
+        rect = stats.changed
+        if not rect.isEmpty():
+            canvas.dirty.mark_rect(rect.x(), rect.y(), rect.width(), rect.height())
+            canvas.update()
+            self.save_state()
+
+        QMessageBox.information(self, "Replay", stats.summary())
+
+
+    # Draw a recording on many image files (on worker threads), results go to a chosen folder
+    def replay_on_files(self):
+        if self.replay_tasks:
+            self.status.showMessage("A replay is still running")
+            return
+
+        recording = self.open_recording()
+        if recording is None:
+            return
+
+        paths, _ = QFileDialog.getOpenFileNames(self, "Images to Replay On", "", "Images (*.png *.jpg *.jpeg *.bmp *.tif *.tiff *.webp);;All Files (*)")
+        if not paths:
+            return
+
+        folder = QFileDialog.getExistingDirectory(self, "Save Results To")
+        if not folder:
+            return
+
+        out_paths = [os.path.join(folder, os.path.basename(p)) for p in paths]
+        if any(os.path.exists(p) for p in out_paths):
+            resp = QMessageBox.question(self, "Overwrite?", "Some images already exist in that folder. Overwrite them?")
+            if resp != QMessageBox.StandardButton.Yes:
+                return
+
+        progress = QProgressDialog("Replaying strokes ...", "Cancel", 0, len(paths), self)
+        progress.setWindowModality(Qt.WindowModality.ApplicationModal)
+        progress.setMinimumDuration(300)
+        errors = []
+
+        def task_ended(task):
+            if task not in self.replay_tasks:                      # Cancelled
+                return
+            self.replay_tasks.remove(task)
+            progress.setValue(len(paths) - len(self.replay_tasks))
+            if self.replay_tasks:
+                return
+
+            progress.close()
+            if errors:
+                QMessageBox.warning(self, "Replay", "Some images were not written:\n\n" + "\n".join(errors[:10]))
+            else:
+                self.status.showMessage(f"Replayed on {len(paths)} images", 3000)
+
+        def failed(task, path, error):
+            errors.append(f"{os.path.basename(path)}: {error}")
+            task_ended(task)
+
+        def cancel():
+            for task in self.replay_tasks:
+                task.cancel()
+            self.replay_tasks.clear()
+
+        progress.canceled.connect(cancel)
+
+        for path, out_path in zip(paths, out_paths):
+            task = StrokeRecorder.ReplayFileTask(recording, path, out_path)
+            task.signals.finished.connect(lambda out, task=task: task_ended(task))
+            task.signals.failed.connect(lambda path, error, task=task: failed(task, path, error))
+            self.replay_tasks.append(task)
+            QThreadPool.globalInstance().start(task)
+
+
+    # Offer to restore the newest session that did not close cleanly (older ones are offered next start)
+    def offer_recovery(self):
+
+        sessions = Autosave.find_crashed_sessions()
+        if not sessions:
+            return
+
+        folder, info = sessions[0]
+        path = info.get("path")
+        name = os.path.basename(path) if path else "Untitled image"
+        saved = time.strftime("%Y-%m-%d %H:%M", time.localtime(info.get("saved", 0)))
+
+        resp = QMessageBox.question(
+            self,
+            "Recover Unsaved Work",
+            f"Paint++ did not close properly.\n\nRestore {name} ({info.get('width')}x{info.get('height')} px, autosaved {saved})?"
+        )
+        if resp != QMessageBox.StandardButton.Yes:
+            Autosave.discard_session(folder)
+            return
+
+        img, meta = Autosave.recover_session(folder)
+        if img is None:
+            QMessageBox.critical(self, "Recovery Failed", meta)
+            return
+
+        doc = self.target_document()
+        doc.set_frames(None, 1)
+        rotation, mirrored = meta.get("orientation", (0, False))
+        doc.canvas.set_qimage(img, Orientation(rotation, mirrored))
+        doc.canvas.restore_selection(meta.get("selection"))
+
+        # Recovered work is unsaved, Save writes it back to where it came from
+        doc.current_path = path
+        doc.project = None
+        doc.recovered = True
+        self.update_document_title(doc)
+        self.status.showMessage(f"Recovered: {name} - autosaved {saved}")
+
+        doc.undo_history.clear()
+        self.save_state(doc)
+
+        # This session autosaves it from now on
+        Autosave.discard_session(folder)
 
 
     #### This method creates the dropdown menu for File #####
@@ -159,9 +533,10 @@ class MainWindow(QMainWindow):
 
         menu = self.menuBar()
 
-        ##### New button to create a new image ####
+        ##### New button to create a new image (new tab) ####
         new_ = QAction(self.style().standardIcon(QStyle.StandardPixmap.SP_FileIcon), "New", self)
-        new_.triggered.connect(self.open_new_instance)
+        new_.setShortcut(QKeySequence.StandardKey.New)
+        new_.triggered.connect(self.new_document)
 
         ##### Open file in File-menu #####
         open_ = QAction(self.style().standardIcon(QStyle.StandardPixmap.SP_DirOpenIcon), "Open", self)
@@ -214,13 +589,6 @@ class MainWindow(QMainWindow):
         dlg.resize(QSize(600, 600))
         dlg.exec()
 
-    # Start new process running this same script
-    def open_new_instance(self):
-        import subprocess, sys, os
-        script = os.path.abspath(sys.argv[0])
-        QProcess.startDetached(sys.executable, [script])
-
-
     # Quit the application
     def exit_program(self):
         QApplication.quit()
@@ -287,7 +655,7 @@ class MainWindow(QMainWindow):
 
         # Allows user to change the canvas size, uses the resize_canvas method from img_canvas
         canvas_size = QAction(self.style().standardIcon(QStyle.StandardPixmap.SP_FileDialogDetailedView), "Canvas Size", self)
-        canvas_size.triggered.connect(self.canvas.resize_canvas)
+        canvas_size.triggered.connect(lambda: self.canvas.resize_canvas())
 
 
         # Add actions to Edit menu
@@ -297,10 +665,25 @@ class MainWindow(QMainWindow):
         edit_menu.addAction(canvas_size)
 
 
+    # Menu whose actions (and icons) are created the first time it opens (in parent, default the menu bar).
+    # Only for menus without shortcuts, a shortcut needs its action to exist from the start.
+    def deferred_menu(self, title, build, parent=None):
+        sub = (parent or self.menuBar()).addMenu(title)
+
+        def populate():
+            sub.aboutToShow.disconnect(populate)
+            build(sub)
+
+        sub.aboutToShow.connect(populate)
+        return sub
+
+
     def image_menu(self):
-        # Makes Image menu
-        menu = self.menuBar()
-        image_menu = menu.addMenu("&Image")
+        # Makes Image menu, filled when first opened
+        self.deferred_menu("&Image", self.build_image_menu)
+
+
+    def build_image_menu(self, image_menu):
 
         # Makes select submenu
         select_menu = QMenu("&Select", self)
@@ -318,9 +701,15 @@ class MainWindow(QMainWindow):
         polygon.triggered.connect(lambda : self.canvas.start_selection("poly"))
 
 
+        # Feather (soft edge) setting for selections
+        feather = QAction("Feather...", self)
+        feather.triggered.connect(lambda: self.canvas.feather_selection())
+
         select_menu.addAction(rectangular)
         select_menu.addAction(lasso)
         select_menu.addAction(polygon)
+        select_menu.addSeparator()
+        select_menu.addAction(feather)
 
         # Crop actions
         crop = QAction(QIcon("icons/icons8-crop.svg"), "Crop", self)
@@ -354,26 +743,32 @@ class MainWindow(QMainWindow):
         flip_vertical = QAction(QIcon("icons/icons8-flip_vertical.svg"), "Flip vertical", self)
         flip_vertical.triggered.connect(lambda :[self.save_state(),self.imf.flip_vertical()])
 
+        rotate_free = QAction(QIcon("icons/icons8-rotate_right.svg"), "Rotate by angle...", self)
+        rotate_free.triggered.connect(lambda :[self.save_state(), self.imf.rotate_free()])
+
         orientation_menu.addAction(rotate_right)
         orientation_menu.addAction(rotate_left)
         orientation_menu.addAction(flip_horizontal)
         orientation_menu.addAction(flip_vertical)
+        orientation_menu.addAction(rotate_free)
 
 
 
     # Shapes menu setup
     def shapes_menu(self):
-        menu = self.menuBar()
-        shape_menu = menu.addMenu("&Shapes")
+        self.deferred_menu("&Shapes", self.build_shapes_menu)
+
+
+    def build_shapes_menu(self, shape_menu):
 
         rect = QAction(QIcon("icons/icons8-paint.svg"), "Rectangle", self)
-        rect.triggered.connect(self.canvas.toggle_rect_mode)
+        rect.triggered.connect(lambda: self.canvas.toggle_rect_mode())
 
         ellipse = QAction(QIcon("icons/icons8-paint.svg"), "Ellipse", self)
-        ellipse.triggered.connect(self.canvas.toggle_ellipse_mode)
+        ellipse.triggered.connect(lambda: self.canvas.toggle_ellipse_mode())
 
         triangle = QAction(QIcon("icons/icons8-paint.svg"), "Triangle", self)
-        triangle.triggered.connect(self.canvas.toggle_triangle_mode)
+        triangle.triggered.connect(lambda: self.canvas.toggle_triangle_mode())
 
         shape_menu.addAction(rect)
         shape_menu.addAction(ellipse)
@@ -387,55 +782,135 @@ class MainWindow(QMainWindow):
 
         # Panning/move tool
         panning = QAction("Move", self)
-        panning.triggered.connect(self.canvas.toggle_panning_mode)
+        panning.triggered.connect(lambda: self.canvas.toggle_panning_mode())
 
         # Zoom actions
         zoom_in = QAction(QIcon("icons/icons8-zoom.svg"), "Zoom In", self)
         zoom_in.setShortcut("Ctrl++")
-        zoom_in.triggered.connect(self.canvas.zoom_in)
+        zoom_in.triggered.connect(lambda: self.canvas.zoom_in())
 
         zoom_out = QAction(QIcon("icons/icons8-zoom.svg"), "Zoom out", self)
         zoom_out.setShortcut("Ctrl+-")
-        zoom_out.triggered.connect(self.canvas.zoom_out)
+        zoom_out.triggered.connect(lambda: self.canvas.zoom_out())
 
         reset_zoom = QAction("Reset Zoom")
         reset_zoom.setShortcut("Ctrl+0")
-        reset_zoom.triggered.connect(self.canvas.reset_zoom)
+        reset_zoom.triggered.connect(lambda: self.canvas.reset_zoom())
 
         tools_menu.addAction(panning)
         tools_menu.addAction(zoom_in)
         tools_menu.addAction(zoom_out)
         tools_menu.addAction(reset_zoom)
 
-        # Paint Submenu
-        paint_menu = QMenu("&Paint", self)
-        tools_menu.addMenu(paint_menu)
+        # Paint Submenu, filled when first opened
+        self.deferred_menu("&Paint", self.build_paint_menu, tools_menu)
+
+        # Recorded strokes
+        self.deferred_menu("&Macros", self.build_macro_menu, tools_menu)
+
+
+    def build_paint_menu(self, paint_menu):
 
         paint = QAction(QIcon("icons/icons8-paint.svg"), "Brush", self)
         # paint.setCheckable(True)
-        paint.triggered.connect(self.canvas.toggle_brush_mode)
+        paint.triggered.connect(lambda: self.canvas.toggle_brush_mode())
+
+        brush_settings = QAction("Brush Settings...", self)
+        brush_settings.triggered.connect(lambda: self.canvas.brush_settings())
 
         eraser = QAction(QIcon("icons/icons8-paint.svg"), "Eraser", self)
-        eraser.triggered.connect(self.canvas.toggle_eraser_mode)
+        eraser.triggered.connect(lambda: self.canvas.toggle_eraser_mode())
 
         spray = QAction(QIcon("icons/icons8-spray.svg"), "Spray", self)
         # spray.setCheckable(True)
-        spray.triggered.connect(self.canvas.toggle_spray_mode)
+        spray.triggered.connect(lambda: self.canvas.toggle_spray_mode())
+
+        bucket = QAction(QIcon("icons/icons8-paint.svg"), "Paint Bucket", self)
+        bucket.triggered.connect(lambda: self.canvas.toggle_bucket_mode())
 
         text = QAction(QIcon("icons/icons8-text.svg"), "Text", self)
-        text.triggered.connect(self.canvas.toggle_text_mode)
+        text.triggered.connect(lambda: self.canvas.toggle_text_mode())
 
 
         paint_menu.addAction(paint)
+        paint_menu.addAction(brush_settings)
         paint_menu.addAction(spray)
+        paint_menu.addAction(bucket)
         paint_menu.addAction(eraser)
         paint_menu.addAction(text)
 
 
+    def build_macro_menu(self, macro_menu):
+
+        start = QAction("Start Recording", self)
+        start.triggered.connect(self.start_recording)
+
+        stop = QAction("Stop Recording...", self)
+        stop.triggered.connect(self.stop_recording)
+
+        replay = QAction("Replay on Image...", self)
+        replay.triggered.connect(self.replay_recording)
+
+        replay_files = QAction("Replay on Files...", self)
+        replay_files.triggered.connect(self.replay_on_files)
+
+        macro_menu.addAction(start)
+        macro_menu.addAction(stop)
+        macro_menu.addSeparator()
+        macro_menu.addAction(replay)
+        macro_menu.addAction(replay_files)
+
+
+    # Layers menu setup, made right away so the New Layer shortcut works before the menu was opened
+    def layers_menu(self):
+        self.build_layers_menu(self.menuBar().addMenu("&Layers"))
+
+
+    def build_layers_menu(self, layers_menu):
+
+        new_layer = QAction("New Layer...", self)
+        new_layer.setShortcut("Ctrl+Shift+N")
+        new_layer.triggered.connect(lambda: self.canvas.new_layer())
+
+        duplicate = QAction("Duplicate Layer", self)
+        duplicate.triggered.connect(lambda: self.canvas.duplicate_layer())
+
+        delete = QAction("Delete Layer", self)
+        delete.triggered.connect(lambda: self.canvas.delete_layer())
+
+        select = QAction("Select Layer...", self)
+        select.triggered.connect(lambda: self.canvas.select_layer())
+
+        properties = QAction("Layer Properties...", self)
+        properties.triggered.connect(lambda: self.canvas.layer_properties())
+
+        move_up = QAction("Move Layer Up", self)
+        move_up.triggered.connect(lambda: self.canvas.move_layer(1))
+
+        move_down = QAction("Move Layer Down", self)
+        move_down.triggered.connect(lambda: self.canvas.move_layer(-1))
+
+        flatten = QAction("Flatten Image", self)
+        flatten.triggered.connect(lambda: [self.save_state(), self.canvas.flatten_layers()])
+
+        layers_menu.addAction(new_layer)
+        layers_menu.addAction(duplicate)
+        layers_menu.addAction(delete)
+        layers_menu.addSeparator()
+        layers_menu.addAction(select)
+        layers_menu.addAction(properties)
+        layers_menu.addAction(move_up)
+        layers_menu.addAction(move_down)
+        layers_menu.addSeparator()
+        layers_menu.addAction(flatten)
+
+
     # Filters menu setup
     def filters_menu(self):
-        menu = self.menuBar()
-        filters_menu = menu.addMenu("&Filters")
+        self.deferred_menu("&Filters", self.build_filters_menu)
+
+
+    def build_filters_menu(self, filters_menu):
 
         # Blur submenu
         blur_menu = filters_menu.addMenu("Blur")
@@ -491,6 +966,30 @@ class MainWindow(QMainWindow):
         filters_menu.addAction(histogram)
         filters_menu.addAction(grayscale)
 
+        # Tone adjustments submenu (lookup tables)
+        adjust_menu = filters_menu.addMenu("Adjustments")
+
+        brightness_contrast = QAction("Brightness / Contrast", self)
+        brightness_contrast.triggered.connect(lambda: [self.save_state(), self.filters.brightness_contrast()])
+
+        gamma = QAction("Gamma", self)
+        gamma.triggered.connect(lambda: [self.save_state(), self.filters.gamma_correction()])
+
+        levels = QAction("Levels", self)
+        levels.triggered.connect(lambda: [self.save_state(), self.filters.levels()])
+
+        curves = QAction("Curves", self)
+        curves.triggered.connect(lambda: [self.save_state(), self.filters.curves()])
+
+        tone_adjust = QAction("Tone Adjust (Brightness/Contrast + Gamma)", self)
+        tone_adjust.triggered.connect(lambda: [self.save_state(), self.filters.tone_adjust()])
+
+        adjust_menu.addAction(brightness_contrast)
+        adjust_menu.addAction(gamma)
+        adjust_menu.addAction(levels)
+        adjust_menu.addAction(curves)
+        adjust_menu.addAction(tone_adjust)
+
 
     # Show zoom in status bar
     def update_zoom_status(self):
@@ -503,79 +1002,404 @@ class MainWindow(QMainWindow):
     def toolbar_button_clicked(self, s):
         print("click", s)
 
-    # Return current image on canvas as QImage
-    def current_qimage(self):
-        if self.canvas.image is None:
+    # Return current image on canvas as QImage (with rotation/flip applied)
+    def current_qimage(self, doc=None):
+        canvas = (doc or self.doc).canvas
+        if canvas.image is None:
             return None
-        return self.canvas.image
+        return canvas.oriented_image()
 
     ##### Actually saves the file #####
-    def write_image(self, path: str, fmt: bytes | None):
-
-
-        img = self.current_qimage()             # Get Current QImage from canvas
+    # Encoding runs on a worker thread, editing can continue while it saves.
+    # doc: document to save (default the current one)
+    def write_image(self, path: str, fmt: bytes | None, doc=None):
+        doc = doc or self.doc
+
+        # One save at a time per document, a newer request waits for the running one
+        if doc.save_task is not None:
+            doc.pending_save = (path, fmt)
+            self.status.showMessage(f"Waiting for previous save before saving {os.path.basename(path)} ...")
+            return True
+
+        # Native project: raw pixels, only changed tiles are written
+        if ProjectFile.is_project_path(path):
+            return self.write_project(path, doc)
+
+        img = self.current_qimage(doc)          # Get Current QImage from canvas
         if img is None:
             QMessageBox.information(self, "Nothing to save", "Load or create an image first.")
             return False
 
-        # Create writer with chosen format
-        writer = QImageWriter(path, fmt  if fmt else b"")
-        ok = writer.write(img)                  # Write to disk
-        if not ok:
-            QMessageBox.critical(self, "Save Failed", writer.errorString() or "Unkown error.")
-            return False
+        # Snapshot: the copy shares pixels until the canvas is painted on again
+        options = self.save_options.get(path, {})
+        task = image_io.ImageSaveTask(QImage(img), path, fmt, options.get("quality", -1), options.get("compression"))
+        task.signals.finished.connect(lambda p: self.on_save_finished(doc, p))
+        task.signals.failed.connect(lambda p, error: self.on_save_failed(doc, p, error))
+        self.start_save(doc, task, f"Saving {os.path.basename(path)} ...")
+        return True
+
+
+    def start_save(self, doc, task, message):
+        doc.save_task = task
+        if doc is self.doc:
+            self.save_progress.show()
+        self.status.showMessage(message)
+        QThreadPool.globalInstance().start(task)
+
+
+    def on_save_finished(self, doc, path):
 
         # Update path and status bar
-        self.current_path = path
+        doc.current_path = path
+        doc.recovered = False
+        self.update_document_title(doc)
         self.status.showMessage(f"Saved: {os.path.basename(path)}")
+
+        self.save_done(doc)
+
+
+    def on_save_failed(self, doc, path, error):
+        self.save_done(doc)
+        QMessageBox.critical(self, "Save Failed", f"{error}\n\nFile: {path}")
+
+
+    # Save the canvas as a .ppp project (pixels as they are, orientation and selection in the header)
+    def write_project(self, path, doc):
+
+        c = doc.canvas
+        if c.image is None or c.image.isNull():
+            QMessageBox.information(self, "Nothing to save", "Load or create an image first.")
+            return False
+
+        # Tiles changed since the project file was written (all of them for another file)
+        project = doc.project if doc.project is not None and doc.project.path == path else None
+        rects = c.dirty.take("project") if project is not None else []
+
+        # An untouched preview of this project only needs a new header, anything else needs the real image
+        image = None
+        if not (c.is_preview() and project is not None and not rects):
+            c.load_full_resolution()
+            image = QImage(c.picture())                     # All layers in one (layers are not kept in the file)
+
+        meta = {
+            "orientation": [c.orientation.rotation, c.orientation.mirrored],
+            "selection": c.selection_state(),
+        }
+
+        task = ProjectFile.ProjectSaveTask(image, path, meta, project, rects)
+        task.signals.finished.connect(lambda p: self.on_project_saved(doc, task, p))
+        task.signals.failed.connect(lambda p, error: self.on_project_save_failed(doc, p, error))
+
+        changed = f"{len(rects)} changed tiles" if project is not None else "full project"
+        self.start_save(doc, task, f"Saving {os.path.basename(path)} ({changed}) ...")
         return True
 
 
+    def on_project_saved(self, doc, task, path):
+        doc.project = task.result
+        self.on_save_finished(doc, path)
+
+
+    def on_project_save_failed(self, doc, path, error):
+        doc.canvas.dirty.mark_all()             # Unknown what reached the file, write everything next time
+        doc.project = None
+        self.on_save_failed(doc, path, error)
+
+
+    # Save task ended, start the waiting one if any
+    def save_done(self, doc):
+        doc.save_task = None
+        if doc is self.doc:
+            self.save_progress.hide()
+
+        if doc.pending_save is not None:
+            path, fmt = doc.pending_save
+            doc.pending_save = None
+            self.write_image(path, fmt, doc)
+
+
+    # Ask for quality/compression of the chosen format, returns dict (empty = defaults) or None if cancelled
+    def ask_save_options(self, ext):
+
+        ext = ext.lower()
+
+        if ext in image_io.QUALITY_FORMATS:
+            quality, ok = QInputDialog.getInt(self, "Save Options", "Quality (0-100, higher = better, larger file)", 90, 0, 100)
+            if not ok:
+                return None
+            return {"quality": quality}
+
+        if ext in image_io.COMPRESSION_FORMATS:
+            level, ok = QInputDialog.getInt(self, "Save Options", "Compression (0 = fastest, 9 = smallest file)", 1, 0, 9)
+            if not ok:
+                return None
+            return {"compression": level}
+
+        return {}
+
+
     def open_file(self):
 
         # Get supported formats
-       fmts = sorted(set(bytes(f).decode("ascii").lower() for f in QImageReader.supportedImageFormats()))
-       file_filter = "Images (" + " ".join(f"*.{ext}" for ext in fmts) + ");;All Files (*)"
+        fmts = sorted(set(bytes(f).decode("ascii").lower() for f in QImageReader.supportedImageFormats()))
+        file_filter = "Images (" + " ".join(f"*.{ext}" for ext in fmts) + f" *{ProjectFile.EXTENSION});;Paint++ Project (*{ProjectFile.EXTENSION});;All Files (*)"
 
 
         # Show file dialog
-       path, _ = QFileDialog.getOpenFileName(self, "Open Image", "", file_filter)
+        path, _ = QFileDialog.getOpenFileName(self, "Open Image", "", file_filter)
 
         # User cancelled
-       if not path:
-           return
+        if not path:
+            return
+
+        if ProjectFile.is_project_path(path):
+            self.open_project(path)
+            return
+
+        # Large images: ask whether to open full, a quick look or only a region
+        full_size = image_io.image_size(path)
+        mode = image_io.OPEN_FULL
+        if full_size.isValid() and full_size.width() * full_size.height() > image_io.LARGE_IMAGE_PIXELS:
+            mode, ok = QInputDialog.getItem(
+                self,
+                "Open Large Image",
+                f"Image is {full_size.width()}x{full_size.height()} px. How should it be opened?",
+                image_io.OPEN_MODES,
+                0,
+                False
+            )
+            if not ok:
+                return
+
+        clip_rect = None
+        if mode == image_io.OPEN_REGION:
+            clip_rect = self.ask_region(full_size)
+            if clip_rect is None:
+                return
+
+        # Decode on a worker thread, the window stays responsive
+        self.start_loading(path, mode, clip_rect)
+
+
+    # Open a .ppp project: pixels are mapped from the file, nothing is decoded
+    def open_project(self, path):
+
+        try:
+            project = ProjectFile.ProjectFile.open(path)
+        except (OSError, ValueError, KeyError) as e:
+            QMessageBox.critical(self, "Open Project Failed", f"{e}\n\nFile: {path}")
+            return
+
+        doc = self.target_document()
+        selection = project.selection()
+
+        # Large projects show a quick look first, the full pixels are read on the first edit.
+        # A stored selection needs full resolution coordinates, so it is read right away then.
+        if project.width * project.height > image_io.LARGE_IMAGE_PIXELS and not selection:
+            img = project.read_proxy()
+            loader = lambda: self.read_project_image(project)
+        else:
+            img = project.read_image()
+            loader = None
+
+        doc.set_frames(None, 1)
+        doc.canvas.set_qimage(img, project.orientation(), loader)
+        doc.canvas.dirty.clear("project")                       # Canvas matches the file
+        doc.canvas.restore_selection(selection)
+
+        doc.project = project
+        doc.current_path = path
+        self.update_document_title(doc)
+        self.status.showMessage(f"Opened project: {os.path.basename(path)} -  {project.width}x{project.height} px")
+
+        # New image, old undo states no longer apply
+        doc.undo_history.clear()
+        self.save_state(doc)
+
+
+    # ----- Background loading ----- #
+
+    # Decode path on a worker thread into a document (the current one if empty, otherwise a new tab)
+    def start_loading(self, path, mode, clip_rect=None):
+
+        doc = self.target_document()
+
+        task = image_io.ImageLoadTask(path, mode, clip_rect)
+        task.signals.preview.connect(lambda img: self.on_load_preview(doc, task, img))
+        task.signals.finished.connect(lambda img: self.on_load_finished(doc, task, img))
+        task.signals.failed.connect(lambda error: self.on_load_failed(doc, task, error))
+
+        doc.load_task = task
+        doc.load_preview_loader = None
+        doc.load_previous = doc.canvas.snapshot()               # Shown again if the load is cancelled
+
+        self.load_cancel.show()
+        self.status.showMessage(f"Loading {os.path.basename(path)} ...")
+        QThreadPool.globalInstance().start(task)
+
+
+    # Stop the load of a document (default the current one), put back what was shown before
+    def cancel_loading(self, doc=None):
+        doc = doc or self.doc
+        task = doc.load_task
+        if task is None:
+            return
+
+        task.cancel()
+        doc.load_task = None
+        if doc is self.doc:
+            self.load_cancel.hide()
+
+        # Remove the preview of the cancelled image
+        if doc.load_preview_loader is not None and doc.canvas.full_res_loader is doc.load_preview_loader:
+            if doc.load_previous is not None:
+                doc.canvas.restore_snapshot(doc.load_previous)
+            else:
+                doc.canvas.set_qimage(None)
+        doc.load_preview_loader = None
+        doc.load_previous = None
+
+        self.status.showMessage("Loading cancelled", 2000)
+
+
+    # Low resolution preview arrived, show it until the full image is ready
+    def on_load_preview(self, doc, task, img):
+        if task is not doc.load_task:
+            return
+
+        # If the user starts editing before the full image arrives, wait for the decode already running
+        # (its finished signal is ignored afterwards, the load is done by then)
+        def load_now():
+            QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+            try:
+                task.wait()
+            finally:
+                QApplication.restoreOverrideCursor()
+
+            full = task.image
+            if full is None:
+                self.finish_loading(doc, task, doc.canvas.image)       # Ends the load, the preview stays
+                return None, task.error or "Loading was cancelled."
+
+            # The operation asking for the pixels may have saved its undo state on the preview already,
+            # keep it (with the full image) after the loaded image instead of losing it with the old history
+            pending = [(QImage(full), state[1], None, None) for state in doc.undo_history
+                       if not isinstance(state, StrokeChange) and state[2] is load_now]
+            self.finish_loading(doc, task, full)
+            doc.undo_history.append((QImage(full), Orientation(), None, None))
+            doc.undo_history.extend(pending)
+            return full, ""                                            # The canvas saves the full image as undo state too
+
+        doc.load_preview_loader = load_now
+        doc.canvas.set_qimage(img, full_res_loader=load_now)
+        doc.scroll.horizontalScrollBar().setValue(0)
+        doc.scroll.verticalScrollBar().setValue(0)
+        self.status.showMessage(f"Loading {os.path.basename(task.path)} ... (preview {img.width()}x{img.height()} px)")
+
+
+    # Final image arrived
+    def on_load_finished(self, doc, task, img):
+        if task is not doc.load_task:
+            return
+
+        # Preview still on screen: swap in the full image, keeps zoom and orientation
+        if doc.load_preview_loader is not None and doc.canvas.full_res_loader is doc.load_preview_loader:
+            doc.canvas.full_res_loader = lambda: (img, "")
+            doc.canvas.load_full_resolution()
+
+        else:
+            # Quick look: the real pixels are decoded when an edit needs them
+            loader = None
+            if task.mode == image_io.OPEN_PROXY:
+                loader = lambda: image_io.read_image(task.path)
+
+            # Send Image to Canvas
+            doc.canvas.set_qimage(img, full_res_loader=loader)
+            doc.scroll.horizontalScrollBar().setValue(0)
+            doc.scroll.verticalScrollBar().setValue(0)
+
+        self.finish_loading(doc, task, img)
+
+        # Saves initial state for undo (only now that the final image is here)
+        self.save_state(doc)
+
+
+    def on_load_failed(self, doc, task, error):
+        if task is not doc.load_task:
+            return
+
+        self.cancel_loading(doc)
+        QMessageBox.critical(self, "Open Image Failed", f"{error}\n\nFile: {task.path}")
+
+
+    # Full pixels of a project opened as a quick look, (QImage, "") or (None, error message)
+    def read_project_image(self, project):
+        try:
+            return project.read_image(), ""
+        except (OSError, ValueError) as e:                      # File changed or removed since it was opened
+            return None, str(e)
+
+
+    # The full image behind a preview could not be read. Editing goes on with the preview,
+    # but saving must not write it over the original file, so the document forgets where it came from
+    def on_full_resolution_failed(self, doc, error):
+        doc.current_path = None
+        doc.project = None
+        self.update_document_title(doc)
+
+        # Not while the pixel operation that asked for the image is still running
+        message = f"{error}\n\nEditing continues on the reduced image. Save asks for a new file name, the original is not overwritten."
+        QTimer.singleShot(0, lambda: QMessageBox.warning(self, "Full Resolution Failed", message))
 
-       reader = QImageReader(path)      # Try to read the image
-       reader.setAutoTransform(True)    # Auto-rotate based on EXIF data
-       img = reader.read()
-       if img.isNull():                 # Failed to load
-           QMessageBox.critical(self, "Open Image Failed", f"{reader.errorString()}\n\nFile: {path}")
-           return
 
+    # Bookkeeping once the final image of a load is known
+    def finish_loading(self, doc, task, img):
 
-        # Convert to Qpixmap for Display
-        # Use img for pixel processing like filters
-       pix = QPixmap.fromImage(img)
-       if pix.isNull():
-           QMessageBox.critical(self, "Open Image Failed", f"Loaded QImage but QPixmap is null. \nFile: {path}")
-           return
+        doc.load_task = None
+        doc.load_preview_loader = None
+        doc.load_previous = None
+        if doc is self.doc:
+            self.load_cancel.hide()
+
+        # A region is a new image, saving must not overwrite the original file
+        doc.current_path = task.path if task.mode != image_io.OPEN_REGION else None
+        doc.project = None
+
+        # Pages / animation frames are only browsed for full images, previews and regions show the first one
+        doc.set_frames(task.path, task.frame_count if task.mode == image_io.OPEN_FULL else 1)
 
         # Update UI
-       name = os.path.basename(path)
-       self.status.showMessage(f"Opened: {name} -  {pix.width()}x{pix.height()} px")
-       self.setWindowTitle(f"Paint++ - {name}")
+        name = os.path.basename(task.path)
+        if task.mode == image_io.OPEN_PROXY:
+            self.status.showMessage(f"Opened preview: {name} -  {img.width()}x{img.height()} px (full image loads on first edit)")
+        else:
+            self.status.showMessage(f"Opened: {name} -  {img.width()}x{img.height()} px")
+        self.update_document_title(doc)
+
+        # New image, old undo states no longer apply
+        doc.undo_history.clear()
+
+
+    # Ask for a region (x, y, width, height) inside an image of the given size, returns QRect or None
+    def ask_region(self, size):
+
+        x, ok = QInputDialog.getInt(self, "Open Region", "Left (x)", 0, 0, size.width() - 1)
+        if not ok:
+            return None
 
+        y, ok = QInputDialog.getInt(self, "Open Region", "Top (y)", 0, 0, size.height() - 1)
+        if not ok:
+            return None
 
-        # Send Image to Canvas
-       self.canvas.set_image(pix)                       # Calls the set_image method from img_canvas
-       self.scroll.horizontalScrollBar().setValue(0)
-       self.scroll.verticalScrollBar().setValue(0)
+        w, ok = QInputDialog.getInt(self, "Open Region", "Width", min(2000, size.width() - x), 1, size.width() - x)
+        if not ok:
+            return None
 
-       self.current_path = path
+        h, ok = QInputDialog.getInt(self, "Open Region", "Height", min(2000, size.height() - y), 1, size.height() - y)
+        if not ok:
+            return None
 
-       # Saves initial state for undo
-       self.undo_history.clear()                        # Clear old history
-       self.save_state()                                # Saves state of newly opened image
+        return QRect(x, y, w, h)
 
 
     def save(self):
@@ -595,7 +1419,7 @@ class MainWindow(QMainWindow):
         # Get supported write formats
         fmts = sorted(set(bytes(f).decode("ascii").lower() for f in QImageWriter.supportedImageFormats()))
         pattern = " ".join(f"*.{ext}" for ext in fmts)
-        file_filter = f"Images ({pattern});;All Files (*)"
+        file_filter = f"Images ({pattern});;Paint++ Project (*{ProjectFile.EXTENSION});;All Files (*)"
 
         # Sugest same dir name when possible
         suggested = self.current_path or ""
@@ -606,7 +1430,7 @@ class MainWindow(QMainWindow):
         # Ensure an extensinon, .png as default
         root, ext = os.path.splitext(path)
         if not ext:
-            ext = ".png"
+            ext = ProjectFile.EXTENSION if selected_filter.startswith("Paint++ Project") else ".png"
             path = root + ext
 
 
@@ -618,8 +1442,13 @@ class MainWindow(QMainWindow):
             if resp != QMessageBox.StandardButton.Yes:
                 return
 
-        if self.write_image(path, fmt):
-            self.setWindowTitle(f"Paint++ - {os.path.basename(path)}")
+        # Quality / compression for this file
+        options = self.ask_save_options(ext.lstrip("."))
+        if options is None:
+            return
+        self.save_options[path] = options
+
+        self.write_image(path, fmt)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
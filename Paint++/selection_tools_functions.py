@@ -1,5 +1,4 @@
-import cv2
-import numpy as np
+from lazy_imports import cv2, np
 import math
 
 